@@ -0,0 +1,136 @@
+"""Round-trip and wall-time benchmarks for WireGuardProvisioner and the API.
+
+Runs every operation against vpn_wizard.testing.SimulatedSSH, which executes the real
+provisioner scripts in a sandbox and charges a configurable latency per round trip.
+
+    python benchmarks/bench_provisioner.py --clients 10 100 1000 --latency 0.08
+    python benchmarks/bench_provisioner.py --json bench_output.txt
+    python benchmarks/bench_provisioner.py --check-budgets   # exit 1 on round-trip regressions
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import inspect
+import json
+import sys
+import time
+from typing import Callable
+from unittest import mock
+
+from fastapi import Request, Response
+
+from vpn_wizard.apply import ApplyQueue
+from vpn_wizard.core import WireGuardProvisioner
+from vpn_wizard.testing import ROUND_TRIP_BUDGETS, AsyncRunner, CountingSSH, SimulatedSSH
+
+
+def _api(endpoint: str, payload: dict) -> Callable[[WireGuardProvisioner], object]:
+    def call(prov: WireGuardProvisioner) -> object:
+        from vpn_wizard import server
+
+        handler = getattr(server, endpoint)
+        model = handler.__annotations__["payload"]
+        if isinstance(model, str):
+            model = getattr(server, model)
+        body = model(ssh={"host": prov.ssh.config.host, "user": "root"}, **payload)
+        # Handlers taking the raw request/response get empty ones, as FastAPI would pass.
+        params = inspect.signature(handler).parameters
+        extra = {}
+        if "request" in params:
+            extra["request"] = Request({"type": "http", "headers": []})
+        if "response" in params:
+            extra["response"] = Response()
+        # Flushed within the measurement, so queued peer changes are counted too.
+        queue = ApplyQueue(delay=60)
+        with mock.patch.object(server, "SSHRunner", lambda *args, **kwargs: prov.ssh), mock.patch.object(
+            server, "AsyncSSHRunner", lambda *args, **kwargs: AsyncRunner(prov.ssh)
+        ), mock.patch.object(server, "APPLY_QUEUE", queue):
+            result = asyncio.run(handler(body, **extra))
+            queue.flush()
+        if getattr(result, "ok", True) is False:
+            raise RuntimeError(f"{endpoint} failed: {result.error}")
+        return result
+
+    return call
+
+
+OPERATIONS: dict[str, Callable[[WireGuardProvisioner], object]] = {
+    "provision": lambda prov: prov.provision(),
+    "list_clients": lambda prov: prov.list_clients(),
+    "add_client": lambda prov: prov.add_client("bench-new"),
+    "remove_client": lambda prov: prov.remove_client("client1"),
+    "detect_mtu": lambda prov: prov.detect_mtu(),
+    "api_clients_list": _api("client_list", {}),
+    "api_clients_add": _api("client_add", {"client_name": "bench-api"}),
+    "api_clients_export": _api("client_export", {"client_name": "client1"}),
+    "api_server_status": _api("server_status", {}),
+}
+
+
+def run_case(operation: str, clients: int, protocol: str, latency: float, cpu_cost: float) -> dict:
+    sim = SimulatedSSH(clients=clients, protocol=protocol, latency=latency, cpu_cost=cpu_cost)
+    try:
+        ssh = CountingSSH(sim)
+        prov = WireGuardProvisioner(ssh, protocol=protocol)
+        started = time.perf_counter()
+        with ssh.measure(operation, enforce=False):
+            OPERATIONS[operation](prov)
+        local_seconds = time.perf_counter() - started
+        return {
+            "operation": operation,
+            "clients": clients,
+            "round_trips": ssh.counts[operation],
+            "budget": ROUND_TRIP_BUDGETS.get(operation),
+            "simulated_seconds": round(sim.simulated_seconds, 3),
+            "local_seconds": round(local_seconds, 3),
+        }
+    finally:
+        sim.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--operations", nargs="+", choices=sorted(OPERATIONS), default=list(OPERATIONS))
+    parser.add_argument("--protocol", choices=["amneziawg", "wireguard"], default="amneziawg")
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated round-trip time, seconds")
+    parser.add_argument("--cpu-cost", type=float, default=0.005, help="Simulated remote work per command, seconds")
+    parser.add_argument("--json", dest="json_path", help="Also write results as JSON to this path")
+    parser.add_argument(
+        "--check-budgets",
+        action="store_true",
+        help="Exit with status 1 if an operation exceeds its ROUND_TRIP_BUDGETS entry",
+    )
+    args = parser.parse_args()
+
+    results = []
+    over_budget = []
+    print(f"{'operation':<20} {'clients':>7} {'round_trips':>11} {'budget':>6} {'simulated_s':>12} {'local_s':>8}")
+    for clients in args.clients:
+        for operation in args.operations:
+            row = run_case(operation, clients, args.protocol, args.latency, args.cpu_cost)
+            results.append(row)
+            budget = row["budget"]
+            if budget is not None and row["round_trips"] > budget:
+                over_budget.append(row)
+            print(
+                f"{row['operation']:<20} {row['clients']:>7} {row['round_trips']:>11} "
+                f"{budget if budget is not None else '-':>6} "
+                f"{row['simulated_seconds']:>12.2f} {row['local_seconds']:>8.2f}"
+            )
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as fp:
+            json.dump(results, fp, indent=2)
+    if args.check_budgets and over_budget:
+        for row in over_budget:
+            print(
+                f"OVER BUDGET: {row['operation']} at {row['clients']} clients used "
+                f"{row['round_trips']} round trips (budget {row['budget']})",
+                file=sys.stderr,
+            )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""Throughput of QR rendering: inline vs the QREngine process pool, Pillow vs fast PNG.
+
+First compares QR payload variants of one client config (verbatim at qrcode's default
+error correction, verbatim and compact with automatic error correction): payload size,
+QR version and render time. Then renders `--count` distinct client configs per case and
+reports renders per second.
+
+    python benchmarks/bench_qr.py --count 400 --workers 1 4 8
+    python benchmarks/bench_qr.py --json bench_qr.json
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import time
+
+import qrcode
+
+from vpn_wizard.qr import QREngine, compact_config, np, qr_code, render_qr
+
+CONFIG = """[Interface]
+PrivateKey = {key}
+Address = 10.10.{a}.{b}/32
+DNS = 1.1.1.1, 1.0.0.1
+MTU = 1380
+Jc = 2
+Jmin = 40
+Jmax = 70
+S1 = 20
+S2 = 30
+H1 = 111111111
+H2 = 222222222
+H3 = 333333333
+H4 = 444444444
+
+[Peer]
+PublicKey = {key}
+PresharedKey = {key}
+Endpoint = 203.0.113.10:3478
+AllowedIPs = 0.0.0.0/0, ::/0
+PersistentKeepalive = 15
+"""
+
+
+def _configs(count: int) -> list[str]:
+    return [
+        CONFIG.format(key=os.urandom(32).hex()[:43] + "=", a=i // 250, b=i % 250 + 2)
+        for i in range(count)
+    ]
+
+
+EC_NAMES = {
+    qrcode.constants.ERROR_CORRECT_L: "L",
+    qrcode.constants.ERROR_CORRECT_M: "M",
+    qrcode.constants.ERROR_CORRECT_Q: "Q",
+    qrcode.constants.ERROR_CORRECT_H: "H",
+}
+
+
+def compare_payloads(config: str, repeat: int = 5) -> list[dict]:
+    def timed(render) -> float:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            render()
+        return (time.perf_counter() - started) / repeat * 1000
+
+    rows = []
+    baseline = qrcode.QRCode()
+    baseline.add_data(config)
+    baseline.make(fit=True)
+    rows.append(
+        {
+            "payload": "verbatim, EC M",
+            "bytes": len(config.encode("utf-8")),
+            "version": baseline.version,
+            "ec": "M",
+            "render_ms": round(timed(lambda: qrcode.make(config).save(os.devnull, format="PNG")), 1),
+        }
+    )
+    for name, data, compact in (
+        ("verbatim, auto EC", config, False),
+        ("compact, auto EC", compact_config(config), True),
+        ("compact+numeric", compact_config(config, group_numeric=True), True),
+    ):
+        qr = qr_code(data)
+        rows.append(
+            {
+                "payload": name,
+                "bytes": len(data.encode("utf-8")),
+                "version": qr.version,
+                "ec": EC_NAMES[qr.error_correction],
+                "render_ms": round(timed(lambda: render_qr(data, "png", fast=True)), 1),
+            }
+        )
+    return rows
+
+
+def run_case(configs: list[str], workers: int, fast: bool, fmt: str) -> dict:
+    engine = QREngine(workers=workers, fast=fast)
+    try:
+        if workers:
+            list(engine.map((config, fmt) for config in configs[: workers * 2]))  # start the processes
+        started = time.perf_counter()
+        total = sum(len(png) for png in engine.map((config, fmt) for config in configs))
+        elapsed = time.perf_counter() - started
+    finally:
+        engine.shutdown()
+    return {
+        "workers": workers,
+        "mode": "svg" if fmt == "svg" else ("fast" if fast else "pillow"),
+        "renders": len(configs),
+        "seconds": round(elapsed, 3),
+        "renders_per_sec": round(len(configs) / elapsed, 1),
+        "avg_bytes": total // len(configs),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 4, 8], help="0 renders inline")
+    parser.add_argument("--modes", nargs="+", choices=["pillow", "fast", "svg"], default=["pillow", "fast"])
+    parser.add_argument("--json", dest="json_path", help="Also write results as JSON to this path")
+    args = parser.parse_args()
+
+    configs = _configs(args.count)
+    print(f"numpy: {'yes' if np is not None else 'no'}, CPUs: {os.cpu_count()}")
+    payloads = compare_payloads(configs[0])
+    print(f"{'payload':<18} {'bytes':>5} {'version':>7} {'ec':>2} {'render_ms':>9}")
+    for row in payloads:
+        print(f"{row['payload']:<18} {row['bytes']:>5} {row['version']:>7} {row['ec']:>2} {row['render_ms']:>9.1f}")
+    print()
+    print(f"{'workers':>7} {'mode':<7} {'renders':>7} {'seconds':>8} {'renders/s':>10} {'avg_bytes':>9}")
+    results = []
+    for workers in args.workers:
+        for mode in args.modes:
+            row = run_case(configs, workers, fast=mode == "fast", fmt="svg" if mode == "svg" else "png")
+            results.append(row)
+            print(
+                f"{row['workers']:>7} {row['mode']:<7} {row['renders']:>7} {row['seconds']:>8.2f} "
+                f"{row['renders_per_sec']:>10.1f} {row['avg_bytes']:>9}"
+            )
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as fp:
+            json.dump({"payloads": payloads, "throughput": results}, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,489 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import contextvars
+from dataclasses import dataclass, field
+import hashlib
+import os
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+
+try:
+    import asyncssh
+except ImportError:  # pragma: no cover - optional dependency
+    asyncssh = None
+
+from vpn_wizard.core import (
+    PRIVATE_KEYS,
+    CommandStat,
+    Ops,
+    RemoteCommandError,
+    SSHConfig,
+    SSHRunner,
+    T,
+    WireGuardProvisioner,
+    _command_error,
+    _flock_command,
+    _CommandRecorder,
+    _mask_secret,
+    _wrap_command,
+)
+from vpn_wizard.plan import ChangePlan
+
+_phase: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("vpnw_phase", default=None)
+
+
+def asyncssh_available() -> bool:
+    return asyncssh is not None
+
+
+class AsyncSSHRunner(_CommandRecorder):
+    """asyncio counterpart of SSHRunner with the same `run` semantics.
+
+    With asyncssh installed (`pip install vpn-wizard[async]`) every command is a channel
+    on one event-loop connection, so concurrent operations cost no threads. Without it
+    the runner falls back to a paramiko SSHRunner driven through `asyncio.to_thread`,
+    which keeps the API usable everywhere at the old cost.
+    """
+
+    def __init__(
+        self,
+        config: SSHConfig,
+        logger: Optional[Callable[[str], None]] = None,
+        on_command: Optional[Callable[[CommandStat], None]] = None,
+        slow_threshold: Optional[float] = 10.0,
+        backend: str = "auto",
+    ) -> None:
+        super().__init__(config, logger, on_command, slow_threshold)
+        if backend not in {"auto", "asyncssh", "paramiko"}:
+            raise ValueError(f"Unknown SSH backend: {backend}")
+        if backend == "asyncssh" and asyncssh is None:
+            raise RuntimeError("asyncssh is not installed (pip install vpn-wizard[async]).")
+        self.backend = "asyncssh" if backend != "paramiko" and asyncssh is not None else "paramiko"
+        self.conn = None
+        self._sync: Optional[SSHRunner] = None
+
+    @property
+    def phase(self) -> Optional[str]:
+        # Context-local, so concurrent tasks tag their own commands.
+        return _phase.get()
+
+    @phase.setter
+    def phase(self, value: Optional[str]) -> None:
+        _phase.set(value)
+
+    async def __aenter__(self) -> "AsyncSSHRunner":
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close()
+
+    async def connect(self) -> None:
+        self.log("Connecting over SSH...")
+        if self.backend == "paramiko":
+            self._sync = SSHRunner(self.config, self.log, self.on_command, self.slow_threshold)
+            await asyncio.to_thread(self._sync.connect)
+            return
+        self.conn = await asyncssh.connect(
+            self.config.host,
+            port=self.config.port,
+            username=self.config.user,
+            password=self.config.password,
+            client_keys=self._client_keys(),
+            agent_path=None,
+            known_hosts=None,
+            connect_timeout=self.config.timeout,
+        )
+
+    def _client_keys(self) -> list:
+        if self.config.key_content:
+            key = PRIVATE_KEYS.get(
+                "asyncssh",
+                self.config.key_content,
+                lambda text: asyncssh.import_private_key(text.strip() + "\n"),
+            )
+            return [key]
+        if self.config.key_path:
+            return [self.config.key_path]
+        return []
+
+    async def close(self) -> None:
+        if self._sync:
+            await asyncio.to_thread(self._sync.close)
+            self._sync = None
+        if self.conn:
+            self.conn.close()
+            await self.conn.wait_closed()
+            self.conn = None
+
+    async def run(
+        self, command: str, sudo: bool = False, check: bool = True, pty: bool = True, attempt: int = 0
+    ) -> str:
+        if self._sync:
+            # Phase is context-local here; hand it to the worker thread explicitly.
+            phase = self.phase
+
+            def call() -> str:
+                self._sync.phase = phase
+                return self._sync.run(command, sudo=sudo, check=check, pty=pty, attempt=attempt)
+
+            return await asyncio.to_thread(call)
+        if not self.conn:
+            raise RuntimeError("SSH client not connected.")
+
+        wrapped = _wrap_command(self.config, command, sudo)
+        self.log(f"$ {command}")
+        if sudo and self.config.password and pty:
+            pty = False  # Avoid echoing the sudo password into stdout/stderr
+        stdin = (self.config.password + "\n").encode("utf-8") if sudo and self.config.password else None
+        started = time.monotonic()
+        result = await self.conn.run(
+            wrapped,
+            input=stdin,
+            term_type="xterm" if pty else None,
+            check=False,
+            encoding=None,
+        )
+        raw_out = result.stdout or b""
+        raw_err = result.stderr or b""
+        out = _mask_secret(self.config, raw_out.decode("utf-8", "ignore").strip())
+        err = _mask_secret(self.config, raw_err.decode("utf-8", "ignore").strip())
+        status = result.exit_status if result.exit_status is not None else -1
+        bytes_out = len(wrapped.encode("utf-8")) + len(stdin or "")
+        self._record(command, time.monotonic() - started, bytes_out, len(raw_out) + len(raw_err), status, attempt)
+        if check and status != 0:
+            raise _command_error(command, status, out, err)
+        if err and not out:
+            return err
+        return out
+
+    async def put(self, local_path: str, remote_path: str) -> None:
+        if self._sync:
+            await asyncio.to_thread(self._sync.put, local_path, remote_path)
+            return
+        started = time.monotonic()
+        async with self.conn.start_sftp_client() as sftp:
+            parent = os.path.dirname(remote_path)
+            if not await sftp.exists(parent):
+                await sftp.mkdir(parent)
+            await sftp.put(local_path, remote_path)
+        self._record(f"sftp put {remote_path}", time.monotonic() - started, os.path.getsize(local_path), 0, 0)
+
+    async def get(self, remote_path: str, local_path: str) -> None:
+        if self._sync:
+            await asyncio.to_thread(self._sync.get, remote_path, local_path)
+            return
+        started = time.monotonic()
+        async with self.conn.start_sftp_client() as sftp:
+            await sftp.get(remote_path, local_path)
+        self._record(f"sftp get {remote_path}", time.monotonic() - started, 0, os.path.getsize(local_path), 0)
+
+    @contextlib.asynccontextmanager
+    async def remote_lock(self, path: str, timeout: float) -> AsyncIterator[None]:
+        """Hold flock(1) on `path` on the server; see SSHRunner.remote_lock."""
+        if self._sync:
+            held = self._sync.remote_lock(path, timeout)
+            await asyncio.to_thread(held.__enter__)
+            try:
+                yield
+            finally:
+                await asyncio.to_thread(held.__exit__, None, None, None)
+            return
+        started = time.monotonic()
+        process = await self.conn.create_process(_flock_command(path, timeout))
+        try:
+            ready = (await process.stdout.readline()).strip()
+            if ready != "locked":
+                await process.wait()
+                raise RemoteCommandError(f"Could not lock {path} on the server (exit {process.exit_status}).")
+            self._record(f"flock {path}", time.monotonic() - started, 0, len(ready), 0)
+            yield
+        finally:
+            process.close()
+
+
+@dataclass
+class _Pooled:
+    runner: Any
+    loop: asyncio.AbstractEventLoop
+    users: int = 0
+    last_used: float = field(default_factory=time.monotonic)
+    expiry: Optional[asyncio.TimerHandle] = None
+
+
+class AsyncSSHPool:
+    """Keeps connected runners open between requests, one per server and credentials.
+
+    Concurrent users of the same server share one runner (asyncssh multiplexes their
+    commands as channels on one connection). A runner is closed once it has been idle for
+    `idle` seconds, when it fails with a connection error, or on `close`. Entries are tied
+    to the event loop that created them and are dropped when used from another loop.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[SSHConfig], Any],
+        idle: float = 60.0,
+        max_size: int = 64,
+    ) -> None:
+        self.factory = factory
+        self.idle = idle
+        self.max_size = max_size
+        self._entries: dict[str, _Pooled] = {}
+        self._connecting: dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def key(config: SSHConfig) -> str:
+        auth = [config.user, config.password, config.key_path, config.key_content]
+        digest = hashlib.sha256(repr(auth).encode("utf-8")).hexdigest()[:16]
+        return f"{config.host}:{config.port}:{digest}"
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @contextlib.asynccontextmanager
+    async def connection(self, config: SSHConfig) -> AsyncIterator[Any]:
+        key = self.key(config)
+        entry = await self._checkout(key, config)
+        try:
+            yield entry.runner
+        except RemoteCommandError:
+            raise  # the command failed, the connection is fine
+        except Exception:
+            self._discard(key, entry)  # possibly a dead connection; the next user reconnects
+            raise
+        finally:
+            entry.users -= 1
+            entry.last_used = time.monotonic()
+            if entry.users == 0 and self._entries.get(key) is entry:
+                entry.expiry = entry.loop.call_later(self.idle, self._expire, key, entry)
+
+    async def _checkout(self, key: str, config: SSHConfig) -> _Pooled:
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = self._entries.get(key)
+            if entry is not None and entry.loop is not loop:
+                del self._entries[key]  # created by an event loop that is gone
+                entry = None
+            if entry is not None:
+                if entry.expiry:
+                    entry.expiry.cancel()
+                    entry.expiry = None
+                entry.users += 1
+                return entry
+            pending = self._connecting.get(key)
+            if pending is not None and pending.get_loop() is loop:
+                # Another request is already connecting to this server; share its result.
+                await asyncio.shield(pending)
+                continue
+            break
+        pending = self._connecting[key] = loop.create_future()
+        try:
+            runner = self.factory(config)
+            await runner.connect()
+            entry = _Pooled(runner=runner, loop=loop, users=1)
+            self._evict_idle()
+            self._entries[key] = entry
+            pending.set_result(None)
+            return entry
+        except BaseException:
+            pending.set_result(None)  # waiters retry and surface their own error
+            raise
+        finally:
+            self._connecting.pop(key, None)
+
+    def _evict_idle(self) -> None:
+        idle = sorted(
+            ((k, e) for k, e in self._entries.items() if e.users == 0),
+            key=lambda item: item[1].last_used,
+        )
+        while len(self._entries) >= self.max_size and idle:
+            self._discard(*idle.pop(0))
+
+    def _expire(self, key: str, entry: _Pooled) -> None:
+        if entry.users == 0:
+            self._discard(key, entry)
+
+    def _discard(self, key: str, entry: _Pooled) -> None:
+        if self._entries.get(key) is entry:
+            del self._entries[key]
+        if entry.expiry:
+            entry.expiry.cancel()
+        entry.loop.create_task(entry.runner.close())
+
+    async def close(self) -> None:
+        entries, self._entries = list(self._entries.values()), {}
+        for entry in entries:
+            if entry.expiry:
+                entry.expiry.cancel()
+        await asyncio.gather(*(entry.runner.close() for entry in entries), return_exceptions=True)
+
+
+async def arun_ops(ssh, ops: Ops[T]) -> T:
+    """Async counterpart of core.run_ops; a yielded list of commands runs concurrently."""
+    result: Any = None
+    error: Optional[BaseException] = None
+    while True:
+        try:
+            request = ops.throw(error) if error is not None else ops.send(result)
+        except StopIteration as stop:
+            return stop.value
+        error = None
+        try:
+            if isinstance(request, list):
+                result = list(
+                    await asyncio.gather(
+                        *(ssh.run(cmd.command, sudo=cmd.sudo, check=cmd.check, pty=cmd.pty) for cmd in request)
+                    )
+                )
+            else:
+                result = await ssh.run(request.command, sudo=request.sudo, check=request.check, pty=request.pty)
+        except Exception as exc:  # noqa: BLE001 - handed back to the operation
+            error = exc
+
+
+class _BlockingBridge:
+    """Blocking SSHRunner facade over an AsyncSSHRunner, for use from worker threads."""
+
+    def __init__(self, inner: AsyncSSHRunner) -> None:
+        self.inner = inner
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._local = threading.local()
+
+    @property
+    def config(self) -> SSHConfig:
+        return self.inner.config
+
+    @property
+    def phase(self) -> Optional[str]:
+        return getattr(self._local, "phase", None)
+
+    @phase.setter
+    def phase(self, value: Optional[str]) -> None:
+        self._local.phase = value
+
+    def _call(self, factory: Callable[[], Any]) -> Any:
+        if self.loop is None:
+            raise RuntimeError("Blocking provisioner calls must go through AsyncWireGuardProvisioner.")
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            raise RuntimeError("Blocking SSH call on the event loop thread would deadlock.")
+        phase = self.phase
+
+        async def call() -> Any:
+            self.inner.phase = phase
+            return await factory()
+
+        return asyncio.run_coroutine_threadsafe(call(), self.loop).result()
+
+    def run(
+        self, command: str, sudo: bool = False, check: bool = True, pty: bool = True, attempt: int = 0
+    ) -> str:
+        return self._call(lambda: self.inner.run(command, sudo=sudo, check=check, pty=pty, attempt=attempt))
+
+    def put(self, local_path: str, remote_path: str) -> None:
+        self._call(lambda: self.inner.put(local_path, remote_path))
+
+    def get(self, remote_path: str, local_path: str) -> None:
+        self._call(lambda: self.inner.get(remote_path, local_path))
+
+    @contextlib.contextmanager
+    def remote_lock(self, path: str, timeout: float) -> Iterator[None]:
+        held = self.inner.remote_lock(path, timeout)
+        self._call(held.__aenter__)
+        try:
+            yield
+        finally:
+            self._call(lambda: held.__aexit__(None, None, None))
+
+
+class AsyncWireGuardProvisioner:
+    """Async facade over WireGuardProvisioner for FastAPI and python-telegram-bot.
+
+    Read-only operations (list_clients, status, find_client, export_client,
+    export_all_clients, export_client_config, post_check, collect_diagnostics, plan) run
+    natively on the event loop. Multi-step mutating operations reuse the blocking
+    implementation in a worker thread whose SSH calls are sent back to the loop, so
+    there is exactly one implementation of each operation.
+    """
+
+    def __init__(self, ssh: AsyncSSHRunner, **options: Any) -> None:
+        self.ssh = ssh
+        self._bridge = _BlockingBridge(ssh)
+        self.sync = WireGuardProvisioner(self._bridge, **options)
+
+    async def _drive(self, ops: Ops[T]) -> T:
+        return await arun_ops(self.ssh, ops)
+
+    async def _blocking(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        self._bridge.loop = asyncio.get_running_loop()
+        return await asyncio.to_thread(fn, *args, **kwargs)
+
+    async def list_clients(self) -> list[dict]:
+        return await self._drive(self.sync._list_clients_ops())
+
+    async def status(self) -> dict:
+        return await self._drive(self.sync._status_ops())
+
+    async def export_client(self, client_name: str) -> dict:
+        return await self._drive(self.sync._export_client_ops(client_name))
+
+    async def find_client(
+        self, name: Optional[str] = None, public_key: Optional[str] = None, ip: Optional[str] = None
+    ) -> Optional[dict]:
+        return await self._drive(self.sync._find_client_ops(name, public_key, ip))
+
+    async def export_all_clients(self) -> list[dict]:
+        return await self._drive(self.sync._export_all_clients_ops())
+
+    async def export_client_config(self) -> str:
+        return await self._drive(self.sync._export_client_config_ops())
+
+    async def post_check(self) -> list[dict]:
+        self.ssh.phase = "Post-checks"
+        return await self._drive(self.sync._post_check_ops())
+
+    async def pre_check(self) -> list[dict]:
+        return await self._blocking(self.sync.pre_check)
+
+    async def plan_provision(self) -> list[dict]:
+        return await self._blocking(self.sync.plan_provision)
+
+    async def provision(self, max_workers: int = 4) -> dict:
+        return await self._blocking(self.sync.provision, max_workers)
+
+    async def add_client(self, client_name: Optional[str] = None, client_ip: Optional[str] = None) -> dict:
+        return await self._blocking(self.sync.add_client, client_name, client_ip)
+
+    async def remove_client(self, client_name: str) -> bool:
+        return await self._blocking(self.sync.remove_client, client_name)
+
+    async def rotate_client(self, client_name: str) -> dict:
+        return await self._blocking(self.sync.rotate_client, client_name)
+
+    async def rollback_last_backup(self) -> Optional[str]:
+        return await self._blocking(self.sync.rollback_last_backup)
+
+    async def list_backups(self) -> list[dict]:
+        return await self._blocking(self.sync.list_backups)
+
+    async def restore_backup(self, backup_id: str) -> bool:
+        return await self._blocking(self.sync.restore_backup, backup_id)
+
+    async def plan(self, operation: str, **kwargs: Any) -> ChangePlan:
+        return await self._drive(self.sync._plan_ops(operation, **kwargs))
+
+    async def collect_diagnostics(self, sections: Optional[list[str]] = None, **options: Any) -> list[dict]:
+        return await self._drive(self.sync._diagnostics_ops(sections, **options))
+
+    async def get_system_report(self, sections: Optional[list[str]] = None, **options: Any) -> str:
+        return self.sync.format_report(await self.collect_diagnostics(sections, **options))
+
+    async def repair_network(self) -> list[str]:
+        return await self._blocking(self.sync.repair_network)
@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+import functools
+import threading
+import time
+import uuid
+from typing import TYPE_CHECKING, Callable, ContextManager, Iterable, Optional
+
+from vpn_wizard.backend import SQLiteBackend
+
+if TYPE_CHECKING:
+    from vpn_wizard.core import SSHConfig, WireGuardProvisioner
+
+
+@dataclass
+class _Batch:
+    prov: "WireGuardProvisioner"
+    first: float
+    interfaces: set[str] = field(default_factory=set)
+    future: Future = field(default_factory=Future)
+    timer: Optional[threading.Timer] = None
+
+
+class ApplyQueue:
+    """Write-behind application of peer changes: one backup and one rebuild per burst.
+
+    With an apply queue, add_client and remove_client write the client files at once, so
+    the config is returned immediately and IP allocation already sees the new peer. Only
+    the interface rebuild and restart are scheduled. Changes to the same host are applied
+    together once `delay` seconds pass without another change, or after `max_delay`
+    seconds under a steady stream. Each `schedule` returns a Future that resolves when
+    the change is live, or fails with the rebuild's exception.
+
+    `opener` connects a fresh runner for the flush (the API closes its connection right
+    after the request). Without it the scheduling provisioner's runner is reused, which
+    must then stay open until `flush` returns.
+
+    Callers usually return before the rebuild runs, so nobody may be waiting on the
+    Future. A failed rebuild is therefore also passed to `log` and recorded in `backend`
+    per host (see `failure`) until those interfaces apply cleanly, e.g. via `reapply`.
+    Scheduled batches are recorded there too, per queue, until they finish: a batch
+    another queue left behind for LOST_AFTER seconds past its deadline (its process
+    exited before the flush) is reported by `failure` and picked up by `reapply` or the
+    next batch for that host.
+    """
+
+    LOST_AFTER = 120.0
+
+    def __init__(
+        self,
+        delay: float = 2.0,
+        max_delay: float = 10.0,
+        opener: Optional[Callable[["SSHConfig"], ContextManager]] = None,
+        backend: Optional[SQLiteBackend] = None,
+        log: Optional[Callable[[str], None]] = None,
+    ) -> None:
+        self.delay = delay
+        self.max_delay = max_delay
+        self.opener = opener
+        self.backend = backend if backend is not None else SQLiteBackend()
+        self.log = log or (lambda _: None)
+        self._batches: dict[str, _Batch] = {}
+        self._lock = threading.Lock()
+        self._records = threading.Lock()  # read-modify-write of backend records
+        self._owner = uuid.uuid4().hex
+
+    def schedule(self, prov: "WireGuardProvisioner", interface: str) -> Future:
+        key = prov.host_key()
+        with self._lock:
+            batch = self._batches.get(key)
+            changed = batch is None or interface not in batch.interfaces
+            if batch is None:
+                batch = self._batches[key] = _Batch(prov=prov, first=time.monotonic())
+                batch.future.add_done_callback(functools.partial(self._finished, key, batch))
+                batch.interfaces.update(self._adopt_lost(key))
+            batch.prov = prov
+            batch.interfaces.add(interface)
+            if changed:
+                self._mark_pending(key, batch.interfaces)
+            if batch.timer:
+                batch.timer.cancel()
+            wait = min(self.delay, max(0.0, batch.first + self.max_delay - time.monotonic()))
+            batch.timer = threading.Timer(wait, self._flush_key, args=(key, batch))
+            batch.timer.daemon = True
+            batch.timer.start()
+            return batch.future
+
+    def pending(self) -> dict[str, list[str]]:
+        with self._lock:
+            return {key: sorted(batch.interfaces) for key, batch in self._batches.items()}
+
+    def flush(self, key: Optional[str] = None) -> None:
+        """Apply pending changes now (for one host key, or all) and wait until they are live."""
+        with self._lock:
+            batches = [(k, b) for k, b in self._batches.items() if key is None or k == key]
+        for batch_key, batch in batches:
+            self._flush_key(batch_key, batch)
+            batch.future.result()
+
+    def _flush_key(self, key: str, batch: _Batch) -> None:
+        with self._lock:
+            if self._batches.get(key) is not batch:
+                return  # already flushed by the timer or an explicit flush
+            del self._batches[key]
+            if batch.timer:
+                batch.timer.cancel()
+        try:
+            if self.opener is None:
+                batch.prov.apply_peer_changes(batch.interfaces)
+            else:
+                with self.opener(batch.prov.ssh.config) as ssh:
+                    batch.prov.clone(ssh).apply_peer_changes(batch.interfaces)
+        except BaseException as exc:  # noqa: BLE001 - delivered through the future
+            batch.future.set_exception(exc)
+            return
+        batch.future.set_result(sorted(batch.interfaces))
+
+    def failure(self, key: str) -> Optional[dict]:
+        """The unapplied changes of host `key`: {"error", "interfaces", "at"}, or None.
+
+        Covers failed rebuilds and batches a queue left behind (see LOST_AFTER).
+        """
+        failed = self.backend.get(self._failure_key(key))
+        lost = self._lost(key)
+        if not lost:
+            return failed
+        if not failed:
+            return {
+                "error": "the process that queued them exited before applying them",
+                "interfaces": sorted(set().union(*lost.values())),
+                "at": time.time(),
+            }
+        return dict(failed, interfaces=sorted(set(failed["interfaces"]).union(*lost.values())))
+
+    def reapply(self, prov: "WireGuardProvisioner") -> list[str]:
+        """Rebuild the interfaces whose changes were not applied on `prov`'s host; returns them."""
+        key = prov.host_key()
+        failed = self.failure(key)
+        if not failed:
+            return []
+        lost = self._lost(key)
+        interfaces = failed["interfaces"]
+        try:
+            prov.apply_peer_changes(interfaces)
+        except Exception as exc:
+            self._record_failure(key, interfaces, exc)
+            self._forget_pending(key, lost)
+            raise
+        self._clear_failure(key, interfaces)
+        self._forget_pending(key, lost)
+        return interfaces
+
+    @staticmethod
+    def _failure_key(key: str) -> str:
+        return f"apply-failed:{key}"
+
+    @staticmethod
+    def _pending_key(key: str) -> str:
+        return f"apply-pending:{key}"
+
+    def _finished(self, key: str, batch: _Batch, future: Future) -> None:
+        exc = future.exception()
+        if exc is None:
+            self._clear_failure(key, batch.interfaces)
+        else:
+            self._record_failure(key, batch.interfaces, exc)
+        with self._lock:
+            current = self._batches.get(key)  # a newer batch may already be pending
+            if current is not None:
+                self._mark_pending(key, current.interfaces)
+            else:
+                self._forget_pending(key, {self._owner: set(batch.interfaces)})
+
+    def _record_failure(self, key: str, interfaces: Iterable[str], exc: BaseException) -> None:
+        with self._records:
+            previous = self.backend.get(self._failure_key(key)) or {}
+            failed = sorted(set(previous.get("interfaces", [])) | set(interfaces))
+            self.backend.set(self._failure_key(key), {"error": str(exc), "interfaces": failed, "at": time.time()})
+        self.log(f"Peer changes on {key} ({', '.join(failed)}) were not applied: {exc}")
+
+    def _clear_failure(self, key: str, interfaces: Iterable[str]) -> None:
+        with self._records:
+            previous = self.backend.get(self._failure_key(key))
+            if not previous:
+                return
+            remaining = sorted(set(previous["interfaces"]) - set(interfaces))
+            if remaining:
+                self.backend.set(self._failure_key(key), dict(previous, interfaces=remaining))
+            else:
+                self.backend.delete(self._failure_key(key))
+
+    def _mark_pending(self, key: str, interfaces: Iterable[str]) -> None:
+        # One entry per queue, so each only clears its own and can tell others' apart.
+        with self._records:
+            pending = self.backend.get(self._pending_key(key)) or {}
+            pending[self._owner] = {"interfaces": sorted(interfaces), "deadline": time.time() + self.max_delay}
+            self.backend.set(self._pending_key(key), pending)
+
+    def _lost(self, key: str) -> dict[str, set[str]]:
+        """Other queues' pending entries for `key` that are long past their deadline."""
+        pending = self.backend.get(self._pending_key(key)) or {}
+        cutoff = time.time() - self.LOST_AFTER
+        return {
+            owner: set(entry["interfaces"])
+            for owner, entry in pending.items()
+            if owner != self._owner and entry["deadline"] < cutoff
+        }
+
+    def _adopt_lost(self, key: str) -> set[str]:
+        # Called for a new batch: it rebuilds the lost interfaces along with its own.
+        lost = self._lost(key)
+        self._forget_pending(key, lost)
+        return set().union(*lost.values())
+
+    def _forget_pending(self, key: str, entries: dict[str, set[str]]) -> None:
+        if not entries:
+            return
+        with self._records:
+            pending = self.backend.get(self._pending_key(key)) or {}
+            for owner, interfaces in entries.items():
+                entry = pending.get(owner)
+                if entry is None:
+                    continue
+                remaining = sorted(set(entry["interfaces"]) - interfaces)
+                if remaining:
+                    pending[owner] = dict(entry, interfaces=remaining)
+                else:
+                    del pending[owner]
+            if pending:
+                self.backend.set(self._pending_key(key), pending)
+            else:
+                self.backend.delete(self._pending_key(key))
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import tempfile
+import time
+from typing import Optional, Union
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactCache:
+    """Local store of prebuilt AmneziaWG packages, one directory per target system.
+
+    Entries are keyed by distro, release, kernel and architecture, because the module
+    package is only valid for the exact kernel it was built against. Each entry holds the
+    .deb files plus a manifest with their checksums; a corrupt or partial entry is treated
+    as a miss, so the provisioner falls back to the DKMS build.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, root: Optional[Union[str, Path]] = None) -> None:
+        default = Path.home() / ".cache" / "vpn-wizard" / "artifacts"
+        self.root = Path(root or os.getenv("VPNW_ARTIFACT_DIR") or default)
+
+    @staticmethod
+    def key(distro: str, version: str, kernel: str, arch: str) -> str:
+        parts = [distro, version, kernel, arch]
+        return "_".join(re.sub(r"[^A-Za-z0-9.+-]", "-", part.strip() or "unknown") for part in parts)
+
+    def lookup(self, key: str) -> Optional[list[Path]]:
+        entry = self.root / key
+        try:
+            manifest = json.loads((entry / self.MANIFEST).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        files = []
+        for item in manifest.get("files", []):
+            path = entry / item["name"]
+            if not path.is_file() or _sha256(path) != item["sha256"]:
+                return None
+            files.append(path)
+        return files or None
+
+    def store(self, key: str, files: list[Path], meta: Optional[dict] = None) -> Path:
+        """Copy `files` into the entry for `key`, replacing any previous entry."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        staging = Path(tempfile.mkdtemp(prefix=".staging-", dir=self.root))
+        try:
+            listed = []
+            for src in files:
+                dest = staging / Path(src).name
+                shutil.copyfile(src, dest)
+                listed.append({"name": dest.name, "sha256": _sha256(dest), "size": dest.stat().st_size})
+            manifest = {"key": key, "created": int(time.time()), "files": listed, **(meta or {})}
+            (staging / self.MANIFEST).write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+            entry = self.root / key
+            if entry.exists():
+                shutil.rmtree(entry)
+            os.replace(staging, entry)
+            return entry
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+    def entries(self) -> list[dict]:
+        if not self.root.is_dir():
+            return []
+        result = []
+        for manifest_path in sorted(self.root.glob(f"*/{self.MANIFEST}")):
+            try:
+                result.append(json.loads(manifest_path.read_text(encoding="utf-8")))
+            except (OSError, ValueError):
+                continue
+        return result
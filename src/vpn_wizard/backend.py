@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Iterator, Optional
+import uuid
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL);
+CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL);
+"""
+
+
+class SQLiteBackend:
+    """Process-shared state for API workers: jobs, a TTL key/value store and named locks.
+
+    One SQLite file in WAL mode lets several uvicorn workers (and the bot in combined
+    mode) see the same jobs and caches: readers never block the writer and each write is
+    a short transaction. The default ":memory:" database keeps everything in-process,
+    which is what a single worker and the tests use. Values are stored as JSON.
+    """
+
+    def __init__(self, path: str = ":memory:", busy_timeout: float = 5.0) -> None:
+        self.path = path
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # BEGIN IMMEDIATE takes the write lock up front, so read-modify-write is atomic
+        # across processes instead of failing with SQLITE_BUSY on upgrade.
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _query(self, sql: str, params: tuple = ()) -> list[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    # Jobs
+
+    def job_put(self, job_id: str, data: dict) -> None:
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, data, updated) VALUES (?, ?, ?)",
+                (job_id, json.dumps(data), time.time()),
+            )
+
+    def job_get(self, job_id: str) -> Optional[dict]:
+        rows = self._query("SELECT data FROM jobs WHERE id = ?", (job_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def job_update(self, job_id: str, change: Callable[[dict], None]) -> bool:
+        """Apply `change` to the stored job in one transaction; False if there is no such job."""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if not row:
+                return False
+            data = json.loads(row[0])
+            change(data)
+            conn.execute(
+                "UPDATE jobs SET data = ?, updated = ? WHERE id = ?",
+                (json.dumps(data), time.time(), job_id),
+            )
+        return True
+
+    def job_purge(self, max_age: float) -> int:
+        with self._transaction() as conn:
+            return conn.execute("DELETE FROM jobs WHERE updated < ?", (time.time() - max_age,)).rowcount
+
+    # Key/value cache
+
+    def get(self, key: str) -> Any:
+        rows = self._query("SELECT value, expires FROM kv WHERE key = ?", (key,))
+        if not rows:
+            return None
+        value, expires = rows[0]
+        if expires is not None and expires <= time.time():
+            return None
+        return json.loads(value)
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        expires = time.time() + ttl if ttl is not None else None
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires),
+            )
+            conn.execute("DELETE FROM kv WHERE expires IS NOT NULL AND expires <= ?", (time.time(),))
+
+    def delete(self, key: str) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    # Locks
+
+    def try_acquire(self, name: str, owner: str, ttl: float) -> bool:
+        """Take lock `name` for `owner` unless someone else holds an unexpired lease."""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM locks WHERE name = ? AND expires <= ?", (name, now))
+            row = conn.execute("SELECT owner FROM locks WHERE name = ?", (name,)).fetchone()
+            if row and row[0] != owner:
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO locks (name, owner, expires) VALUES (?, ?, ?)",
+                (name, owner, now + ttl),
+            )
+        return True
+
+    def release(self, name: str, owner: str) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+
+    @contextlib.contextmanager
+    def lock(
+        self,
+        name: str,
+        ttl: float = 900.0,
+        timeout: Optional[float] = None,
+        poll: float = 0.2,
+    ) -> Iterator[str]:
+        """Hold lock `name` across processes; the lease expires after `ttl` if the holder dies."""
+        owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.try_acquire(name, owner, ttl):
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"Lock {name} is held by another worker.")
+            time.sleep(poll)
+        try:
+            yield owner
+        finally:
+            self.release(name, owner)
+
+
+_DEFAULT: Optional[SQLiteBackend] = None
+_DEFAULT_LOCK = threading.Lock()
+
+
+def default_state_path() -> str:
+    return str(Path.home() / ".cache" / "vpn-wizard" / "state.db")
+
+
+def get_backend() -> SQLiteBackend:
+    """The process-wide backend: the VPNW_STATE_DB file if set, otherwise in-memory."""
+    global _DEFAULT
+    with _DEFAULT_LOCK:
+        if _DEFAULT is None:
+            _DEFAULT = SQLiteBackend(os.getenv("VPNW_STATE_DB") or ":memory:")
+        return _DEFAULT
+
+
+def shared_backend() -> Optional[SQLiteBackend]:
+    """The backend when it is shared between processes (VPNW_STATE_DB set), else None."""
+    return get_backend() if os.getenv("VPNW_STATE_DB") else None
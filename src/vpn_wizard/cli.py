@@ -5,12 +5,19 @@ from typing import Optional
 
 import typer
 
-from vpn_wizard.core import SSHConfig, SSHRunner, WireGuardProvisioner
+from vpn_wizard.artifacts import ArtifactCache
+from vpn_wizard.core import CommandTimings, SSHConfig, SSHRunner, WireGuardProvisioner
+from vpn_wizard.export import iter_clients_zip
+from vpn_wizard.plan import ChangePlan
 from vpn_wizard.qr import save_qr_png
 
 app = typer.Typer(add_completion=False)
 client_app = typer.Typer(add_completion=False)
 app.add_typer(client_app, name="client")
+cache_app = typer.Typer(add_completion=False)
+app.add_typer(cache_app, name="cache")
+backup_app = typer.Typer(add_completion=False)
+app.add_typer(backup_app, name="backup")
 
 
 def _build_provisioner(
@@ -29,6 +36,7 @@ def _build_provisioner(
     tune: bool,
     quiet: bool,
     protocol: str = "amneziawg",
+    timings: Optional[CommandTimings] = None,
 ) -> WireGuardProvisioner:
     def log(msg: str) -> None:
         if not quiet:
@@ -41,7 +49,7 @@ def _build_provisioner(
         password=password,
         key_path=key,
     )
-    ssh = SSHRunner(cfg, logger=log)
+    ssh = SSHRunner(cfg, logger=log, on_command=timings)
     ssh.connect()
     normalized_mtu = None if mtu is None or mtu <= 0 else mtu
     effective_auto_mtu = auto_mtu if mtu is None else False
@@ -66,6 +74,23 @@ def _print_checks(checks: list[dict]) -> None:
         )
 
 
+def _print_timings(timings: CommandTimings) -> None:
+    for entry in timings.breakdown():
+        typer.echo(
+            f"timing {entry['phase']}: {entry['seconds']:.1f}s, {entry['commands']} commands"
+            f" (slowest {entry['slowest_seconds']:.1f}s: {entry['slowest']})"
+        )
+
+
+def _print_plan(plan: ChangePlan) -> None:
+    for note in plan.notes:
+        typer.echo(f"note: {note}")
+    for command in plan.commands:
+        typer.echo(f"would run: {command}")
+    diff = plan.diff()
+    typer.echo(diff.rstrip("\n") if diff else "No file changes.")
+
+
 def _has_critical_fail(checks: list[dict]) -> bool:
     critical = {"os_supported", "sudo", "port_available"}
     return any(item.get("name") in critical and not item.get("ok") for item in checks)
@@ -89,8 +114,11 @@ def provision(
     check: bool = typer.Option(True, "--check/--no-check", help="Post-provision checks"),
     precheck: bool = typer.Option(True, "--precheck/--no-precheck", help="Pre-provision checks"),
     protocol: str = typer.Option("amneziawg", help="Protocol (amneziawg or wireguard)"),
+    show_timings: bool = typer.Option(False, "--timings", help="Print per-phase command timings"),
+    plan: bool = typer.Option(False, "--plan", help="Show which steps would run and exit"),
     quiet: bool = typer.Option(False, help="Less output"),
 ) -> None:
+    timings = CommandTimings() if show_timings else None
     prov = _build_provisioner(
         host,
         user,
@@ -107,8 +135,15 @@ def provision(
         tune,
         quiet,
         protocol,
+        timings=timings,
     )
     try:
+        if plan:
+            for item in prov.plan_provision():
+                typer.echo(f"plan {item['step']}: {item['action']} ({item['reason']})")
+                if item["action"] == "run" and item["diff"]:
+                    typer.echo(item["diff"], nl=False)
+            return
         if precheck:
             checks = prov.pre_check()
             _print_checks(checks)
@@ -124,6 +159,8 @@ def provision(
         typer.echo("Provisioned.")
     finally:
         prov.ssh.close()
+        if timings:
+            _print_timings(timings)
 
 
 @app.command()
@@ -286,6 +323,7 @@ def client_add(
     client_ip: Optional[str] = typer.Option(None, help="Client IP/CIDR"),
     out: Optional[Path] = typer.Option(None, help="Output config path"),
     qr: Optional[Path] = typer.Option(None, help="Output QR PNG path"),
+    plan: bool = typer.Option(False, help="Show the diff and commands without changing the server"),
     quiet: bool = typer.Option(False, help="Less output"),
 ) -> None:
     prov = _build_provisioner(
@@ -305,6 +343,9 @@ def client_add(
         quiet,
     )
     try:
+        if plan:
+            _print_plan(prov.plan("add_client", client_name=name, client_ip=client_ip))
+            return
         result = prov.add_client(client_name=name, client_ip=client_ip)
     finally:
         prov.ssh.close()
@@ -320,6 +361,49 @@ def client_add(
         typer.echo(f"Wrote {qr}")
 
 
+@client_app.command("export-all")
+def client_export_all(
+    host: str = typer.Option(..., help="Server hostname or IP"),
+    user: str = typer.Option(..., help="SSH username"),
+    password: Optional[str] = typer.Option(None, help="SSH password"),
+    key: Optional[str] = typer.Option(None, help="SSH private key path"),
+    port: int = typer.Option(22, help="SSH port"),
+    out: Optional[Path] = typer.Option(None, help="Output ZIP path"),
+    qr: list[str] = typer.Option(["png"], help="QR formats to include (png, svg); repeatable"),
+    quiet: bool = typer.Option(False, help="Less output"),
+) -> None:
+    prov = _build_provisioner(
+        host,
+        user,
+        password,
+        key,
+        port,
+        "client1",
+        3478,
+        "10.10.0.2/32",
+        "10.10.0.1/24",
+        "1.1.1.1, 1.0.0.1",
+        None,
+        True,
+        True,
+        quiet,
+    )
+    try:
+        clients = prov.export_all_clients()
+    finally:
+        prov.ssh.close()
+
+    out_path = out or Path(f"vpn-clients-{host}.zip")
+    try:
+        with out_path.open("wb") as fp:
+            for chunk in iter_clients_zip(clients, qr):
+                fp.write(chunk)
+    except ValueError as exc:
+        out_path.unlink(missing_ok=True)
+        raise typer.BadParameter(str(exc), param_hint="--qr") from exc
+    typer.echo(f"Wrote {out_path} ({len(clients)} clients)")
+
+
 @client_app.command("remove")
 def client_remove(
     host: str = typer.Option(..., help="Server hostname or IP"),
@@ -328,6 +412,7 @@ def client_remove(
     key: Optional[str] = typer.Option(None, help="SSH private key path"),
     port: int = typer.Option(22, help="SSH port"),
     name: str = typer.Option(..., help="Client name"),
+    plan: bool = typer.Option(False, help="Show the diff and commands without changing the server"),
     quiet: bool = typer.Option(False, help="Less output"),
 ) -> None:
     prov = _build_provisioner(
@@ -347,6 +432,9 @@ def client_remove(
         quiet,
     )
     try:
+        if plan:
+            _print_plan(prov.plan("remove_client", client_name=name))
+            return
         ok = prov.remove_client(name)
     finally:
         prov.ssh.close()
@@ -363,6 +451,7 @@ def client_rotate(
     name: str = typer.Option(..., help="Client name"),
     out: Optional[Path] = typer.Option(None, help="Output config path"),
     qr: Optional[Path] = typer.Option(None, help="Output QR PNG path"),
+    plan: bool = typer.Option(False, help="Show the diff and commands without changing the server"),
     quiet: bool = typer.Option(False, help="Less output"),
 ) -> None:
     prov = _build_provisioner(
@@ -382,6 +471,9 @@ def client_rotate(
         quiet,
     )
     try:
+        if plan:
+            _print_plan(prov.plan("rotate_client", client_name=name))
+            return
         result = prov.rotate_client(name)
     finally:
         prov.ssh.close()
@@ -396,6 +488,126 @@ def client_rotate(
         typer.echo(f"Wrote {qr}")
 
 
+@backup_app.command("list")
+def backup_list(
+    host: str = typer.Option(..., help="Server hostname or IP"),
+    user: str = typer.Option(..., help="SSH username"),
+    password: Optional[str] = typer.Option(None, help="SSH password"),
+    key: Optional[str] = typer.Option(None, help="SSH private key path"),
+    port: int = typer.Option(22, help="SSH port"),
+    quiet: bool = typer.Option(False, help="Less output"),
+) -> None:
+    prov = _build_provisioner(
+        host,
+        user,
+        password,
+        key,
+        port,
+        "client1",
+        3478,
+        "10.10.0.2/32",
+        "10.10.0.1/24",
+        "1.1.1.1, 1.0.0.1",
+        None,
+        True,
+        True,
+        quiet,
+    )
+    try:
+        backups = prov.list_backups()
+    finally:
+        prov.ssh.close()
+    if not backups:
+        typer.echo("No backups found.")
+    for item in backups:
+        marker = " (current)" if item["current"] else ""
+        typer.echo(f"{item['id']} {item['label']} {item['size']}B{marker}")
+
+
+@backup_app.command("restore")
+def backup_restore(
+    backup_id: str = typer.Argument(..., help="Backup id from `vpnw backup list`"),
+    host: str = typer.Option(..., help="Server hostname or IP"),
+    user: str = typer.Option(..., help="SSH username"),
+    password: Optional[str] = typer.Option(None, help="SSH password"),
+    key: Optional[str] = typer.Option(None, help="SSH private key path"),
+    port: int = typer.Option(22, help="SSH port"),
+    quiet: bool = typer.Option(False, help="Less output"),
+) -> None:
+    prov = _build_provisioner(
+        host,
+        user,
+        password,
+        key,
+        port,
+        "client1",
+        3478,
+        "10.10.0.2/32",
+        "10.10.0.1/24",
+        "1.1.1.1, 1.0.0.1",
+        None,
+        True,
+        True,
+        quiet,
+    )
+    try:
+        restored = prov.restore_backup(backup_id)
+    finally:
+        prov.ssh.close()
+    if not restored:
+        typer.echo("Backup not found.")
+        raise typer.Exit(code=1)
+    typer.echo(f"Restored {backup_id}")
+
+
+@cache_app.command("populate")
+def cache_populate(
+    host: str = typer.Option(..., help="Server with a working AmneziaWG DKMS build"),
+    user: str = typer.Option(..., help="SSH username"),
+    password: Optional[str] = typer.Option(None, help="SSH password"),
+    key: Optional[str] = typer.Option(None, help="SSH private key path"),
+    port: int = typer.Option(22, help="SSH port"),
+    cache_dir: Optional[Path] = typer.Option(None, help="Artifact cache directory"),
+    quiet: bool = typer.Option(False, help="Less output"),
+) -> None:
+    prov = _build_provisioner(
+        host,
+        user,
+        password,
+        key,
+        port,
+        "client1",
+        3478,
+        "10.10.0.2/32",
+        "10.10.0.1/24",
+        "1.1.1.1, 1.0.0.1",
+        None,
+        True,
+        True,
+        quiet,
+    )
+    cache = ArtifactCache(cache_dir)
+    try:
+        cache_key, names = prov.collect_amneziawg_artifacts(cache)
+    finally:
+        prov.ssh.close()
+    typer.echo(f"Cached {', '.join(names)} as {cache_key} in {cache.root}")
+
+
+@cache_app.command("list")
+def cache_list(
+    cache_dir: Optional[Path] = typer.Option(None, help="Artifact cache directory"),
+) -> None:
+    cache = ArtifactCache(cache_dir)
+    entries = cache.entries()
+    if not entries:
+        typer.echo(f"No cached artifacts in {cache.root}")
+        return
+    for entry in entries:
+        names = ", ".join(item["name"] for item in entry.get("files", []))
+        typer.echo(f"{entry.get('key')}: {names}")
+
+
 def main() -> None:
     app()
 
@@ -1,14 +1,32 @@
 from __future__ import annotations
 
+import base64
+from collections import OrderedDict
+from concurrent.futures import Future
+import contextlib
 from dataclasses import dataclass
+import functools
+import gzip
+import hashlib
+import io
 import ipaddress
 import os
+from pathlib import Path
 import re
 import shlex
-from typing import Callable, Optional
+import tempfile
+import threading
+import time
+from typing import Any, Callable, ContextManager, Generator, Iterable, Iterator, Optional, TypeVar, Union
 
 import paramiko
 
+from vpn_wizard.apply import ApplyQueue
+from vpn_wizard.artifacts import ArtifactCache
+from vpn_wizard.backend import SQLiteBackend, get_backend, shared_backend
+from vpn_wizard.plan import ChangePlan, Snapshot, parse_snapshot, snapshot_script
+from vpn_wizard.steps import Step, StepGraph, StepResult
+
 
 class RemoteCommandError(RuntimeError):
     pass
@@ -22,13 +40,261 @@ class SSHConfig:
     password: Optional[str] = None
     key_path: Optional[str] = None
     timeout: int = 20
+    key_content: Optional[str] = None  # private key text; used instead of key_path when set
+
+    def private_key(self) -> Optional[paramiko.PKey]:
+        """The parsed `key_content`, shared with every other config holding the same key."""
+        if not self.key_content:
+            return None
+        return PRIVATE_KEYS.get("paramiko", self.key_content, load_private_key)
+
+
+def load_private_key(content: str, passphrase: Optional[str] = None) -> paramiko.PKey:
+    """Parse an OpenSSH/PEM private key from text, trying Ed25519, ECDSA and RSA."""
+    text = content.strip() + "\n"
+    last_error: Optional[Exception] = None
+    for key_class in (paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey):
+        try:
+            return key_class.from_private_key(io.StringIO(text), password=passphrase)
+        except paramiko.PasswordRequiredException:
+            raise
+        except (paramiko.SSHException, ValueError) as exc:
+            last_error = exc
+    raise paramiko.SSHException(f"Unsupported or invalid private key: {last_error}")
+
+
+class PrivateKeyCache:
+    """Parsed private keys keyed by a SHA-256 fingerprint of their text, bounded LRU.
+
+    API requests and bot sessions send the same key over and over; parsing it once per
+    process instead of once per connection skips the key-type probing and, for RSA, the
+    expensive validation. Only the fingerprint and the parsed object are kept, never the
+    text itself. Loaders are namespaced by `kind` so paramiko and asyncssh keys coexist.
+    """
+
+    def __init__(self, maxsize: int = 64) -> None:
+        self.maxsize = maxsize
+        self._items: OrderedDict[tuple[str, str], Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(content: str) -> str:
+        return hashlib.sha256(content.strip().encode("utf-8")).hexdigest()
+
+    def get(self, kind: str, content: str, loader: Callable[[str], Any]) -> Any:
+        key = (kind, self.fingerprint(content))
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+        # Parse outside the lock; a concurrent miss on the same key just parses twice.
+        value = loader(content)
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+PRIVATE_KEYS = PrivateKeyCache(int(os.getenv("VPNW_KEY_CACHE_SIZE", "64")))
+
+
+@dataclass
+class CommandStat:
+    command: str
+    phase: Optional[str]
+    duration: float
+    bytes_out: int
+    bytes_in: int
+    exit_code: int
+    retries: int = 0
+
+
+@dataclass
+class Command:
+    """A remote command yielded by provisioner operations written as generators.
+
+    Operations yield a Command (or a list of them, which async runners execute
+    concurrently) and receive the output back, so the same logic runs on the blocking
+    SSHRunner via `run_ops` and on AsyncSSHRunner via `vpn_wizard.aio.arun_ops`.
+    """
+
+    command: str
+    sudo: bool = False
+    check: bool = True
+    pty: bool = True
+
+
+T = TypeVar("T")
+Ops = Generator[Union[Command, list[Command]], Union[str, list[str], None], T]
 
 
-class SSHRunner:
-    def __init__(self, config: SSHConfig, logger: Optional[Callable[[str], None]] = None) -> None:
+def run_ops(ssh, ops: Ops[T]) -> T:
+    """Drive a generator operation with a blocking runner, one command at a time."""
+    result: Union[str, list[str], None] = None
+    error: Optional[BaseException] = None
+    while True:
+        try:
+            request = ops.throw(error) if error is not None else ops.send(result)
+        except StopIteration as stop:
+            return stop.value
+        error = None
+        try:
+            if isinstance(request, list):
+                result = [ssh.run(cmd.command, sudo=cmd.sudo, check=cmd.check, pty=cmd.pty) for cmd in request]
+            else:
+                result = ssh.run(request.command, sudo=request.sudo, check=request.check, pty=request.pty)
+        except Exception as exc:  # noqa: BLE001 - handed back to the operation
+            error = exc
+
+
+def _flock_command(path: str, timeout: float) -> str:
+    # Prints "locked" once flock holds the file, then blocks in cat until stdin closes.
+    return f"flock -w {int(timeout)} {shlex.quote(path)} -c 'echo locked; exec cat >/dev/null'"
+
+
+def _wrap_command(config: SSHConfig, command: str, sudo: bool) -> str:
+    wrapped = f"bash -lc {shlex.quote(command)}"
+    if sudo:
+        if config.password:
+            wrapped = f"sudo -S -p '' {wrapped}"
+        else:
+            wrapped = f"sudo {wrapped}"
+    return wrapped
+
+
+def _mask_secret(config: SSHConfig, text: str) -> str:
+    return text.replace(config.password, "***") if config.password else text
+
+
+def _command_error(command: str, status: int, out: str, err: str) -> RemoteCommandError:
+    msg = f"Command failed ({status}): {command}"
+    if err:
+        msg += f"\nSTDERR: {err}"
+    if out:
+        msg += f"\nSTDOUT: {out}"
+    return RemoteCommandError(msg)
+
+
+def _short_command(command: str, limit: int = 80) -> str:
+    first = command.strip().splitlines()[0] if command.strip() else ""
+    return first if len(first) <= limit else first[: limit - 3] + "..."
+
+
+class CommandTimings:
+    """Collects CommandStat records and summarizes them per provisioning phase."""
+
+    def __init__(self) -> None:
+        self.records: list[CommandStat] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, stat: CommandStat) -> None:
+        with self._lock:
+            self.records.append(stat)
+
+    def breakdown(self) -> list[dict]:
+        phases: dict[str, dict] = {}
+        with self._lock:
+            records = list(self.records)
+        for stat in records:
+            phase = stat.phase or "other"
+            entry = phases.setdefault(
+                phase,
+                {
+                    "phase": phase,
+                    "commands": 0,
+                    "seconds": 0.0,
+                    "bytes_in": 0,
+                    "bytes_out": 0,
+                    "retries": 0,
+                    "slowest": None,
+                    "slowest_seconds": 0.0,
+                },
+            )
+            entry["commands"] += 1
+            entry["seconds"] += stat.duration
+            entry["bytes_in"] += stat.bytes_in
+            entry["bytes_out"] += stat.bytes_out
+            entry["retries"] += stat.retries
+            if stat.duration >= entry["slowest_seconds"]:
+                entry["slowest"] = _short_command(stat.command)
+                entry["slowest_seconds"] = stat.duration
+        for entry in phases.values():
+            entry["seconds"] = round(entry["seconds"], 3)
+            entry["slowest_seconds"] = round(entry["slowest_seconds"], 3)
+        return list(phases.values())
+
+    def slowest(self, limit: int = 5) -> list[CommandStat]:
+        with self._lock:
+            records = list(self.records)
+        return sorted(records, key=lambda stat: stat.duration, reverse=True)[:limit]
+
+
+class _CommandRecorder:
+    """Shared slow-command logging and CommandStat reporting for SSH runners."""
+
+    phase: Optional[str]
+
+    def __init__(
+        self,
+        config: SSHConfig,
+        logger: Optional[Callable[[str], None]] = None,
+        on_command: Optional[Callable[[CommandStat], None]] = None,
+        slow_threshold: Optional[float] = 10.0,
+    ) -> None:
         self.config = config
-        self.client: Optional[paramiko.SSHClient] = None
         self.log = logger or (lambda _: None)
+        self.on_command = on_command
+        self.slow_threshold = slow_threshold
+
+    def _record(
+        self, command: str, duration: float, bytes_out: int, bytes_in: int, status: int, attempt: int = 0
+    ) -> None:
+        """Report one finished command; `attempt` > 0 marks a retry by the caller."""
+        if self.slow_threshold is not None and duration >= self.slow_threshold:
+            self.log(f"Slow command ({duration:.1f}s, phase: {self.phase or 'other'}): {_short_command(command)}")
+        if self.on_command:
+            self.on_command(
+                CommandStat(
+                    command=command,
+                    phase=self.phase,
+                    duration=duration,
+                    bytes_out=bytes_out,
+                    bytes_in=bytes_in,
+                    exit_code=status,
+                    retries=attempt,
+                )
+            )
+
+
+class SSHRunner(_CommandRecorder):
+    def __init__(
+        self,
+        config: SSHConfig,
+        logger: Optional[Callable[[str], None]] = None,
+        on_command: Optional[Callable[[CommandStat], None]] = None,
+        slow_threshold: Optional[float] = 10.0,
+    ) -> None:
+        super().__init__(config, logger, on_command, slow_threshold)
+        self.client: Optional[paramiko.SSHClient] = None
+        self._local = threading.local()
+
+    @property
+    def phase(self) -> Optional[str]:
+        # Thread-local so parallel provisioning steps tag their own commands.
+        return getattr(self._local, "phase", None)
+
+    @phase.setter
+    def phase(self, value: Optional[str]) -> None:
+        self._local.phase = value
 
     def __enter__(self) -> "SSHRunner":
         self.connect()
@@ -41,12 +307,14 @@ class SSHRunner:
         self.log("Connecting over SSH...")
         client = paramiko.SSHClient()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        pkey = self.config.private_key()
         client.connect(
             hostname=self.config.host,
             port=self.config.port,
             username=self.config.user,
             password=self.config.password,
-            key_filename=self.config.key_path,
+            pkey=pkey,
+            key_filename=None if pkey else self.config.key_path,
             timeout=self.config.timeout,
             look_for_keys=False,
             allow_agent=False,
@@ -58,42 +326,191 @@ class SSHRunner:
             self.client.close()
             self.client = None
 
-    def run(self, command: str, sudo: bool = False, check: bool = True, pty: bool = True) -> str:
+    def run(
+        self, command: str, sudo: bool = False, check: bool = True, pty: bool = True, attempt: int = 0
+    ) -> str:
         if not self.client:
             raise RuntimeError("SSH client not connected.")
 
-        wrapped = f"bash -lc {shlex.quote(command)}"
-        if sudo:
-            if self.config.password:
-                wrapped = f"sudo -S -p '' {wrapped}"
-            else:
-                wrapped = f"sudo {wrapped}"
-
+        wrapped = _wrap_command(self.config, command, sudo)
         self.log(f"$ {command}")
         if sudo and self.config.password and pty:
             pty = False  # Avoid echoing the sudo password into stdout/stderr
+        started = time.monotonic()
+        bytes_out = len(wrapped.encode("utf-8"))
         stdin, stdout, stderr = self.client.exec_command(wrapped, get_pty=pty)
         if sudo and self.config.password:
             stdin.write(self.config.password + "\n")
             stdin.flush()
+            bytes_out += len(self.config.password) + 1
 
-        out = stdout.read().decode("utf-8", "ignore").strip()
-        err = stderr.read().decode("utf-8", "ignore").strip()
-        if self.config.password:
-            out = out.replace(self.config.password, "***")
-            err = err.replace(self.config.password, "***")
+        raw_out = stdout.read()
+        raw_err = stderr.read()
+        out = _mask_secret(self.config, raw_out.decode("utf-8", "ignore").strip())
+        err = _mask_secret(self.config, raw_err.decode("utf-8", "ignore").strip())
         status = stdout.channel.recv_exit_status()
+        self._record(command, time.monotonic() - started, bytes_out, len(raw_out) + len(raw_err), status, attempt)
         if check and status != 0:
-            msg = f"Command failed ({status}): {command}"
-            if err:
-                msg += f"\nSTDERR: {err}"
-            if out:
-                msg += f"\nSTDOUT: {out}"
-            raise RemoteCommandError(msg)
+            raise _command_error(command, status, out, err)
         if err and not out:
             return err
         return out
 
+    def put(self, local_path: str, remote_path: str) -> None:
+        """Upload a file over SFTP on the existing connection, creating its directory."""
+        if not self.client:
+            raise RuntimeError("SSH client not connected.")
+        self.log(f"sftp put {remote_path}")
+        started = time.monotonic()
+        sftp = self.client.open_sftp()
+        try:
+            parent = os.path.dirname(remote_path)
+            try:
+                sftp.stat(parent)
+            except FileNotFoundError:
+                sftp.mkdir(parent, mode=0o700)
+            attrs = sftp.put(local_path, remote_path)
+        finally:
+            sftp.close()
+        self._record(f"sftp put {remote_path}", time.monotonic() - started, attrs.st_size or 0, 0, 0)
+
+    def get(self, remote_path: str, local_path: str) -> None:
+        """Download a file over SFTP on the existing connection."""
+        if not self.client:
+            raise RuntimeError("SSH client not connected.")
+        self.log(f"sftp get {remote_path}")
+        started = time.monotonic()
+        sftp = self.client.open_sftp()
+        try:
+            sftp.get(remote_path, local_path)
+        finally:
+            sftp.close()
+        size = os.path.getsize(local_path)
+        self._record(f"sftp get {remote_path}", time.monotonic() - started, 0, size, 0)
+
+    @contextlib.contextmanager
+    def remote_lock(self, path: str, timeout: float) -> Iterator[None]:
+        """Hold flock(1) on `path` on the server until the block exits.
+
+        The lock is held by a dedicated channel running flock around `cat`; closing the
+        channel ends cat and releases it, and so does a dropped connection.
+        """
+        if not self.client:
+            raise RuntimeError("SSH client not connected.")
+        started = time.monotonic()
+        channel = self.client.get_transport().open_session()
+        try:
+            channel.exec_command(_flock_command(path, timeout))
+            ready = channel.makefile("r").readline().strip()
+            if ready != "locked":
+                status = channel.recv_exit_status()
+                raise RemoteCommandError(f"Could not lock {path} on the server (exit {status}).")
+            self._record(f"flock {path}", time.monotonic() - started, 0, len(ready), 0)
+            yield
+        finally:
+            channel.close()
+
+
+class HostLocks:
+    """In-process, re-entrant per-host locks for operations that change a server.
+
+    `hold` takes the host's RLock and, on the outermost acquisition only, enters the
+    context returned by `outer` (cross-process and remote locks), so rotate_client can
+    call remove_client and add_client without locking against itself. Waiting for the
+    RLock is bounded by `timeout` like the other locks; TimeoutError when it runs out.
+    """
+
+    def __init__(self) -> None:
+        self._locks: dict[str, threading.RLock] = {}
+        self._depth: dict[str, int] = {}
+        self._guard = threading.Lock()
+
+    @contextlib.contextmanager
+    def hold(
+        self,
+        key: str,
+        outer: Optional[Callable[[], ContextManager]] = None,
+        timeout: Optional[float] = None,
+    ) -> Iterator[None]:
+        with self._guard:
+            lock = self._locks.setdefault(key, threading.RLock())
+        if not lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise TimeoutError(f"Host {key} is busy with another change.")
+        try:
+            depth = self._depth.get(key, 0)
+            self._depth[key] = depth + 1
+            try:
+                if depth or outer is None:
+                    yield
+                else:
+                    with outer():
+                        yield
+            finally:
+                self._depth[key] = depth
+        finally:
+            lock.release()
+
+
+HOST_LOCKS = HostLocks()
+
+
+def _exclusive(method: Callable[..., T]) -> Callable[..., T]:
+    """Run a provisioner method under the per-host lock (see WireGuardProvisioner.host_lock)."""
+
+    @functools.wraps(method)
+    def wrapper(self: "WireGuardProvisioner", *args: Any, **kwargs: Any) -> T:
+        with self.host_lock():
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class ClientIndex:
+    """Clients of one host keyed by name, public key and address, for O(1) lookups.
+
+    Rows are dicts with name, interface, ip, public_key and mtime (of the client
+    config). Names are unique per interface only, so name lookups can be narrowed to
+    the interfaces of one protocol.
+    """
+
+    def __init__(self, rows: list[dict]) -> None:
+        self.rows = rows
+        self._by_name: dict[str, list[dict]] = {}
+        self._by_key: dict[str, dict] = {}
+        self._by_ip: dict[str, dict] = {}
+        for row in rows:
+            self._by_name.setdefault(row["name"], []).append(row)
+            if row["public_key"]:
+                self._by_key[row["public_key"]] = row
+            for address in row["ip"].split(","):
+                if address:
+                    self._by_ip[address] = row
+                    self._by_ip.setdefault(address.split("/", 1)[0], row)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def find(
+        self,
+        name: Optional[str] = None,
+        public_key: Optional[str] = None,
+        ip: Optional[str] = None,
+        interfaces: Optional[Iterable[str]] = None,
+    ) -> Optional[dict]:
+        allowed = set(interfaces) if interfaces is not None else None
+        if name is not None:
+            candidates = self._by_name.get(name, [])
+        elif public_key is not None:
+            candidates = [self._by_key[public_key]] if public_key in self._by_key else []
+        elif ip is not None:
+            candidates = [self._by_ip[ip]] if ip in self._by_ip else []
+        else:
+            raise ValueError("Pass a name, public key or IP.")
+        for row in candidates:
+            if allowed is None or row["interface"] in allowed:
+                return row
+        return None
+
 
 class WireGuardProvisioner:
     def __init__(
@@ -112,6 +529,10 @@ class WireGuardProvisioner:
         progress: Optional[Callable[[str], None]] = None,
         protocol: str = "amneziawg",  # "wireguard" or "amneziawg"
         allow_ipv6: bool = False,
+        artifacts: Optional[ArtifactCache] = None,
+        lock_backend: Optional[SQLiteBackend] = None,
+        remote_lock: Optional[bool] = None,
+        apply_queue: Optional[ApplyQueue] = None,
     ) -> None:
         self.ssh = ssh
         self.client_name = client_name
@@ -125,6 +546,15 @@ class WireGuardProvisioner:
         self.mtu_probe_host = mtu_probe_host
         self.tune = tune
         self.progress = progress or (lambda _: None)
+        self.package_timings: list[dict] = []
+        self.artifacts = artifacts or ArtifactCache()
+        self.lock_backend = lock_backend if lock_backend is not None else shared_backend()
+        if remote_lock is None:
+            remote_lock = os.getenv("VPNW_REMOTE_LOCK") == "1"
+        self.remote_lock = remote_lock
+        self.apply_queue = apply_queue
+        self.last_apply: Optional[Future] = None
+        self._peers_backed_up = False
         self._resolved_mtu: Optional[int] = None
         self._name_pattern = re.compile(r"^[a-zA-Z0-9_-]{1,32}$")
         self.protocol = protocol
@@ -155,32 +585,398 @@ class WireGuardProvisioner:
 
     # ... (omitted) ...
 
-    def provision(self) -> None:
-        self.progress("Detecting OS")
-        os_info = self.detect_os()
-        
+    def _phase(self, name: str, announce: bool = True) -> None:
+        """Report a provisioning phase and tag subsequent SSH commands with it."""
+        if announce:
+            self.progress(name)
+        self.ssh.phase = name
+
+    REMOTE_LOCK_PATH = "/run/lock/vpn-wizard.lock"
+    HOST_LOCK_TIMEOUT = 900.0  # seconds to wait for another writer on the same host
+    HOST_LOCK_TTL = 3600.0  # lease on the shared lock, in case a worker dies holding it
+
+    def host_key(self) -> str:
+        config = getattr(self.ssh, "config", None)
+        return f"{config.host}:{config.port}" if config else f"runner:{id(self.ssh)}"
+
+    def clone(self, ssh) -> "WireGuardProvisioner":
+        """A provisioner for the same server over another runner, e.g. a fresh connection."""
+        return WireGuardProvisioner(
+            ssh,
+            progress=self.progress,
+            protocol=self.protocol,
+            artifacts=self.artifacts,
+            lock_backend=self.lock_backend,
+            remote_lock=self.remote_lock,
+        )
+
+    def host_lock(self) -> ContextManager[None]:
+        """Serialize operations that change this server; read-only operations never lock.
+
+        Always takes an in-process lock per host:port. With a shared state backend
+        (several API workers) it also takes a cross-process lease there, and with
+        `remote_lock` a flock on the server itself, which also covers other machines.
+        """
+        key = self.host_key()
+
+        def outer() -> contextlib.ExitStack:
+            stack = contextlib.ExitStack()
+            try:
+                if self.lock_backend is not None:
+                    stack.enter_context(
+                        self.lock_backend.lock(
+                            f"host:{key}", ttl=self.HOST_LOCK_TTL, timeout=self.HOST_LOCK_TIMEOUT
+                        )
+                    )
+                remote = getattr(self.ssh, "remote_lock", None)
+                if self.remote_lock and remote is not None:
+                    stack.enter_context(remote(self.REMOTE_LOCK_PATH, self.HOST_LOCK_TIMEOUT))
+            except BaseException:
+                stack.close()
+                raise
+            return stack
+
+        return HOST_LOCKS.hold(key, outer, timeout=self.HOST_LOCK_TIMEOUT)
+
+    STATE_PATH = "/etc/vpn-wizard/provision.state"
+    CLIENT_INDEX_PATH = "/etc/vpn-wizard/clients.tsv"
+    CLIENT_DIRS = {
+        "awg0": "/etc/amnezia/amneziawg/clients",
+        "awg1": "/etc/amnezia/amneziawg/clients_tyumen",
+        "wg0": "/etc/wireguard/clients",
+    }
+
+    BASE_PACKAGES = ("qrencode", "iptables", "curl")
+
+    def _required_packages(self) -> list[str]:
+        tools = "amneziawg" if self.protocol == "amneziawg" else "wireguard"
+        return [tools, *self.BASE_PACKAGES]
+
+    def _install_check_script(self) -> str:
+        """Shell lines printing packages=0/1 (and module=0/1 for AmneziaWG) for the install step."""
         if self.protocol == "amneziawg":
-            self.progress("Installing AmneziaWG")
-            self.install_amneziawg(os_info)
-            self.progress("Configuring sysctl")
-            self.configure_sysctl()
-            self.progress("Setting up AmneziaWG")
-            self.setup_amneziawg()
-            self.progress("Configuring firewall")
-            self.enable_firewall()
-            self.progress("Starting AmneziaWG service")
-            self.start_awg_service()
+            rpm = "amneziawg-dkms amneziawg-tools qrencode curl"
         else:
-            self.progress("Installing WireGuard")
-            self.install_wireguard(os_info)
-            self.progress("Configuring sysctl")
-            self.configure_sysctl()
-            self.progress("Setting up WireGuard")
-            self.setup_wireguard()
-            self.progress("Configuring firewall")
-            self.enable_firewall()
-            self.progress("Starting service")
-            self.start_service()
+            rpm = "wireguard-tools qrencode iptables curl"
+        lines = [
+            "if command -v dpkg-query >/dev/null 2>&1; then",
+            f"  s=$(dpkg-query -W -f '${{Package}} ${{db:Status-Status}}\\n' {' '.join(self._required_packages())}"
+            " 2>/dev/null) && ! printf '%s\\n' \"$s\" | grep -qv ' installed$' && echo packages=1 || echo packages=0",
+            "else",
+            f"  rpm -q {rpm} >/dev/null 2>&1 && echo packages=1 || echo packages=0",
+            "fi",
+        ]
+        if self.protocol == "amneziawg":
+            # The module is built per kernel, so a kernel upgrade can leave the tools without it.
+            lines.append("modinfo amneziawg >/dev/null 2>&1 && echo module=1 || echo module=0")
+        return "\n".join(lines) + "\n"
+
+    def desired_state(self) -> dict[str, str]:
+        """Human-readable description of what each recorded provisioning step produces."""
+        sysctl = self.SYSCTL_CONF + (self.SYSCTL_TUNING_CONF if self.tune else "")
+        setup = (
+            f"protocol={self.protocol} client={self.client_name} client_ip={self.client_ip} "
+            f"cidr={self.server_cidr} port={self.listen_port} dns={self.dns} mtu={self.mtu} "
+            f"auto_mtu={self.auto_mtu} ipv6={self.allow_ipv6}"
+        )
+        return {
+            "install": "packages=" + ",".join(self._required_packages()),
+            "sysctl": sysctl,
+            "setup": setup,
+            "firewall": f"udp_port={self.listen_port} nat_source={self.server_cidr}",
+            "service": setup,
+        }
+
+    def state_fingerprints(self) -> dict[str, str]:
+        return {
+            name: hashlib.sha256(value.encode("utf-8")).hexdigest()[:16]
+            for name, value in self.desired_state().items()
+        }
+
+    SYSCTL_PATH = "/etc/sysctl.d/99-vpn-wizard.conf"
+    SYSCTL_TUNING_PATH = "/etc/sysctl.d/99-vpn-wizard-tuning.conf"
+    NAT_MARKER = "# VPN Wizard NAT"
+
+    def _provision_paths(self) -> tuple[str, str, str]:
+        """(interface, config dir, server config) the provisioning steps manage."""
+        if self.protocol == "amneziawg":
+            return "awg0", "/etc/amnezia/amneziawg", "/etc/amnezia/amneziawg/awg0.conf"
+        return "wg0", "/etc/wireguard", "/etc/wireguard/wg0.conf"
+
+    def _sysctl_paths(self) -> list[str]:
+        return [self.SYSCTL_PATH, self.SYSCTL_TUNING_PATH] if self.tune else [self.SYSCTL_PATH]
+
+    def _state_hash_commands(self) -> dict[str, str]:
+        """Shell pipelines hashing what each step wrote, so edits made on the server are noticed.
+
+        Setup only hashes the [Interface] section: peers change with every client operation.
+        """
+        _, _, conf = self._provision_paths()
+        digest = "sha256sum | cut -c1-16"
+        return {
+            "sysctl": f"cat {' '.join(self._sysctl_paths())} 2>/dev/null | {digest}",
+            "setup": f"awk '/^\\[Peer\\]/{{exit}} {{print}}' {conf} 2>/dev/null | {digest}",
+            "firewall": f"sed -n '/^{self.NAT_MARKER}/,/^COMMIT/p' /etc/ufw/before.rules 2>/dev/null | {digest}",
+        }
+
+    def _probe_provision_state(self, with_files: bool = False) -> dict:
+        """Collect OS info and everything the skip checks need in a single round trip.
+
+        `with_files` also reads the files provisioning writes, for `plan_provision` diffs.
+        """
+        ifname, conf_dir, conf = self._provision_paths()
+        tool = "awg" if self.protocol == "amneziawg" else "wg"
+        service = f"{tool}-quick@{ifname}"
+        sysctl_files = " ".join(self._sysctl_paths())
+        hashes = "".join(f"echo hash_{name}=$({command})\n" for name, command in self._state_hash_commands().items())
+        files = ""
+        if with_files:
+            patterns = [
+                *self._sysctl_paths(),
+                conf,
+                f"{conf_dir}/server_public.key",
+                f"{conf_dir}/clients/*.conf",
+                f"{conf_dir}/clients/*.pub",
+                "/etc/ufw/before.rules",
+                "/etc/default/ufw",
+            ]
+            files = "echo '@@files'\n" + snapshot_script(patterns) + "\n"
+        raw = self.ssh.run(
+            "cat /etc/os-release\n"
+            "echo '@@facts'\n"
+            f"command -v {tool} >/dev/null 2>&1 && echo tools=1 || echo tools=0\n"
+            + self._install_check_script()
+            + f"ls {sysctl_files} >/dev/null 2>&1 && echo sysctl=1 || echo sysctl=0\n"
+            f"test -f {conf} && echo server_conf=1 || echo server_conf=0\n"
+            f"test -f {conf_dir}/clients/{self.client_name}.conf && echo client_conf=1 || echo client_conf=0\n"
+            f"grep -q '{self.NAT_MARKER}' /etc/ufw/before.rules 2>/dev/null && echo nat=1 || echo nat=0\n"
+            f"echo service=$(systemctl is-active {service} 2>/dev/null)\n"
+            + hashes
+            + "echo '@@state'\n"
+            f"cat {self.STATE_PATH} 2>/dev/null\n"
+            + files
+            + "true",
+            sudo=True,
+            check=False,
+            pty=False,
+        )
+        os_part, _, rest = raw.partition("@@facts")
+        facts_part, _, state_part = rest.partition("@@state")
+        state_part, _, files_part = state_part.partition("@@files")
+        os_info = {}
+        for line in os_part.splitlines():
+            if "=" in line:
+                key, value = line.split("=", 1)
+                os_info[key.strip()] = value.strip().strip('"')
+        if not os_info:
+            raise RuntimeError("Unable to detect OS from /etc/os-release.")
+        facts: dict = {"os": os_info}
+        for line in facts_part.splitlines():
+            if "=" in line:
+                key, value = line.split("=", 1)
+                facts[key.strip()] = value.strip()
+        recorded: dict[str, str] = {}
+        recorded_files: dict[str, str] = {}
+        for line in state_part.splitlines():
+            parts = line.split()
+            if len(parts) in (2, 3):
+                recorded[parts[0]] = parts[1]
+            if len(parts) == 3:
+                recorded_files[parts[0]] = parts[2]
+        facts["recorded"] = recorded
+        facts["recorded_files"] = recorded_files
+        if with_files:
+            facts["files"] = parse_snapshot(files_part).files
+        return facts
+
+    def _step_decision(self, name: str, facts: dict, fingerprints: dict[str, str]) -> tuple[bool, str]:
+        """Return (skip, reason) for a provisioning step given the probed server facts."""
+        if name in {"mtu", "public_ip"}:
+            skip, _ = self._step_decision("setup", facts, fingerprints)
+            return skip, "setup unchanged" if skip else "needed by setup"
+        present = {
+            "install": facts.get("tools") == "1"
+            and facts.get("packages") == "1"
+            and facts.get("module", "1") == "1",
+            "sysctl": facts.get("sysctl") == "1",
+            "setup": facts.get("server_conf") == "1" and facts.get("client_conf") == "1",
+            "firewall": facts.get("nat") == "1",
+            "service": facts.get("service") == "active",
+        }[name]
+        recorded = facts.get("recorded", {}).get(name)
+        if recorded is None:
+            return False, "no record of a previous run"
+        if recorded != fingerprints[name]:
+            return False, "desired state changed"
+        if not present:
+            return False, "recorded but missing on server"
+        written = facts.get("recorded_files", {}).get(name)
+        if written is not None and facts.get(f"hash_{name}") != written:
+            return False, "changed on server since last run"
+        return True, "matches recorded state"
+
+    def _save_provision_state(self, results: dict[str, StepResult], facts: dict) -> None:
+        fingerprints = self.state_fingerprints()
+        recorded = dict(facts.get("recorded", {}))
+        for name, result in results.items():
+            if name not in fingerprints:
+                continue
+            if result.status == "failed":
+                recorded.pop(name, None)
+            else:
+                recorded[name] = fingerprints[name]
+        # Hash the written files on the server in the same round trip as the state write.
+        hash_commands = self._state_hash_commands()
+        lines = [f"mkdir -p {os.path.dirname(self.STATE_PATH)}"]
+        lines += [f"h_{name}=$({hash_commands[name]})" for name in sorted(recorded) if name in hash_commands]
+        body = "\n".join(
+            f"{name} {value} $h_{name}" if name in hash_commands else f"{name} {value}"
+            for name, value in sorted(recorded.items())
+        )
+        lines.append(f"cat > {self.STATE_PATH} <<EOF\n{body}\nEOF")
+        self.ssh.run("\n".join(lines), sudo=True, check=False)
+
+    def _provision_steps(self, facts: dict) -> list[Step]:
+        os_info = facts["os"]
+        fingerprints = self.state_fingerprints()
+        awg = self.protocol == "amneziawg"
+        name = "AmneziaWG" if awg else "WireGuard"
+
+        def skip(step: str) -> Callable[[], bool]:
+            return lambda: self._step_decision(step, facts, fingerprints)[0]
+
+        return [
+            Step(
+                "install",
+                lambda: self.install_amneziawg(os_info) if awg else self.install_wireguard(os_info),
+                skip=skip("install"),
+                label=f"Installing {name}",
+            ),
+            Step(
+                "sysctl",
+                self.configure_sysctl,
+                skip=skip("sysctl"),
+                label="Configuring sysctl",
+            ),
+            # Prefetch what setup needs while packages install.
+            Step("mtu", self.resolve_mtu, skip=skip("mtu"), label="Probing MTU"),
+            Step("public_ip", self.get_public_ip, skip=skip("public_ip"), label="Looking up public IP"),
+            Step(
+                "setup",
+                self.setup_amneziawg if awg else self.setup_wireguard,
+                deps=("install", "mtu", "public_ip"),
+                skip=skip("setup"),
+                label=f"Setting up {name}",
+            ),
+            Step(
+                "firewall",
+                self.enable_firewall,
+                deps=("install",),
+                skip=skip("firewall"),
+                label="Configuring firewall",
+            ),
+            Step(
+                "service",
+                self.start_awg_service if awg else self.start_service,
+                deps=("setup", "sysctl", "firewall"),
+                skip=skip("service"),
+                label="Starting AmneziaWG service" if awg else "Starting service",
+            ),
+        ]
+
+    def plan_provision(self) -> list[dict]:
+        """Show which provisioning steps would run and how their files change, without changing the server."""
+        self._phase("Detecting OS", announce=False)
+        facts = self._probe_provision_state(with_files=True)
+        fingerprints = self.state_fingerprints()
+        files = facts["files"]
+        planned = self._planned_provision_files(files)
+        plan = []
+        for step in self._provision_steps(facts):
+            skip, reason = self._step_decision(step.name, facts, fingerprints)
+            # Skipped steps write nothing.
+            after = {} if skip else planned.get(step.name, {})
+            before = {path: files[path] for path in after if path in files}
+            plan.append(
+                {
+                    "step": step.name,
+                    "label": step.label or step.name,
+                    "action": "skip" if skip else "run",
+                    "reason": reason,
+                    "diff": ChangePlan(operation=step.name).compare(before, after).diff(),
+                    "recorded": facts["recorded"].get(step.name),
+                    "fingerprint": fingerprints.get(step.name),
+                }
+            )
+        return plan
+
+    def _planned_provision_files(self, files: dict[str, str]) -> dict[str, dict[str, str]]:
+        """Files each step would write (path -> content), computed from the current ones.
+
+        Values only known while provisioning (new keys, a free client IP, a probed MTU) are
+        shown as `<placeholders>`.
+        """
+        ifname, conf_dir, conf = self._provision_paths()
+        clients_dir = f"{conf_dir}/clients"
+        client_conf = f"{clients_dir}/{self.client_name}.conf"
+        current_client = files.get(client_conf)
+        sysctl = {self.SYSCTL_PATH: self.SYSCTL_CONF}
+        if self.tune:
+            sysctl[self.SYSCTL_TUNING_PATH] = self.SYSCTL_TUNING_CONF
+
+        mtu: Optional[Union[int, str]] = self._resolved_mtu or self.mtu
+        if mtu is None and self.auto_mtu:
+            mtu = self._conf_value(files.get(conf), "MTU") or "<probed>"
+        endpoint_host = self._public_ip_cache or self._conf_value(current_client, "Endpoint").rpartition(":")[0]
+        awg_params = self._awg_params_text() if self.protocol == "amneziawg" else ""
+        setup = dict(files)
+        setup[conf] = self._server_header(ifname, self._conf_value(files.get(conf), "PrivateKey") or "<generated>", mtu)
+        setup.setdefault(f"{clients_dir}/{self.client_name}.pub", "<generated>\n")
+        setup[client_conf] = self._client_config_text(
+            self._conf_value(current_client, "PrivateKey") or "<generated>",
+            self.client_ip or "<next free>",
+            self.dns,
+            mtu,
+            awg_params,
+            (files.get(f"{conf_dir}/server_public.key") or "").strip() or "<generated>",
+            f"{endpoint_host or '<public ip>'}:{self.listen_port}",
+            self._allowed_ips(),
+        )
+        self._planned_rebuild(setup, ifname, conf, clients_dir, ChangePlan(operation="setup"))
+
+        firewall: dict[str, str] = {}
+        rules = files.get("/etc/ufw/before.rules")
+        if rules is not None and self.NAT_MARKER not in rules:
+            firewall["/etc/ufw/before.rules"] = rules + self._nat_block()
+        if "/etc/default/ufw" in files:
+            firewall["/etc/default/ufw"] = re.sub(
+                r"^DEFAULT_FORWARD_POLICY=.*$",
+                'DEFAULT_FORWARD_POLICY="ACCEPT"',
+                files["/etc/default/ufw"],
+                flags=re.MULTILINE,
+            )
+        return {
+            "sysctl": sysctl,
+            "setup": {conf: setup[conf], client_conf: setup[client_conf]},
+            "firewall": firewall,
+        }
+
+    @_exclusive
+    def provision(self, max_workers: int = 4) -> dict[str, StepResult]:
+        self._phase("Detecting OS")
+        facts = self._probe_provision_state()
+        graph = StepGraph(self._provision_steps(facts))
+        try:
+            graph.run(
+                max_workers=max_workers,
+                on_start=lambda step: self._phase(step.label or step.name),
+                on_skip=lambda step: self.progress(f"{step.label or step.name}: already done, skipping"),
+            )
+        finally:
+            # Persist finished steps, so a failed run resumes where it stopped.
+            self._phase("Saving state", announce=False)
+            self._save_provision_state(graph.results, facts)
+        return graph.results
 
     def _classify_os(self, os_info: dict) -> tuple[bool, bool, str, str]:
         distro = os_info.get("ID", "").lower()
@@ -202,41 +998,148 @@ class WireGuardProvisioner:
             raise RuntimeError("Unable to detect OS from /etc/os-release.")
         return info
 
+    APT = "DEBIAN_FRONTEND=noninteractive apt-get -o DPkg::Lock::Timeout=300"
+    APT_LISTS_MAX_AGE = 6 * 3600
+    BOOT_MIN_FREE_MB = 200
+
+    def _apt_probe(self, packages: list[str], tool: Optional[str] = None) -> dict:
+        """Collect everything the apt planner needs in one round trip.
+
+        Package names may contain `$(uname -r)`; they are expanded on the server and
+        mapped back here, so callers can keep using the unexpanded names.
+        """
+        names = " ".join(packages)
+        script = (
+            'echo "@@kernel $(uname -r)"\n'
+            'arch=$(dpkg --print-architecture 2>/dev/null); echo "@@arch ${arch:-$(uname -m)}"\n'
+            'echo "@@now $(date +%s)"\n'
+            'echo "@@lists $(stat -c %Y /var/lib/apt/lists/*_Packages 2>/dev/null | sort -n | tail -1)"\n'
+            "echo \"@@boot $(df -Pm /boot 2>/dev/null | awk 'NR==2{print $4}')\"\n"
+            'echo "@@ppa $(grep -rlsi amnezia /etc/apt/sources.list /etc/apt/sources.list.d 2>/dev/null | head -1)"\n'
+            + (f'echo "@@tool $(command -v {tool} 2>/dev/null)"\n' if tool else "")
+            + "echo @@dpkg\n"
+            f"dpkg-query -W -f '${{Package}} ${{db:Status-Status}}\\n' {names} 2>/dev/null\n"
+            "true"
+        )
+        out = self.ssh.run(script, sudo=True, check=False)
+        values: dict[str, str] = {}
+        installed: set[str] = set()
+        in_dpkg = False
+        for line in out.splitlines():
+            if line.strip() == "@@dpkg":
+                in_dpkg = True
+                continue
+            if in_dpkg:
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == "installed":
+                    installed.add(parts[0])
+                continue
+            if line.startswith("@@"):
+                key, _, value = line[2:].partition(" ")
+                values[key] = value.strip()
+        kernel = values.get("kernel", "")
+        now = values.get("now", "")
+        lists = values.get("lists", "")
+        boot = values.get("boot", "")
+        lists_fresh = (
+            now.isdigit() and lists.isdigit() and int(now) - int(lists) < self.APT_LISTS_MAX_AGE
+        )
+        return {
+            "kernel": kernel,
+            "arch": values.get("arch", ""),
+            "missing": [
+                pkg for pkg in packages if pkg.replace("$(uname -r)", kernel) not in installed
+            ],
+            "lists_fresh": lists_fresh,
+            "boot_free_mb": int(boot) if boot.isdigit() else None,
+            "ppa": bool(values.get("ppa")),
+            "tool": bool(values.get("tool")),
+        }
+
+    def _apt_install(
+        self,
+        packages: list[str],
+        update: bool,
+        optional: tuple[str, ...] = (),
+        prepare: str = "",
+        attempt: int = 0,
+    ) -> list[dict]:
+        """Install `packages` in a single apt transaction and return per-package timings.
+
+        `prepare` runs first (after an optional index refresh), e.g. to add a repository.
+        Instead of killing apt or sleeping on lock errors, apt waits up to
+        DPkg::Lock::Timeout for a running unattended-upgrade to release the lock.
+        Timings are approximate: they come from dpkg's file-list timestamps, one second
+        resolution, in install order.
+        """
+        names = " ".join(list(packages) + list(optional))
+        # Local .deb files are installed by path but queried by package name.
+        queried = " ".join(
+            os.path.basename(pkg).split("_", 1)[0] if pkg.endswith(".deb") else pkg
+            for pkg in list(packages) + list(optional)
+        )
+        lines = [
+            "set -e",
+            "systemctl stop apt-daily.timer apt-daily-upgrade.timer 2>/dev/null || true",
+            'echo "@@start $(date +%s)"',
+        ]
+        if update:
+            lines.append(f"{self.APT} update -y")
+        if prepare:
+            lines.append(prepare)
+        if optional:
+            lines.append(
+                f"{self.APT} install -y {names} || {self.APT} install -y {' '.join(packages)}"
+            )
+        else:
+            lines.append(f"{self.APT} install -y {names}")
+        lines.append("echo @@timings")
+        lines.append(f"dpkg-query -W -f '${{Package}} ${{db-fsys:Last-Modified}}\\n' {queried} 2>/dev/null || true")
+        out = self.ssh.run("\n".join(lines), sudo=True, attempt=attempt)
+
+        start = None
+        finished: list[tuple[int, str]] = []
+        in_timings = False
+        for line in out.splitlines():
+            if line.startswith("@@start "):
+                value = line.split(" ", 1)[1].strip()
+                start = int(value) if value.isdigit() else None
+            elif line.strip() == "@@timings":
+                in_timings = True
+            elif in_timings:
+                parts = line.split()
+                if len(parts) == 2 and parts[1].isdigit():
+                    finished.append((int(parts[1]), parts[0]))
+        timings = []
+        previous = start
+        for stamp, package in sorted(finished):
+            if start is not None and stamp < start:
+                continue
+            timings.append({"package": package, "seconds": stamp - previous if previous else 0})
+            previous = stamp
+        if timings:
+            total = sum(item["seconds"] for item in timings)
+            slowest = max(timings, key=lambda item: item["seconds"])
+            self.progress(
+                f"Installed {len(timings)} packages in {total}s"
+                f" (slowest: {slowest['package']} {slowest['seconds']}s)"
+            )
+        self.package_timings.extend(timings)
+        return timings
+
     def install_wireguard(self, os_info: dict) -> None:
         is_deb, is_rhel, distro, _ = self._classify_os(os_info)
 
         if is_deb:
-            # Retry loop for apt lock
-            import time
-            max_retries = 10
-            for i in range(max_retries):
-                try:
-                    self.ssh.run("DEBIAN_FRONTEND=noninteractive apt-get update -y", sudo=True)
-                    self.ssh.run(
-                        "DEBIAN_FRONTEND=noninteractive apt-get install -y wireguard qrencode iptables curl",
-                        sudo=True,
-                    )
-                    self.ssh.run(
-                        "DEBIAN_FRONTEND=noninteractive apt-get install -y iptables-persistent || true",
-                        sudo=True,
-                        check=False,
-                    )
-                    return
-                except RemoteCommandError as exc:
-                    err_msg = str(exc).lower()
-                    # Check for lock errors or generic failures
-                    if "lock" in err_msg or "resource temporarily unavailable" in err_msg or "could not get lock" in err_msg:
-                        if i < max_retries - 1:
-                            self.progress(f"Apt locked, retrying in 10s... ({i+1}/{max_retries})")
-                            time.sleep(10)
-                            continue
-                    # Check for generic exit code 100 which often means update needed or lock
-                    if "failed (100)" in str(exc):
-                         if i < max_retries - 1:
-                            self.progress(f"Apt failed (likely locked), retrying in 10s... ({i+1}/{max_retries})")
-                            time.sleep(10)
-                            continue
-                    raise exc
+            packages = ["wireguard", *self.BASE_PACKAGES]
+            optional = ("iptables-persistent",)
+            probe = self._apt_probe(packages + list(optional))
+            missing = [pkg for pkg in packages if pkg in probe["missing"]]
+            if not missing:
+                self.progress("Packages already installed, skipping...")
+                return
+            extra = tuple(pkg for pkg in optional if pkg in probe["missing"])
+            self._apt_install(missing, update=not probe["lists_fresh"], optional=extra)
             return
 
         if is_rhel:
@@ -249,106 +1152,210 @@ class WireGuardProvisioner:
 
         raise RuntimeError(f"Unsupported distro: {distro}")
 
-    def _release_apt_locks(self) -> None:
-        """Aggressively release apt locks and kill blocking processes."""
-        self.progress("Releasing apt locks...")
-        self.ssh.run(
-            "systemctl stop unattended-upgrades apt-daily.timer apt-daily-upgrade.timer 2>/dev/null || true; "
-            "killall -9 unattended-upgrade apt apt-get dpkg 2>/dev/null || true; "
-            "rm -f /var/lib/apt/lists/lock /var/cache/apt/archives/lock /var/lib/dpkg/lock* 2>/dev/null || true; "
-            "dpkg --configure -a 2>/dev/null || true",
-            sudo=True,
-            check=False,
-        )
-        import time
-        time.sleep(2)
-
     def _clean_boot_partition(self) -> None:
         """Remove old kernels to free space in /boot."""
         self.progress("Cleaning old kernels to free space...")
-        # Get current kernel version
-        current = self.ssh.run("uname -r").strip()
-        # List all installed kernels (linux-image-*) excluding current
-        # This one-liner finds old kernels and purging them
         cmd = (
-            f"current_kernel=$(uname -r); "
-            f"dpkg -l 'linux-image-[0-9]*' | grep '^ii' | awk '{{print $2}}' | "
-            f"grep -v \"$current_kernel\" | grep -v \"$(uname -r | cut -d- -f1-2)\" | "
-            f"xargs -r apt-get -y purge"
+            "current_kernel=$(uname -r); "
+            "dpkg -l 'linux-image-[0-9]*' | grep '^ii' | awk '{print $2}' | "
+            "grep -v \"$current_kernel\" | grep -v \"$(uname -r | cut -d- -f1-2)\" | "
+            f"xargs -r {self.APT} -y purge; "
+            f"{self.APT} autoremove -y; "
+            "apt-get clean"
         )
         self.ssh.run(cmd, sudo=True, check=False)
-        self.ssh.run("apt-get autoremove -y", sudo=True, check=False)
-        self.ssh.run("apt-get clean", sudo=True, check=False)
+
+    ARTIFACT_REMOTE_BASE = "/var/cache/vpn-wizard"
+
+    def _make_artifact_dir(self) -> str:
+        """Create a fresh 0700 directory for package transfers and return its path.
+
+        It lives in a root-owned base directory instead of /tmp, so other local users can
+        neither pre-create it nor swap packages in it; an existing base owned by someone
+        else or writable by others is an error. A sudo login gets the directory for SFTP.
+        """
+        base = self.ARTIFACT_REMOTE_BASE
+        out = self.ssh.run(
+            "set -e\n"
+            "umask 077\n"
+            f"mkdir -p {base}\n"
+            f'if [ "$(stat -c %u {base})" != "$(id -u)" ] || [ -n "$(find {base} -maxdepth 0 -perm /022)" ]; then\n'
+            f'  echo "{base} must be owned by root and not writable by others" >&2\n'
+            "  exit 1\n"
+            "fi\n"
+            f"dir=$(mktemp -d {base}/artifacts.XXXXXX)\n"
+            '[ "${SUDO_USER:-root}" = root ] || chown "$SUDO_USER" "$dir"\n'
+            'echo "@@dir ${dir##*/}"',
+            sudo=True,
+        )
+        for line in out.splitlines():
+            if line.startswith("@@dir "):
+                return f"{base}/{line[len('@@dir '):].strip()}"
+        raise RuntimeError("Could not create a directory for package uploads.")
+
+    def _install_prebuilt_amneziawg(self, key: str, base_missing: list[str], update: bool) -> bool:
+        """Install cached module/tools packages for this exact kernel; False means use DKMS."""
+        files = self.artifacts.lookup(key)
+        if not files:
+            return False
+        self.progress(f"Installing prebuilt AmneziaWG packages ({key})...")
+        remote_dir = self._make_artifact_dir()
+        remote = [f"{remote_dir}/{path.name}" for path in files]
+        try:
+            for path, target in zip(files, remote):
+                self.ssh.put(str(path), target)
+            self._apt_install(
+                remote + base_missing,
+                update=update,
+                # A sudo login's upload directory goes back to root before apt reads from it.
+                prepare=f'[ "${{SUDO_USER:-root}}" = root ] || chown -R root: {remote_dir}\ndpkg --configure -a || true',
+            )
+            self.ssh.run(
+                f"rm -rf {remote_dir}; depmod -a; modprobe amneziawg && command -v awg",
+                sudo=True,
+            )
+            return True
+        except (OSError, RemoteCommandError) as exc:
+            self.ssh.run(f"rm -rf {remote_dir}", sudo=True, check=False)
+            self.progress(f"Prebuilt packages failed ({exc}), falling back to DKMS build...")
+            return False
+
+    def collect_amneziawg_artifacts(self, cache: Optional[ArtifactCache] = None) -> tuple[str, list[str]]:
+        """Package the DKMS-built module and tools on a working server into the local cache.
+
+        Uses `dkms mkbmdeb` for a binary module package and `apt-get download` for the
+        tools, then pulls both over SFTP. Returns the cache key and stored file names.
+        """
+        cache = cache or self.artifacts
+        out_dir = self._make_artifact_dir()
+        try:
+            return self._collect_artifacts_into(out_dir, cache)
+        finally:
+            self.ssh.run(f"rm -rf {out_dir}", sudo=True, check=False)
+
+    def _collect_artifacts_into(self, out_dir: str, cache: ArtifactCache) -> tuple[str, list[str]]:
+        script = (
+            "set -e\n"
+            "ver=$(ls /var/lib/dkms/amneziawg 2>/dev/null | grep -v original_module | sort -V | tail -1)\n"
+            '[ -n "$ver" ] || { echo "amneziawg DKMS module not found" >&2; exit 1; }\n'
+            'dkms mkbmdeb "amneziawg/$ver" -k "$(uname -r)" >/dev/null\n'
+            f'cp /var/lib/dkms/amneziawg/"$ver"/bmdeb/*.deb {out_dir}/\n'
+            f"cd {out_dir} && apt-get download amneziawg-tools >/dev/null\n"
+            f"chmod a+r {out_dir}/*.deb\n"
+            f'[ "${{SUDO_USER:-root}}" = root ] || chown -R "$SUDO_USER" {out_dir}\n'
+            ". /etc/os-release\n"
+            'echo "@@os $ID $VERSION_ID"\n'
+            'echo "@@kernel $(uname -r)"\n'
+            'arch=$(dpkg --print-architecture 2>/dev/null); echo "@@arch ${arch:-$(uname -m)}"\n'
+            f"ls -1 {out_dir}/*.deb"
+        )
+        out = self.ssh.run(script, sudo=True)
+        values: dict[str, str] = {}
+        remote_files = []
+        for line in out.splitlines():
+            line = line.strip()
+            if line.startswith("@@"):
+                name, _, value = line[2:].partition(" ")
+                values[name] = value.strip()
+            elif line.endswith(".deb"):
+                remote_files.append(line)
+        if not remote_files:
+            raise RuntimeError("No AmneziaWG packages were produced on the server.")
+        distro, _, version = values.get("os", "").partition(" ")
+        key = ArtifactCache.key(distro, version, values.get("kernel", ""), values.get("arch", ""))
+        with tempfile.TemporaryDirectory(prefix="vpnw-artifacts-") as tmp:
+            local_files = []
+            for remote_path in remote_files:
+                local = Path(tmp) / os.path.basename(remote_path)
+                self.ssh.get(remote_path, str(local))
+                local_files.append(local)
+            cache.store(key, local_files, meta={"source_host": self.ssh.config.host})
+        return key, [path.name for path in local_files]
 
     def install_amneziawg(self, os_info: dict) -> None:
         """Install AmneziaWG kernel module and tools via PPA."""
-        # Check if AmneziaWG tools are already installed
-        awg_check = self.ssh.run("which awg 2>/dev/null && echo 'installed' || echo 'missing'", check=False)
-        if "installed" in awg_check:
-            self.progress("AmneziaWG already installed, skipping...")
-            self.ssh.run("modprobe amneziawg 2>/dev/null || true", sudo=True, check=False)
-            return
-        
         is_deb, is_rhel, distro, _ = self._classify_os(os_info)
-        
+
         if is_deb:
-            # 1. Release locks
-            self._release_apt_locks()
-            
-            # 2. Clean boot partition to avoid "No space left on device"
-            self._clean_boot_partition()
-            
-            # Apt with 2 minute lock timeout
-            apt = "DEBIAN_FRONTEND=noninteractive apt-get -o DPkg::Lock::Timeout=120"
-            
-            self.progress("Updating packages...")
-            self.ssh.run(f"{apt} update -y", sudo=True)
-            
-            self.progress("Installing prerequisites...")
-            self.ssh.run(f"{apt} install -y software-properties-common gnupg2 curl qrencode iptables", sudo=True)
-            
-            # Try to install headers - this often fails if space is low, so we try-catch
-            try:
-                self.ssh.run(f"{apt} install -y linux-headers-$(uname -r)", sudo=True)
-            except RemoteCommandError:
-                self.progress("Header install failed, trying explicit cleanup again...")
-                self._clean_boot_partition()
-                self.ssh.run(f"{apt} install -y linux-headers-$(uname -r)", sudo=True)
+            repo_prereqs = ["software-properties-common", "gnupg2"]
+            packages = ["amneziawg", *self.BASE_PACKAGES, "linux-headers-$(uname -r)"]
+            probe = self._apt_probe(repo_prereqs + packages, tool="awg")
+            missing = [pkg for pkg in packages if pkg in probe["missing"]]
+            # Headers for a freshly upgraded kernel show up as missing; installing them rebuilds the module.
+            if probe["tool"] and not missing:
+                self.progress("AmneziaWG already installed, skipping...")
+                self.ssh.run(
+                    "modprobe amneziawg 2>/dev/null || { dkms autoinstall >/dev/null 2>&1; modprobe amneziawg; } || true",
+                    sudo=True,
+                    check=False,
+                )
+                return
 
-            self.progress("Adding AmneziaWG repository...")
-            self.ssh.run(
-                "add-apt-repository -y ppa:amnezia/ppa || "
-                "(apt-key adv --keyserver keyserver.ubuntu.com --recv-keys 57290828 && "
-                "echo 'deb https://ppa.launchpadcontent.net/amnezia/ppa/ubuntu focal main' >> /etc/apt/sources.list)",
-                sudo=True,
-                check=False,
+            key = ArtifactCache.key(
+                os_info.get("ID", ""), os_info.get("VERSION_ID", ""), probe["kernel"], probe["arch"]
             )
-            self.ssh.run(f"{apt} update -y", sudo=True)
-            
+            base_missing = [pkg for pkg in self.BASE_PACKAGES if pkg in probe["missing"]]
+            update = bool(base_missing) and not probe["lists_fresh"]
+            if self._install_prebuilt_amneziawg(key, base_missing, update):
+                return
+
+            # Old kernels fill small /boot partitions and make the headers/DKMS build fail.
+            boot_free = probe["boot_free_mb"]
+            if boot_free is not None and boot_free < self.BOOT_MIN_FREE_MB:
+                self._clean_boot_partition()
+
+            update = not probe["lists_fresh"]
+            prepare = "dpkg --configure -a || true"
+            if not probe["ppa"]:
+                self.progress("Adding AmneziaWG repository...")
+                prereqs = [pkg for pkg in repo_prereqs if pkg in probe["missing"]]
+                if prereqs:
+                    prepare += f"\n{self.APT} install -y {' '.join(prereqs)}"
+                else:
+                    update = False
+                prepare += (
+                    "\nadd-apt-repository -y -n ppa:amnezia/ppa || "
+                    "(apt-key adv --keyserver keyserver.ubuntu.com --recv-keys 57290828 && "
+                    "echo 'deb https://ppa.launchpadcontent.net/amnezia/ppa/ubuntu focal main' >> /etc/apt/sources.list)"
+                    f"\n{self.APT} update -y"
+                )
+
             self.progress("Installing AmneziaWG...")
             try:
-                self.ssh.run(f"{apt} install -y amneziawg", sudo=True)
+                try:
+                    self._apt_install(missing, update=update, prepare=prepare)
+                except RemoteCommandError as exc:
+                    if "No space left" not in str(exc):
+                        raise
+                    self.progress("Package install failed, cleaning /boot and retrying...")
+                    self._clean_boot_partition()
+                    self._apt_install(missing, update=False, prepare="dpkg --configure -a || true", attempt=1)
             except RemoteCommandError as e:
                 # DKMS/initramfs failure - try to force load module
                 if "mkinitrd" in str(e) or "initramfs" in str(e) or "exit status" in str(e):
                     self.progress("DKMS failed, loading module manually...")
-                    self.ssh.run("dpkg --configure -a --force-confdef || true", sudo=True, check=False)
-                    self.ssh.run("modprobe amneziawg || true", sudo=True, check=False)
-                    if "not_found" in self.ssh.run("which awg || echo 'not_found'", check=False):
+                    out = self.ssh.run(
+                        "dpkg --configure -a --force-confdef || true; modprobe amneziawg || true; "
+                        "which awg || echo 'not_found'",
+                        sudo=True,
+                        check=False,
+                    )
+                    if "not_found" in out:
                         raise RuntimeError("AmneziaWG tools not installed. Try reinstalling VPS.")
                 else:
                     raise e
             return
-        
+
         if is_rhel:
             pm = self.ssh.run("command -v dnf >/dev/null && echo dnf || echo yum", check=False).strip() or "yum"
             self.ssh.run(f"{pm} copr enable -y amneziavpn/amneziawg || true", sudo=True, check=False)
             self.ssh.run(f"{pm} install -y amneziawg-dkms amneziawg-tools qrencode curl", sudo=True)
             return
-        
+
         raise RuntimeError(f"Unsupported distro for AmneziaWG: {distro}")
 
     def pre_check(self) -> list[dict]:
+        self._phase("Prechecks", announce=False)
         checks: list[dict] = []
         try:
             os_info = self.detect_os()
@@ -394,33 +1401,33 @@ class WireGuardProvisioner:
         )
         return checks
 
+    SYSCTL_CONF = "net.ipv4.ip_forward=1\nnet.ipv6.conf.all.forwarding=1\n"
+    SYSCTL_TUNING_CONF = (
+        "net.core.default_qdisc=fq\n"
+        "net.ipv4.tcp_congestion_control=bbr\n"
+        "net.core.rmem_max=26214400\n"
+        "net.core.wmem_max=26214400\n"
+        "net.core.rmem_default=2097152\n"
+        "net.core.wmem_default=2097152\n"
+        "net.ipv4.udp_rmem_min=16384\n"
+        "net.ipv4.udp_wmem_min=16384\n"
+        "net.ipv4.tcp_mtu_probing=1\n"
+    )
+
     def configure_sysctl(self) -> None:
         self.ssh.run(
-            "cat > /etc/sysctl.d/99-vpn-wizard.conf <<'EOF'\n"
-            "net.ipv4.ip_forward=1\n"
-            "net.ipv6.conf.all.forwarding=1\n"
-            "EOF",
+            f"cat > {self.SYSCTL_PATH} <<'EOF'\n{self.SYSCTL_CONF}EOF",
             sudo=True,
         )
         self.ssh.run("sysctl --system", sudo=True)
         if self.tune:
             self.ssh.run(
-                "cat > /etc/sysctl.d/99-vpn-wizard-tuning.conf <<'EOF'\n"
-                "net.core.default_qdisc=fq\n"
-                "net.ipv4.tcp_congestion_control=bbr\n"
-                "net.core.rmem_max=26214400\n"
-                "net.core.wmem_max=26214400\n"
-                "net.core.rmem_default=2097152\n"
-                "net.core.wmem_default=2097152\n"
-                "net.ipv4.udp_rmem_min=16384\n"
-                "net.ipv4.udp_wmem_min=16384\n"
-                "net.ipv4.tcp_mtu_probing=1\n"
-                "EOF",
+                f"cat > {self.SYSCTL_TUNING_PATH} <<'EOF'\n{self.SYSCTL_TUNING_CONF}EOF",
                 sudo=True,
             )
             self.ssh.run("modprobe tcp_bbr || true", sudo=True, check=False)
             self.ssh.run(
-                "sysctl -p /etc/sysctl.d/99-vpn-wizard-tuning.conf || true",
+                f"sysctl -p {self.SYSCTL_TUNING_PATH} || true",
                 sudo=True,
                 check=False,
             )
@@ -458,6 +1465,44 @@ class WireGuardProvisioner:
             )
         return postup, postdown
 
+    def _awg_params_text(self) -> str:
+        return (
+            f"Jc = {self.awg_jc}\n"
+            f"Jmin = {self.awg_jmin}\n"
+            f"Jmax = {self.awg_jmax}\n"
+            f"S1 = {self.awg_s1}\n"
+            f"S2 = {self.awg_s2}\n"
+            f"H1 = {self.awg_h1}\n"
+            f"H2 = {self.awg_h2}\n"
+            f"H3 = {self.awg_h3}\n"
+            f"H4 = {self.awg_h4}\n"
+        )
+
+    def _server_header(self, ifname: str, private_key: str, mtu: Optional[Union[int, str]]) -> str:
+        """[Interface] section setup writes; `private_key` may be a shell variable."""
+        postup, postdown = self._post_rules(ifname)
+        mtu_line = f"MTU = {mtu}\n" if mtu else ""
+        awg_params = self._awg_params_text() if ifname.startswith("awg") else ""
+        return (
+            "[Interface]\n"
+            f"Address = {self.server_cidr}\n"
+            f"ListenPort = {self.listen_port}\n"
+            f"PrivateKey = {private_key}\n"
+            f"{mtu_line}"
+            f"{awg_params}"
+            f"PostUp = {postup}\n"
+            f"PostDown = {postdown}\n"
+        )
+
+    def _nat_block(self) -> str:
+        return (
+            f"{self.NAT_MARKER}\n"
+            "*nat\n"
+            ":POSTROUTING ACCEPT [0:0]\n"
+            f"-A POSTROUTING -s {self.server_cidr} -j MASQUERADE\n"
+            "COMMIT\n"
+        )
+
     def _resolve_listen_port(self, conf_path: str) -> int:
         port = self.ssh.run(
             f"awk -F'= ' '/^ListenPort/{{print $2; exit}}' {conf_path} 2>/dev/null || true",
@@ -491,10 +1536,7 @@ class WireGuardProvisioner:
         client = self.client_name
         port = self.listen_port
         resolved_mtu = self.resolve_mtu()
-        mtu_line = f"MTU = {resolved_mtu}\n" if resolved_mtu else ""
-        mtu_line_client = f"MTU = {resolved_mtu}\n" if resolved_mtu else ""
         allowed_ips = self._allowed_ips()
-        postup, postdown = self._post_rules("wg0")
         
         # Detect interface reliably
         iface = self.ssh.run("ip -4 route get 1.1.1.1 | awk '{print $5; exit}'", check=False).strip()
@@ -505,7 +1547,7 @@ class WireGuardProvisioner:
         if not self.client_ip:
             self.client_ip = self.next_client_ip()
 
-        self.backup_config()
+        self.backup_config("setup")
         self.ssh.run(
             "if [ ! -f /etc/wireguard/server_private.key ]; then\n"
             "  umask 077\n"
@@ -525,14 +1567,8 @@ class WireGuardProvisioner:
             "server_priv=$(cat /etc/wireguard/server_private.key)\n"
             f"client_pub=$(cat /etc/wireguard/clients/{client}.pub)\n"
             "cat > /etc/wireguard/wg0.conf <<EOF\n"
-            "[Interface]\n"
-            f"Address = {self.server_cidr}\n"
-            f"ListenPort = {port}\n"
-            "PrivateKey = $server_priv\n"
-            f"{mtu_line}"
-            f"PostUp = {postup}\n"
-            f"PostDown = {postdown}\n"
-            "\n"
+            + self._server_header("wg0", "$server_priv", resolved_mtu)
+            + "\n"
             "[Peer]\n"
             "PublicKey = $client_pub\n"
             f"AllowedIPs = {self.client_ip}\n"
@@ -546,18 +1582,11 @@ class WireGuardProvisioner:
             "server_pub=$(cat /etc/wireguard/server_public.key)\n"
             f"public_ip={self.get_public_ip()}\n"
             f"cat > /etc/wireguard/clients/{client}.conf <<EOF\n"
-            "[Interface]\n"
-            "PrivateKey = $client_priv\n"
-            f"Address = {self.client_ip}\n"
-            f"DNS = {self.dns}\n"
-            f"{mtu_line_client}"
-            "\n"
-            "[Peer]\n"
-            "PublicKey = $server_pub\n"
-            f"Endpoint = $public_ip:{port}\n"
-            f"AllowedIPs = {allowed_ips}\n"
-            "PersistentKeepalive = 15\n"
-            "EOF\n"
+            + self._client_config_text(
+                "$client_priv", self.client_ip, self.dns, resolved_mtu, "", "$server_pub",
+                f"$public_ip:{port}", allowed_ips,
+            )
+            + "EOF\n"
             f"chmod 600 /etc/wireguard/clients/{client}.conf",
             sudo=True,
         )
@@ -568,30 +1597,17 @@ class WireGuardProvisioner:
         client = self.client_name
         port = self.listen_port
         resolved_mtu = self.resolve_mtu()
-        mtu_line = f"MTU = {resolved_mtu}\n" if resolved_mtu else ""
-        mtu_line_client = f"MTU = {resolved_mtu}\n" if resolved_mtu else ""
         allowed_ips = self._allowed_ips()
-        postup, postdown = self._post_rules("awg0")
         
         # Resolve client IP if not set (prevent None/null in config)
         if not self.client_ip:
             self.client_ip = self.next_client_ip()
         
         # AWG obfuscation params block
-        awg_params = (
-            f"Jc = {self.awg_jc}\n"
-            f"Jmin = {self.awg_jmin}\n"
-            f"Jmax = {self.awg_jmax}\n"
-            f"S1 = {self.awg_s1}\n"
-            f"S2 = {self.awg_s2}\n"
-            f"H1 = {self.awg_h1}\n"
-            f"H2 = {self.awg_h2}\n"
-            f"H3 = {self.awg_h3}\n"
-            f"H4 = {self.awg_h4}\n"
-        )
+        awg_params = self._awg_params_text()
         
         self.ssh.run("mkdir -p /etc/amnezia/amneziawg/clients", sudo=True)
-        self.backup_config()
+        self.backup_config("setup")
         
         # Generate server keys using awg command
         self.ssh.run(
@@ -617,15 +1633,8 @@ class WireGuardProvisioner:
             "server_priv=$(cat /etc/amnezia/amneziawg/server_private.key)\n"
             f"client_pub=$(cat /etc/amnezia/amneziawg/clients/{client}.pub)\n"
             "cat > /etc/amnezia/amneziawg/awg0.conf <<EOF\n"
-            "[Interface]\n"
-            f"Address = {self.server_cidr}\n"
-            f"ListenPort = {port}\n"
-            "PrivateKey = $server_priv\n"
-            f"{mtu_line}"
-            f"{awg_params}"
-            f"PostUp = {postup}\n"
-            f"PostDown = {postdown}\n"
-            "\n"
+            + self._server_header("awg0", "$server_priv", resolved_mtu)
+            + "\n"
             "[Peer]\n"
             "PublicKey = $client_pub\n"
             f"AllowedIPs = {self.client_ip}\n"
@@ -641,19 +1650,11 @@ class WireGuardProvisioner:
             "server_pub=$(cat /etc/amnezia/amneziawg/server_public.key)\n"
             f"public_ip={self.get_public_ip()}\n"
             f"cat > /etc/amnezia/amneziawg/clients/{client}.conf <<EOF\n"
-            "[Interface]\n"
-            "PrivateKey = $client_priv\n"
-            f"Address = {self.client_ip}\n"
-            f"DNS = {self.dns}\n"
-            f"{mtu_line_client}"
-            f"{awg_params}"
-            "\n"
-            "[Peer]\n"
-            "PublicKey = $server_pub\n"
-            f"Endpoint = $public_ip:{port}\n"
-            f"AllowedIPs = {allowed_ips}\n"
-            "PersistentKeepalive = 15\n"
-            "EOF\n"
+            + self._client_config_text(
+                "$client_priv", self.client_ip, self.dns, resolved_mtu, awg_params, "$server_pub",
+                f"$public_ip:{port}", allowed_ips,
+            )
+            + "EOF\n"
             f"chmod 600 /etc/amnezia/amneziawg/clients/{client}.conf",
             sudo=True,
         )
@@ -750,20 +1751,12 @@ class WireGuardProvisioner:
             
         # Ensure UFW before.rules has the NAT instruction. Use cat for safety.
         # We append to a temp file then concat if missing.
-        nat_marker = "# VPN Wizard NAT"
-        
-        nat_block = (
-            f"\n{nat_marker}\n"
-            f"*nat\n"
-            f":POSTROUTING ACCEPT [0:0]\n"
-            f"-A POSTROUTING -s {self.server_cidr} -j MASQUERADE\n"
-            f"COMMIT\n"
-        )
+        nat_marker = self.NAT_MARKER
         
         # Python f-string newlines + ssh run is tricky with quotes.
         # We'll use a temp file on the server.
         self.ssh.run(
-            f"cat > /tmp/vpn_wizard_nat_rules <<EOF{nat_block}EOF", 
+            f"cat > /tmp/vpn_wizard_nat_rules <<EOF\n{self._nat_block()}EOF", 
             sudo=True, 
             check=False
         )
@@ -793,70 +1786,105 @@ class WireGuardProvisioner:
     def start_service(self) -> None:
         self.ssh.run("systemctl enable --now wg-quick@wg0", sudo=True)
 
+    def _drive(self, ops: Ops[T]) -> T:
+        return run_ops(self.ssh, ops)
+
     def export_client_config(self) -> str:
+        return self._drive(self._export_client_config_ops())
+
+    def _export_client_config_ops(self) -> Ops[str]:
         if self.protocol == "amneziawg":
-            return self.ssh.run(
-                f"cat /etc/amnezia/amneziawg/clients/{self.client_name}.conf", sudo=True, pty=False
-            )
-        return self.ssh.run(
-            f"cat /etc/wireguard/clients/{self.client_name}.conf", sudo=True, pty=False
-        )
+            path = f"/etc/amnezia/amneziawg/clients/{self.client_name}.conf"
+        else:
+            path = f"/etc/wireguard/clients/{self.client_name}.conf"
+        return (yield Command(f"cat {path}", sudo=True, pty=False))
 
     def _auto_detect_protocol(self) -> None:
+        self._drive(self._detect_protocol_ops())
+
+    def _detect_protocol_ops(self) -> Ops[None]:
         awg_path = "/etc/amnezia/amneziawg/awg0.conf"
         wg_path = "/etc/wireguard/wg0.conf"
-        has_awg = (
-            self.ssh.run(f"test -f {awg_path} && echo yes || echo no", sudo=True, check=False).strip()
-            == "yes"
-        )
-        has_wg = (
-            self.ssh.run(f"test -f {wg_path} && echo yes || echo no", sudo=True, check=False).strip()
-            == "yes"
-        )
+        found = (
+            yield Command(
+                f"test -f {awg_path} && echo awg; test -f {wg_path} && echo wg; true",
+                sudo=True,
+                check=False,
+            )
+        ).split()
+        self._pick_protocol("awg" in found, "wg" in found)
+
+    def _pick_protocol(self, has_awg: bool, has_wg: bool) -> None:
         if self.protocol == "amneziawg" and not has_awg and has_wg:
             self.protocol = "wireguard"
         elif self.protocol != "amneziawg" and not has_wg and has_awg:
             self.protocol = "amneziawg"
 
     def export_client(self, client_name: str) -> dict:
-        self._validate_client_name(client_name)
-        self._auto_detect_protocol()
-        if self.protocol == "amneziawg":
-            candidates = [
-                ("/etc/amnezia/amneziawg/clients", "awg0"),
-                ("/etc/amnezia/amneziawg/clients_tyumen", "awg1"),
-            ]
-        else:
-            candidates = [("/etc/wireguard/clients", "wg0")]
-
-        for clients_dir, iface in candidates:
-            exists = self.ssh.run(
-                f"test -f {clients_dir}/{client_name}.conf && echo yes || echo no",
-                sudo=True,
-                check=False,
-            ).strip()
-            if exists != "yes":
-                continue
+        return self._drive(self._export_client_ops(client_name))
 
-            conf = self.ssh.run(
-                f"cat {clients_dir}/{client_name}.conf", sudo=True, check=False, pty=False
+    def _export_client_ops(self, client_name: str) -> Ops[dict]:
+        self._validate_client_name(client_name)
+        entry = yield from self._find_client_ops(name=client_name)
+        if entry is None:
+            raise RuntimeError("Client not found.")
+        clients_dir = self.CLIENT_DIRS[entry["interface"]]
+        conf = yield Command(f"cat {clients_dir}/{client_name}.conf", sudo=True, check=False, pty=False)
+        return {
+            "name": client_name,
+            "ip": entry["ip"],
+            "public_key": entry["public_key"],
+            "config": conf,
+            "interface": entry["interface"],
+        }
+
+    def export_all_clients(self) -> list[dict]:
+        return self._drive(self._export_all_clients_ops())
+
+    def _export_all_clients_ops(self) -> Ops[list[dict]]:
+        """Every client's config and public key in one round trip, in export_client's shape."""
+        yield from self._detect_protocol_ops()
+        script = ["set +e"]
+        for clients_dir, iface in self._client_dirs():
+            script.append(
+                f"for f in {clients_dir}/*.conf; do\n"
+                '  [ -f "$f" ] || continue\n'
+                f'  echo "@@client {iface} $f"; cat "$f"; echo\n'
+                '  echo "@@pub"; cat "${f%.conf}.pub" 2>/dev/null; echo\n'
+                "done"
             )
-            pub = self.ssh.run(
-                f"cat {clients_dir}/{client_name}.pub", sudo=True, check=False, pty=False
-            ).strip()
-            ip = ""
+        script.append("true")
+        raw = yield Command("\n".join(script), sudo=True, check=False, pty=False)
+
+        clients: list[dict] = []
+        target = "config"
+        for line in raw.splitlines():
+            if line.startswith("@@client "):
+                _, iface, path = line.split(" ", 2)
+                clients.append(
+                    {
+                        "name": path.rsplit("/", 1)[-1].removesuffix(".conf"),
+                        "ip": "",
+                        "public_key": "",
+                        "config": [],
+                        "interface": iface,
+                    }
+                )
+                target = "config"
+            elif line == "@@pub":
+                target = "public_key"
+            elif clients and target == "config":
+                clients[-1]["config"].append(line)
+            elif clients and line.strip():
+                clients[-1]["public_key"] = line.strip()
+        for client in clients:
+            conf = "\n".join(client["config"]).strip()
+            client["config"] = conf
             for line in conf.splitlines():
                 if line.startswith("Address"):
-                    ip = line.split("=", 1)[1].strip()
+                    client["ip"] = line.split("=", 1)[1].strip()
                     break
-            return {
-                "name": client_name,
-                "ip": ip,
-                "public_key": pub,
-                "config": conf,
-                "interface": iface,
-            }
-        raise RuntimeError("Client not found.")
+        return clients
 
     def _parse_wg_show(self, output: str) -> dict[str, dict]:
         peers: dict[str, dict] = {}
@@ -884,65 +1912,174 @@ class WireGuardProvisioner:
                     peers[current]["transfer_tx"] = tx
         return peers
 
-    def list_clients(self) -> list[dict]:
-        self._auto_detect_protocol()
+    def _client_dirs(self) -> list[tuple[str, str]]:
         if self.protocol == "amneziawg":
-            dirs = [("/etc/amnezia/amneziawg/clients", "awg0")]
-            tyumen_probe = self.ssh.run(
-                "ls /etc/amnezia/amneziawg/clients_tyumen/*.conf 2>/dev/null | head -n 1 || true",
-                sudo=True,
-                check=False,
-            ).strip()
-            if tyumen_probe:
-                dirs.append(("/etc/amnezia/amneziawg/clients_tyumen", "awg1"))
+            return [
+                ("/etc/amnezia/amneziawg/clients", "awg0"),
+                ("/etc/amnezia/amneziawg/clients_tyumen", "awg1"),
+            ]
+        return [("/etc/wireguard/clients", "wg0")]
+
+    def _client_index_script(self, known: str) -> str:
+        # The index is rebuilt when missing or when a client dir changed since it was
+        # written (mutations also delete it). Its content hash lets a caller holding
+        # the same version skip the transfer.
+        entries = " ".join(f"{clients_dir}:{iface}" for iface, clients_dir in self.CLIENT_DIRS.items())
+        idx = self.CLIENT_INDEX_PATH
+        return (
+            "set +e\n"
+            "test -f /etc/amnezia/amneziawg/awg0.conf && echo '@@proto awg'\n"
+            "test -f /etc/wireguard/wg0.conf && echo '@@proto wg'\n"
+            f"entries='{entries}'\n"
+            "sig='# index'\n"
+            "for entry in $entries; do\n"
+            '  d=${entry%%:*}\n'
+            '  [ -d "$d" ] && sig="$sig ${entry##*:}=$(stat -c %Y "$d")"\n'
+            "done\n"
+            f'if [ "$(head -n 1 {idx} 2>/dev/null)" != "$sig" ]; then\n'
+            f"  mkdir -p {os.path.dirname(idx)}\n"
+            "  tmp=$(mktemp)\n"
+            '  echo "$sig" > "$tmp"\n'
+            "  for entry in $entries; do\n"
+            '    d=${entry%%:*}\n'
+            '    for conf in "$d"/*.conf; do\n'
+            '      [ -f "$conf" ] || continue\n'
+            '      name=$(basename "$conf" .conf)\n'
+            "      ip=$(grep -m1 '^Address' \"$conf\" | cut -d= -f2- | tr -d ' \\r')\n"
+            '      pub=$(cat "$d/$name.pub" 2>/dev/null)\n'
+            "      printf '%s\\t%s\\t%s\\t%s\\t%s\\n' \"$name\" \"${entry##*:}\" \"$ip\" \"$pub\" "
+            '"$(stat -c %Y "$conf")" >> "$tmp"\n'
+            "    done\n"
+            "  done\n"
+            f'  mv "$tmp" {idx}\n'
+            "fi\n"
+            f"sum=$(md5sum < {idx} | cut -c1-32)\n"
+            f'if [ "$sum" = "{known}" ]; then echo "@@same $sum"; else echo "@@index $sum"; tail -n +2 {idx}; fi'
+        )
 
-            stats_by_iface = {
-                "awg0": self._parse_wg_show(
-                    self.ssh.run("awg show awg0 || true", sudo=True, check=False)
-                )
-            }
-            if any(item[1] == "awg1" for item in dirs):
-                stats_by_iface["awg1"] = self._parse_wg_show(
-                    self.ssh.run("awg show awg1 || true", sudo=True, check=False)
-                )
-        else:
-            dirs = [("/etc/wireguard/clients", "wg0")]
-            stats_by_iface = {
-                "wg0": self._parse_wg_show(
-                    self.ssh.run("wg show wg0 || true", sudo=True, check=False)
+    def client_index(self) -> ClientIndex:
+        return self._drive(self._client_index_ops())
+
+    def _client_index_ops(self) -> Ops[ClientIndex]:
+        """The host's client index in one round trip; also detects the protocol.
+
+        The last version seen is kept in the local backend, so an unchanged index is
+        answered with its hash only.
+        """
+        key = f"client-index:{self.host_key()}"
+        cache = self.lock_backend or get_backend()
+        cached = cache.get(key) or {}
+        raw = yield Command(
+            self._client_index_script(cached.get("sum", "")), sudo=True, check=False, pty=False
+        )
+        protocols: set[str] = set()
+        rows: Optional[list[dict]] = None
+        for line in raw.splitlines():
+            if line.startswith("@@proto "):
+                protocols.add(line.split(" ", 1)[1].strip())
+            elif line.startswith("@@same "):
+                rows = cached.get("rows", [])
+            elif line.startswith("@@index "):
+                digest = line.split(" ", 1)[1].strip()
+                rows = []
+            elif rows is not None and line.strip():
+                fields = (line.split("\t") + [""] * 5)[:5]
+                name, iface, ip, pub, mtime = (field.strip() for field in fields)
+                rows.append(
+                    {
+                        "name": name,
+                        "interface": iface,
+                        "ip": ip,
+                        "public_key": pub,
+                        "mtime": int(mtime) if mtime.isdigit() else None,
+                    }
                 )
-            }
+        self._pick_protocol("awg" in protocols, "wg" in protocols)
+        if rows is None:
+            raise RuntimeError("Could not read the client index.")
+        if "@@index " in raw:
+            cache.set(key, {"sum": digest, "rows": rows})
+        return ClientIndex(rows)
+
+    def find_client(
+        self, name: Optional[str] = None, public_key: Optional[str] = None, ip: Optional[str] = None
+    ) -> Optional[dict]:
+        """Look a client up by name, public key or address (one round trip)."""
+        return self._drive(self._find_client_ops(name, public_key, ip))
+
+    def _find_client_ops(
+        self, name: Optional[str] = None, public_key: Optional[str] = None, ip: Optional[str] = None
+    ) -> Ops[Optional[dict]]:
+        index = yield from self._client_index_ops()
+        return index.find(name, public_key, ip, interfaces=[iface for _, iface in self._client_dirs()])
+
+    def _forget_client_index(self) -> str:
+        """Shell snippet invalidating the server-side index after client files change."""
+        return f"rm -f {self.CLIENT_INDEX_PATH}"
 
-        clients = []
-        for clients_dir, iface in dirs:
-            raw = self.ssh.run(
-                f"ls {clients_dir}/*.conf 2>/dev/null || true", sudo=True, check=False
+    def list_clients(self) -> list[dict]:
+        return self._drive(self._list_clients_ops())
+
+    def _list_clients_ops(self) -> Ops[list[dict]]:
+        yield from self._detect_protocol_ops()
+        show = "awg show" if self.protocol == "amneziawg" else "wg show"
+        # One round trip for every interface: first Address line and public key of each
+        # client plus the live peer stats, regardless of how many clients exist.
+        script = ["set +e"]
+        for clients_dir, iface in self._client_dirs():
+            script.append(
+                f"if ls {clients_dir}/*.conf >/dev/null 2>&1; then\n"
+                f"  echo '@@iface {iface}'\n"
+                f"  ls -1 {clients_dir}/*.conf 2>/dev/null | sed 's/^/@@conf /'\n"
+                f"  grep -H -m1 '^Address' {clients_dir}/*.conf 2>/dev/null | sed 's/^/@@addr /'\n"
+                f"  grep -H '' {clients_dir}/*.pub 2>/dev/null | sed 's/^/@@pub /'\n"
+                "  echo '@@show'\n"
+                f"  {show} {iface} 2>/dev/null\n"
+                "fi"
             )
-            names = []
-            for line in raw.splitlines():
-                if not line.strip():
-                    continue
-                name = line.strip().split("/")[-1].removesuffix(".conf")
-                names.append(name)
-
-            for name in names:
-                conf = self.ssh.run(
-                    f"cat {clients_dir}/{name}.conf", sudo=True, check=False, pty=False
-                )
-                pub = self.ssh.run(
-                    f"cat {clients_dir}/{name}.pub", sudo=True, check=False, pty=False
-                ).strip()
-                ip = ""
-                for line in conf.splitlines():
-                    if line.startswith("Address"):
-                        ip = line.split("=", 1)[1].strip()
-                        break
-                stats = stats_by_iface.get(iface, {}).get(pub, {})
+        script.append("true")
+        raw = yield Command("\n".join(script), sudo=True, check=False, pty=False)
+
+        order: list[str] = []
+        names: dict[str, list[str]] = {}
+        ips: dict[tuple[str, str], str] = {}
+        pubs: dict[tuple[str, str], str] = {}
+        show_lines: dict[str, list[str]] = {}
+        iface = ""
+        in_show = False
+        for line in raw.splitlines():
+            if line.startswith("@@iface "):
+                iface = line.split(" ", 1)[1].strip()
+                order.append(iface)
+                names[iface] = []
+                show_lines[iface] = []
+                in_show = False
+            elif line.startswith("@@show"):
+                in_show = True
+            elif in_show:
+                show_lines[iface].append(line)
+            elif line.startswith("@@conf "):
+                names[iface].append(line.strip().split("/")[-1].removesuffix(".conf"))
+            elif line.startswith("@@addr ") or line.startswith("@@pub "):
+                kind, rest = line.split(" ", 1)
+                path, _, value = rest.partition(":")
+                name = path.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+                if kind == "@@addr":
+                    ips[(iface, name)] = value.split("=", 1)[1].strip() if "=" in value else ""
+                else:
+                    pubs[(iface, name)] = value.strip()
+
+        clients = []
+        for iface in order:
+            stats_by_pub = self._parse_wg_show("\n".join(show_lines[iface]))
+            for name in names[iface]:
+                entry = {"ip": ips.get((iface, name), ""), "pub": pubs.get((iface, name), "")}
+                stats = stats_by_pub.get(entry["pub"], {})
                 clients.append(
                     {
                         "name": name,
-                        "ip": ip,
-                        "public_key": pub,
+                        "ip": entry["ip"],
+                        "public_key": entry["pub"],
                         "endpoint": stats.get("endpoint"),
                         "latest_handshake": stats.get("latest_handshake"),
                         "transfer_rx": stats.get("transfer_rx"),
@@ -952,24 +2089,16 @@ class WireGuardProvisioner:
                 )
         return clients
 
+    @_exclusive
     def add_client(self, client_name: Optional[str] = None, client_ip: Optional[str] = None) -> dict:
         name = (client_name or self.next_client_name()).strip()
         self._validate_client_name(name)
         is_tyumen = name.lower().startswith("tyumen")
         
         # Auto-detect protocol if config is missing (robustness against frontend defaults)
-        # Check standard paths
-        awg_path = "/etc/amnezia/amneziawg/awg0.conf"
-        wg_path = "/etc/wireguard/wg0.conf"
-        
-        has_awg = self.ssh.run(f"test -f {awg_path} && echo yes || echo no", sudo=True, check=False).strip() == "yes"
-        has_wg = self.ssh.run(f"test -f {wg_path} && echo yes || echo no", sudo=True, check=False).strip() == "yes"
-        
-        if self.protocol == "amneziawg" and not has_awg and has_wg:
-             self.protocol = "wireguard"
-        elif self.protocol != "amneziawg" and not has_wg and has_awg:
-             self.protocol = "amneziawg"
-        
+        self._auto_detect_protocol()
+        self._backup_before_peer_change()
+
         # Protocol-specific paths and commands
         if self.protocol == "amneziawg":
             # Tyumen "Magic" Interface Logic
@@ -979,7 +2108,6 @@ class WireGuardProvisioner:
                 clients_dir = f"{conf_dir}/clients_tyumen"
                 cmd_genkey = "awg genkey"
                 cmd_pubkey = "awg pubkey"
-                rebuild_cmd = self.rebuild_awg1_from_clients
                 self.server_cidr = "10.11.0.1/24" # Tyumen subnet
                 # Mutate obfuscation params for Tyumen to be different from default
                 self.awg_jc += 1
@@ -995,14 +2123,12 @@ class WireGuardProvisioner:
                 clients_dir = f"{conf_dir}/clients"
                 cmd_genkey = "awg genkey"
                 cmd_pubkey = "awg pubkey"
-                rebuild_cmd = self.rebuild_awg0_from_clients
         else:
             conf_dir = "/etc/wireguard"
             wg_conf = f"{conf_dir}/wg0.conf"
             clients_dir = f"{conf_dir}/clients"
             cmd_genkey = "wg genkey"
             cmd_pubkey = "wg pubkey"
-            rebuild_cmd = self.rebuild_wg0_from_clients
 
         # Final check
         has_conf = self.ssh.run(
@@ -1047,7 +2173,6 @@ class WireGuardProvisioner:
             
         ip = client_ip or self.next_client_ip()
         resolved_mtu = self.resolve_mtu()
-        mtu_line = f"MTU = {resolved_mtu}\n" if resolved_mtu else ""
         listen_port = self._resolve_listen_port(wg_conf)
         dns_value = self._resolve_dns(clients_dir)
         allowed_ips = self._resolve_allowed_ips(clients_dir)
@@ -1122,75 +2247,210 @@ class WireGuardProvisioner:
             f"server_pub=$(cat {server_pub_path})\n"
             f"public_ip={self.get_public_ip()}\n"
             f"cat > {clients_dir}/{name}.conf <<EOF\n"
+            + self._client_config_text(
+                "$client_priv", ip, dns_value, resolved_mtu, awg_params, "$server_pub",
+                f"$public_ip:{listen_port}", allowed_ips,
+            )
+            + "EOF\n"
+            f"chmod 600 {clients_dir}/{name}.conf\n"
+            f"{self._forget_client_index()}",
+            sudo=True,
+        )
+        
+        iface_name = "wg0"
+        if self.protocol == "amneziawg":
+            iface_name = "awg1" if is_tyumen else "awg0"
+        self._apply_peers(iface_name)
+
+        config = self.ssh.run(
+            f"cat {clients_dir}/{name}.conf", sudo=True, pty=False
+        )
+        return {"name": name, "ip": ip, "config": config, "interface": iface_name}
+
+    @staticmethod
+    def _client_config_text(
+        private_key: str,
+        address: str,
+        dns: str,
+        mtu: Optional[Union[int, str]],
+        awg_params: str,
+        server_pub: str,
+        endpoint: str,
+        allowed_ips: str,
+    ) -> str:
+        mtu_line = f"MTU = {mtu}\n" if mtu else ""
+        return (
             "[Interface]\n"
-            "PrivateKey = $client_priv\n"
-            f"Address = {ip}\n"
-            f"DNS = {dns_value}\n"
+            f"PrivateKey = {private_key}\n"
+            f"Address = {address}\n"
+            f"DNS = {dns}\n"
             f"{mtu_line}"
             f"{awg_params}"
             "\n"
             "[Peer]\n"
-            "PublicKey = $server_pub\n"
-            f"Endpoint = $public_ip:{listen_port}\n"
+            f"PublicKey = {server_pub}\n"
+            f"Endpoint = {endpoint}\n"
             f"AllowedIPs = {allowed_ips}\n"
             "PersistentKeepalive = 15\n"
-            "EOF\n"
-            f"chmod 600 {clients_dir}/{name}.conf",
-            sudo=True,
         )
-        
-        self.backup_config()
-        rebuild_cmd()
-        
-        config = self.ssh.run(
-            f"cat {clients_dir}/{name}.conf", sudo=True, pty=False
-        )
-        iface_name = "wg0"
-        if self.protocol == "amneziawg":
-            iface_name = "awg1" if is_tyumen else "awg0"
-        return {"name": name, "ip": ip, "config": config, "interface": iface_name}
 
+    @_exclusive
     def remove_client(self, client_name: str) -> bool:
         self._validate_client_name(client_name)
-        self._auto_detect_protocol()
-        is_tyumen = client_name.lower().startswith("tyumen")
-
-        if self.protocol == "amneziawg":
-            if is_tyumen:
-                clients_dir = "/etc/amnezia/amneziawg/clients_tyumen"
-                rebuild_cmd = self.rebuild_awg1_from_clients
-            else:
-                clients_dir = "/etc/amnezia/amneziawg/clients"
-                rebuild_cmd = self.rebuild_awg0_from_clients
-        else:
-            clients_dir = "/etc/wireguard/clients"
-            rebuild_cmd = self.rebuild_wg0_from_clients
-
-        exists = self.ssh.run(
-            f"test -f {clients_dir}/{client_name}.conf && echo yes || echo no",
-            sudo=True,
-            check=False,
-        ).strip()
-        if exists != "yes":
+        entry = self.find_client(name=client_name)
+        if entry is None:
             return False
-            
+        self._backup_before_peer_change()
+        self._remove_client_files(entry)
+        return True
+
+    def _remove_client_files(self, entry: dict) -> None:
+        clients_dir = self.CLIENT_DIRS[entry["interface"]]
+        name = entry["name"]
         self.ssh.run(
-            f"rm -f {clients_dir}/{client_name}.conf "
-            f"{clients_dir}/{client_name}.key "
-            f"{clients_dir}/{client_name}.pub",
+            f"rm -f {clients_dir}/{name}.conf {clients_dir}/{name}.key {clients_dir}/{name}.pub\n"
+            f"{self._forget_client_index()}",
             sudo=True,
         )
-        self.backup_config()
-        rebuild_cmd()
-        return True
+        self._apply_peers(entry["interface"])
 
+    @_exclusive
     def rotate_client(self, client_name: str) -> dict:
+        """Give a client a new keypair, swapping its peer in place.
+
+        One remote script generates the keys, rewrites the client's files and the
+        peer's PublicKey in the interface config, replaces the peer on the running
+        interface with `wg set` (no restart) and takes the backup. Any failure restores
+        the previous files and peer. If the interface config does not list the peer
+        yet (e.g. an add still waiting in the apply queue), the usual rebuild applies
+        the new key instead.
+        """
         self._validate_client_name(client_name)
-        current_ip = self._get_client_ip(client_name)
-        if not current_ip:
+        entry = self.find_client(name=client_name)
+        if entry is None or not entry["ip"]:
             raise RuntimeError("Client not found.")
-        self.remove_client(client_name)
-        return self.add_client(client_name=client_name, client_ip=current_ip)
+        if not entry["public_key"]:
+            # Without the old public key the peer cannot be swapped in place.
+            self._backup_before_peer_change()
+            self._peers_backed_up = True  # one snapshot for the remove and the re-add
+            try:
+                self._remove_client_files(entry)
+                return self.add_client(client_name=client_name, client_ip=entry["ip"])
+            finally:
+                self._peers_backed_up = False
+        out = self.ssh.run(self._rotate_script(entry), sudo=True, pty=False)
+        mode, config = "", ""
+        lines = out.splitlines()
+        for idx, line in enumerate(lines):
+            if line in ("@@live", "@@rebuild"):
+                mode = line[2:]
+            elif line == "@@conf" and idx + 1 < len(lines):
+                config = base64.b64decode(lines[idx + 1].strip()).decode("utf-8", "replace")
+        iface = entry["interface"]
+        self._backup_result(out)
+        if mode == "rebuild":
+            self._apply_peers(iface)
+        else:
+            self.last_apply = Future()
+            self.last_apply.set_result([iface])
+        return {"name": client_name, "ip": entry["ip"], "config": config, "interface": iface}
+
+    def _rotate_script(self, entry: dict) -> str:
+        iface = entry["interface"]
+        tool = "awg" if iface.startswith("awg") else "wg"
+        ifconf = f"{os.path.dirname(self.CLIENT_DIRS[iface])}/{iface}.conf"
+        backup = f"backup=$( ( {self._backup_script('peers')} ) || true)\n" if self._needs_peer_backup() else ""
+        return (
+            "set -e\n"
+            "umask 077\n"
+            + backup
+            + f"dir={self.CLIENT_DIRS[iface]}; name={entry['name']}; iface={iface}; ifconf={ifconf}\n"
+            f"ip={shlex.quote(entry['ip'])}\n"
+            'conf="$dir/$name.conf"\n'
+            "stage=$(mktemp -d)\n"
+            "live=0\n"
+            'cp -p "$conf" "$dir/$name.pub" "$ifconf" "$stage/"\n'
+            '[ ! -f "$dir/$name.key" ] || cp -p "$dir/$name.key" "$stage/"\n'
+            "rollback() {\n"
+            '  for f in "$name.conf" "$name.pub" "$name.key"; do\n'
+            '    [ ! -f "$stage/$f" ] || cp -p "$stage/$f" "$dir/$f"\n'
+            "  done\n"
+            '  cp -p "$stage/$(basename "$ifconf")" "$ifconf"\n'
+            '  rm -f "$conf.new" "$dir/$name.key.new" "$dir/$name.pub.new" "$ifconf.new"\n'
+            '  if [ "$live" = 1 ]; then\n'
+            f'    {tool} set "$iface" peer "$new_pub" remove 2>/dev/null || true\n'
+            f'    {tool} set "$iface" peer "$old_pub" allowed-ips "$ip" || true\n'
+            "  fi\n"
+            "}\n"
+            "trap 'rc=$?; [ $rc -eq 0 ] || rollback; rm -rf \"$stage\"; exit $rc' EXIT\n"
+            'old_pub=$(cat "$dir/$name.pub")\n'
+            f"new_priv=$({tool} genkey)\n"
+            f"new_pub=$(printf '%s\\n' \"$new_priv\" | {tool} pubkey)\n"
+            '[ -n "$new_priv" ] && [ -n "$new_pub" ]\n'
+            'sed "s|^PrivateKey = .*|PrivateKey = $new_priv|" "$conf" > "$conf.new"\n'
+            "printf '%s\\n' \"$new_priv\" > \"$dir/$name.key.new\"\n"
+            "printf '%s\\n' \"$new_pub\" > \"$dir/$name.pub.new\"\n"
+            'if grep -qxF "PublicKey = $old_pub" "$ifconf"; then\n'
+            '  sed "s|^PublicKey = $old_pub\\$|PublicKey = $new_pub|" "$ifconf" > "$ifconf.new"\n'
+            '  mv "$ifconf.new" "$ifconf"\n'
+            "  mode=live\n"
+            "else\n"
+            "  mode=rebuild\n"
+            "fi\n"
+            'mv "$conf.new" "$conf"\n'
+            'mv "$dir/$name.key.new" "$dir/$name.key"\n'
+            'mv "$dir/$name.pub.new" "$dir/$name.pub"\n'
+            f"{self._forget_client_index()}\n"
+            f'if [ "$mode" = live ] && {tool} show "$iface" >/dev/null 2>&1; then\n'
+            "  live=1\n"
+            f'  {tool} set "$iface" peer "$old_pub" remove\n'
+            f'  {tool} set "$iface" peer "$new_pub" allowed-ips "$ip"\n'
+            "fi\n"
+            "trap - EXIT\n"
+            'rm -rf "$stage"\n'
+            'echo "@@$mode"\n'
+            'echo "@@conf"\n'
+            'base64 -w0 "$conf"\n'
+            "echo\n"
+            '[ -z "${backup:-}" ] || echo "$backup"'
+        )
+
+    def _needs_peer_backup(self) -> bool:
+        # A pending apply batch was snapshotted before its first change.
+        if self._peers_backed_up:
+            return False
+        return self.apply_queue is None or self.host_key() not in self.apply_queue.pending()
+
+    def _backup_before_peer_change(self) -> None:
+        """Snapshot the config before client files change, so rollback can undo it."""
+        if self._needs_peer_backup():
+            self.backup_config("peers")
+
+    def _apply_peers(self, interface: str) -> None:
+        """Make client file changes live now, or hand them to the apply queue."""
+        if self.apply_queue is not None:
+            self.last_apply = self.apply_queue.schedule(self, interface)
+            return
+        self._rebuild_interface(interface)
+        self.last_apply = Future()
+        self.last_apply.set_result([interface])
+
+    def _rebuild_interface(self, interface: str) -> None:
+        rebuilds = {
+            "wg0": self.rebuild_wg0_from_clients,
+            "awg0": self.rebuild_awg0_from_clients,
+            "awg1": self.rebuild_awg1_from_clients,
+        }
+        rebuilds[interface]()
+
+    @_exclusive
+    def apply_peer_changes(self, interfaces: Iterable[str]) -> None:
+        """One rebuild per interface for a batch of queued peer changes.
+
+        The batch's backup was taken before its first change (see `_needs_peer_backup`).
+        """
+        for interface in sorted(set(interfaces)):
+            self._rebuild_interface(interface)
 
     def rebuild_wg0_from_clients(self) -> None:
         self.ssh.run(
@@ -1326,72 +2586,188 @@ class WireGuardProvisioner:
         raise RuntimeError(f"No free IPs available in {self.server_cidr} subnet")
 
     def _get_client_ip(self, client_name: str) -> Optional[str]:
-        self._auto_detect_protocol()
-        if self.protocol == "amneziawg":
-            if client_name.lower().startswith("tyumen"):
-                clients_dir = "/etc/amnezia/amneziawg/clients_tyumen"
-            else:
-                clients_dir = "/etc/amnezia/amneziawg/clients"
-        else:
-            clients_dir = "/etc/wireguard/clients"
-
-        conf = self.ssh.run(
-            f"cat {clients_dir}/{client_name}.conf", sudo=True, check=False
-        )
-        if not conf:
-            return None
-        for line in conf.splitlines():
-            if line.startswith("Address"):
-                return line.split("=", 1)[1].strip()
-        return None
+        entry = self.find_client(name=client_name)
+        return (entry["ip"] or None) if entry else None
 
     def _validate_client_name(self, name: str) -> None:
         if not self._name_pattern.match(name):
             raise RuntimeError("Invalid client name. Use letters, numbers, dash, underscore.")
 
-    def backup_config(self) -> Optional[str]:
+    BACKUP_DIR = "/var/backups/vpn-wizard"
+    BACKUP_KEEP = int(os.getenv("VPNW_BACKUP_KEEP", "50"))
+    BACKUP_MAX_AGE_DAYS = int(os.getenv("VPNW_BACKUP_MAX_AGE_DAYS", "30"))
+    _backup_id_pattern = re.compile(r"^[0-9]{14}-[0-9a-f]{16}$")
+
+    def _backup_paths(self) -> tuple[str, str, str]:
+        """(parent dir, config dir name, service prefix) of what the backup store covers."""
         if self.protocol == "amneziawg":
-            conf_path = "/etc/amnezia/amneziawg/awg0.conf"
-            backup_prefix = "/etc/amnezia/amneziawg/awg0.conf.bak"
-        else:
-            conf_path = "/etc/wireguard/wg0.conf"
-            backup_prefix = "/etc/wireguard/wg0.conf.bak"
-
-        path = self.ssh.run(
-            f"if [ -f {conf_path} ]; then\n"
-            "  ts=$(date +%Y%m%d%H%M%S)\n"
-            f"  cp {conf_path} {backup_prefix}.$ts\n"
-            f"  echo {backup_prefix}.$ts\n"
-            "fi",
+            return "/etc/amnezia", "amneziawg", "awg-quick"
+        return "/etc", "wireguard", "wg-quick"
+
+    def _backup_hash_script(self) -> str:
+        # Content hash of the config dir (server confs, keys, client dirs), paths included.
+        parent, name, _ = self._backup_paths()
+        return (
+            f"sum=$(cd {parent} && find {name} -type f ! -name '*.bak.*' | LC_ALL=C sort "
+            "| xargs -r sha256sum | sha256sum | cut -c1-16)\n"
+        )
+
+    def _restore_script(self) -> str:
+        # Expects $store, $src and $target (a backup id) to be set.
+        _, name, service = self._backup_paths()
+        return (
+            "sum=$(grep \"^$target \" \"$store/index\" | tail -n 1 | cut -d' ' -f3)\n"
+            "tmp=$(mktemp -d)\n"
+            'tar -C "$tmp" -xzf "$store/objects/$sum.tar.gz"\n'
+            "find \"$src\" -mindepth 1 -maxdepth 1 ! -name '*.bak.*' -exec rm -rf {} +\n"
+            f'cp -a "$tmp/{name}/." "$src/"\n'
+            'rm -rf "$tmp"\n'
+            f"{self._forget_client_index()}\n"
+            'for conf in "$src"/*.conf; do\n'
+            '  [ -f "$conf" ] || continue\n'
+            f'  systemctl restart {service}@$(basename "$conf" .conf) || true\n'
+            "done\n"
+            'echo "$target"'
+        )
+
+    def backup_config(self, label: str = "config") -> Optional[str]:
+        """Snapshot the whole config dir into the backup store; returns the backup id.
+
+        Taken before each change, so the store holds the states changes can be undone to.
+        Snapshots are content-addressed: an unchanged config only returns the latest id,
+        and a config identical to an older snapshot reuses its archive. The index is
+        append-only, so the latest entry is its last line, and it is pruned to
+        BACKUP_KEEP entries younger than BACKUP_MAX_AGE_DAYS (the latest always stays).
+        """
+        out = self.ssh.run(self._backup_script(label), sudo=True, check=False).strip()
+        return self._backup_result(out)
+
+    def _backup_script(self, label: str) -> str:
+        parent, name, _ = self._backup_paths()
+        return (
+            "set -e\n"
+            "umask 077\n"
+            f"store={self.BACKUP_DIR}/{name}\n"
+            f"[ -d {parent}/{name} ] || exit 0\n"
+            'mkdir -p "$store/objects"\n'
+            'touch "$store/index"\n'
+            'rm -f "$store/rollback"\n'
+            + self._backup_hash_script()
+            + 'last=$(tail -n 1 "$store/index")\n'
+            'if [ -n "$last" ] && [ "$(echo "$last" | cut -d\' \' -f3)" = "$sum" ]; then\n'
+            '  echo "@@same $(echo "$last" | cut -d\' \' -f1)"\n'
+            "  exit 0\n"
+            "fi\n"
+            "now=$(date +%s)\n"
+            "id=$(date -u +%Y%m%d%H%M%S)-$sum\n"
+            'obj="$store/objects/$sum.tar.gz"\n'
+            'if [ ! -f "$obj" ]; then\n'
+            f"  tar -C {parent} --exclude='*.bak.*' -czf \"$obj.tmp\" {name}\n"
+            '  mv "$obj.tmp" "$obj"\n'
+            "fi\n"
+            f'echo "$id $now $sum {label}" >> "$store/index"\n'
+            f"cutoff=$((now - {self.BACKUP_MAX_AGE_DAYS} * 86400))\n"
+            f'tail -n {self.BACKUP_KEEP} "$store/index" '
+            "| awk -v c=$cutoff '{l[NR]=$0; t[NR]=$2} END{for(i=1;i<=NR;i++) if(t[i]>=c || i==NR) print l[i]}' "
+            '> "$store/index.tmp"\n'
+            'mv "$store/index.tmp" "$store/index"\n'
+            'for old in "$store"/objects/*.tar.gz; do\n'
+            '  grep -q " $(basename "$old" .tar.gz) " "$store/index" || rm -f "$old"\n'
+            "done\n"
+            'echo "@@new $id"'
+        )
+
+    def _backup_result(self, out: str) -> Optional[str]:
+        status, _, backup_id = out.rpartition("\n")[2].partition(" ")
+        if status == "@@new":
+            self.progress(f"Backup saved: {backup_id}")
+        return backup_id if status in {"@@new", "@@same"} else None
+
+    def list_backups(self) -> list[dict]:
+        """Backups in the store, newest first; `current` marks the one matching the live config."""
+        parent, name, _ = self._backup_paths()
+        out = self.ssh.run(
+            f"store={self.BACKUP_DIR}/{name}\n"
+            f"[ -d {parent}/{name} ] && {self._backup_hash_script().strip()} && echo \"@@current $sum\"\n"
+            '[ -f "$store/index" ] || exit 0\n'
+            "while read -r id ts sum label; do\n"
+            '  size=$(stat -c %s "$store/objects/$sum.tar.gz" 2>/dev/null || echo 0)\n'
+            '  echo "$id $ts $sum $label $size"\n'
+            'done < "$store/index"',
+            sudo=True,
+            check=False,
+        )
+        current = ""
+        backups = []
+        for line in out.splitlines():
+            parts = line.split()
+            if parts[:1] == ["@@current"] and len(parts) == 2:
+                current = parts[1]
+            elif len(parts) == 5 and self._backup_id_pattern.match(parts[0]):
+                backup_id, created, digest, label, size = parts
+                backups.append(
+                    {
+                        "id": backup_id,
+                        "created": int(created),
+                        "sha256": digest,
+                        "label": label,
+                        "size": int(size),
+                        "current": digest == current,
+                    }
+                )
+        return backups[::-1]
+
+    @_exclusive
+    def restore_backup(self, backup_id: str) -> bool:
+        """Replace the config dir with backup `backup_id` and restart its interfaces."""
+        if not self._backup_id_pattern.match(backup_id):
+            raise RuntimeError("Invalid backup id.")
+        parent, name, _ = self._backup_paths()
+        restored = self.ssh.run(
+            "set -e\n"
+            f"store={self.BACKUP_DIR}/{name}\n"
+            f"src={parent}/{name}\n"
+            f"target={backup_id}\n"
+            'grep -q "^$target " "$store/index" 2>/dev/null || exit 0\n' + self._restore_script(),
             sudo=True,
             check=False,
         ).strip()
-        if path:
-            self.progress(f"Backup saved: {path}")
-            return path
-        return None
+        return restored == backup_id
 
+    @_exclusive
     def rollback_last_backup(self) -> Optional[str]:
-        if self.protocol == "amneziawg":
-            conf_path = "/etc/amnezia/amneziawg/awg0.conf"
-            backup_glob = "/etc/amnezia/amneziawg/awg0.conf.bak.*"
-            service_name = "awg-quick@awg0"
-        else:
-            conf_path = "/etc/wireguard/wg0.conf"
-            backup_glob = "/etc/wireguard/wg0.conf.bak.*"
-            service_name = "wg-quick@wg0"
-
+        """Undo the last change by restoring the newest backup that differs from the live config.
+
+        Snapshots are taken before each change. The restored id is kept in
+        `$store/rollback` (cleared by the next snapshot), so repeated rollbacks keep
+        stepping back through the index instead of returning to the state just undone.
+        Servers without a backup store fall back to the legacy `*.conf.bak.*` copies.
+        """
+        parent, name, service = self._backup_paths()
+        iface = "awg0" if self.protocol == "amneziawg" else "wg0"
+        conf_path = f"{parent}/{name}/{iface}.conf"
         backup = self.ssh.run(
             "set -e\n"
-            f"latest=$(ls -t {backup_glob} 2>/dev/null | head -n 1 || true)\n"
-            "if [ -z \"$latest\" ]; then\n"
-            "  echo ''\n"
+            f"store={self.BACKUP_DIR}/{name}\n"
+            f"src={parent}/{name}\n"
+            + self._backup_hash_script()
+            + 'if [ -s "$store/index" ]; then\n'
+            '  cursor=$(cat "$store/rollback" 2>/dev/null || true)\n'
+            "  target=$(awk -v cur=\"$sum\" -v stop=\"$cursor\" "
+            "'{id[NR]=$1; s[NR]=$3; if ($1 == stop) pos=NR} "
+            "END{n=NR; if (pos && s[pos] == cur) n=pos-1; "
+            "for (i=n; i>0; i--) if (s[i] != cur) {print id[i]; exit}}' \"$store/index\")\n"
+            '  [ -n "$target" ] || exit 0\n'
+            '  echo "$target" > "$store/rollback"\n'
+            "else\n"
+            f"  latest=$(ls -t {conf_path}.bak.* 2>/dev/null | head -n 1 || true)\n"
+            '  [ -n "$latest" ] || exit 0\n'
+            f'  cp "$latest" {conf_path}\n'
+            f"  chmod 600 {conf_path}\n"
+            f"  systemctl restart {service}@{iface} || true\n"
+            '  echo "$latest"\n'
             "  exit 0\n"
-            "fi\n"
-            f"cp \"$latest\" {conf_path}\n"
-            f"chmod 600 {conf_path}\n"
-            f"systemctl restart {service_name} || true\n"
-            "echo \"$latest\"",
+            "fi\n" + self._restore_script(),
             sudo=True,
             check=False,
         ).strip()
@@ -1451,79 +2827,153 @@ class WireGuardProvisioner:
         return wg_mtu
 
     def post_check(self) -> list[dict]:
-        checks: list[dict] = []
+        self._phase("Post-checks", announce=False)
+        return self._drive(self._post_check_ops())
+
+    def _post_check_ops(self) -> Ops[list[dict]]:
         service_name = "awg-quick@awg0" if self.protocol == "amneziawg" else "wg-quick@wg0"
         iface = "awg0" if self.protocol == "amneziawg" else "wg0"
-        service = self.ssh.run(
-            f"systemctl is-active {service_name} || true", sudo=True, check=False
-        ).strip()
-        checks.append(
-            {"name": "service_active", "ok": service == "active", "details": service}
-        )
-
-        link = self.ssh.run(
-            f"ip link show {iface} >/dev/null 2>&1 && echo ok || echo missing",
-            sudo=True,
-            check=False,
-        ).strip()
-        checks.append({"name": "interface", "ok": link == "ok", "details": link})
-
-        fwd = self.ssh.run(
-            "sysctl -n net.ipv4.ip_forward 2>/dev/null || echo missing",
-            sudo=True,
-            check=False,
-        ).strip()
-        checks.append({"name": "ip_forward", "ok": fwd == "1", "details": fwd})
-
         port = self.listen_port
-        udp = self.ssh.run(
-            f"ss -lun | grep -q ':{port} ' && echo ok || echo missing",
-            sudo=True,
-            check=False,
-        ).strip()
-        checks.append({"name": "udp_listen", "ok": udp == "ok", "details": udp})
-        return checks
+        service, link, fwd, udp = yield [
+            Command(f"systemctl is-active {service_name} || true", sudo=True, check=False),
+            Command(
+                f"ip link show {iface} >/dev/null 2>&1 && echo ok || echo missing",
+                sudo=True,
+                check=False,
+            ),
+            Command("sysctl -n net.ipv4.ip_forward 2>/dev/null || echo missing", sudo=True, check=False),
+            Command(f"ss -lun | grep -q ':{port} ' && echo ok || echo missing", sudo=True, check=False),
+        ]
+        service, link, fwd, udp = (item.strip() for item in (service, link, fwd, udp))
+        return [
+            {"name": "service_active", "ok": service == "active", "details": service},
+            {"name": "interface", "ok": link == "ok", "details": link},
+            {"name": "ip_forward", "ok": fwd == "1", "details": fwd},
+            {"name": "udp_listen", "ok": udp == "ok", "details": udp},
+        ]
 
     def status(self) -> dict:
+        return self._drive(self._status_ops())
+
+    def _status_ops(self) -> Ops[dict]:
         service_name = "awg-quick@awg0" if self.protocol == "amneziawg" else "wg-quick@wg0"
         show_cmd = "awg show awg0" if self.protocol == "amneziawg" else "wg show wg0"
-        service = self.ssh.run(
-            f"systemctl is-active {service_name} || true", sudo=True, check=False
-        )
-        wg = self.ssh.run(f"{show_cmd} || true", sudo=True, check=False)
+        service, wg = yield [
+            Command(f"systemctl is-active {service_name} || true", sudo=True, check=False),
+            Command(f"{show_cmd} || true", sudo=True, check=False),
+        ]
         return {"service": service.strip(), "wg": wg.strip()}
 
-    def get_system_report(self) -> str:
-        """Collects deep diagnostics for debugging connectivity issues."""
+    def diagnostic_sections(self) -> list[tuple[str, str, str]]:
+        """(key, title, command) of every section the diagnostic report can include."""
         service_name = "awg-quick@awg0" if self.protocol == "amneziawg" else "wg-quick@wg0"
         show_cmd = "awg show all" if self.protocol == "amneziawg" else "wg show all"
-        commands = [
-            ("Service Status", f"systemctl status {service_name} --no-pager"),
-            ("WireGuard Status", show_cmd),
-            ("Interfaces", "ip addr"),
-            ("Routes", "ip route"),
-            ("IP Forwarding", "sysctl net.ipv4.ip_forward"),
-            ("UFW Status", "ufw status verbose"),
-            ("IPTables NAT", "iptables -t nat -S"),
-            ("IPTables Filter", "iptables -S"),
-            ("IP6Tables NAT", "ip6tables -t nat -S"),
-            ("Sysctl Conf", "cat /etc/sysctl.d/99-vpn-wizard.conf || echo 'missing'"),
-            ("UFW Before Rules", "tail -n 20 /etc/ufw/before.rules"),
-            ("Journal Log", f"journalctl -u {service_name} -n 50 --no-pager"),
-            ("Ping 1.1.1.1", "ping -c 3 1.1.1.1 || echo 'failed'"),
+        return [
+            ("service", "Service Status", f"systemctl status {service_name} --no-pager"),
+            ("wg", "WireGuard Status", show_cmd),
+            ("interfaces", "Interfaces", "ip addr"),
+            ("routes", "Routes", "ip route"),
+            ("forwarding", "IP Forwarding", "sysctl net.ipv4.ip_forward"),
+            ("ufw", "UFW Status", "ufw status verbose"),
+            ("nat", "IPTables NAT", "iptables -t nat -S"),
+            ("filter", "IPTables Filter", "iptables -S"),
+            ("nat6", "IP6Tables NAT", "ip6tables -t nat -S"),
+            ("sysctl", "Sysctl Conf", "cat /etc/sysctl.d/99-vpn-wizard.conf || echo 'missing'"),
+            ("ufw_before", "UFW Before Rules", "tail -n 20 /etc/ufw/before.rules"),
+            ("journal", "Journal Log", f"journalctl -u {service_name} -n 50 --no-pager"),
+            ("ping", "Ping 1.1.1.1", "ping -c 3 1.1.1.1 || echo 'failed'"),
         ]
-        
+
+    def collect_diagnostics(
+        self,
+        sections: Optional[Iterable[str]] = None,
+        timeout: float = 10.0,
+        max_bytes: int = 65536,
+        compress: bool = False,
+    ) -> list[dict]:
+        return run_ops(self.ssh, self._diagnostics_ops(sections, timeout, max_bytes, compress))
+
+    def _diagnostics_ops(
+        self,
+        sections: Optional[Iterable[str]] = None,
+        timeout: float = 10.0,
+        max_bytes: int = 65536,
+        compress: bool = False,
+    ) -> Ops[list[dict]]:
+        """Run the selected diagnostic sections concurrently on the server in one round trip.
+
+        Each section gets its own `timeout` (exit code 124 when it fires) and at most
+        `max_bytes` of its output is returned. With `compress` the whole result travels
+        gzipped and base64-encoded, which shrinks journal and iptables dumps several-fold.
+        """
+        available = self.diagnostic_sections()
+        if sections is not None:
+            wanted = list(dict.fromkeys(sections))
+            unknown = sorted(set(wanted) - {key for key, _, _ in available})
+            if unknown:
+                raise ValueError(f"Unknown diagnostic sections: {', '.join(unknown)}")
+            available = [item for item in available if item[0] in wanted]
+        lines = [
+            'd=$(mktemp -d)',
+            f'limit="timeout -k 1 {max(0.1, timeout):g}"',
+            'command -v timeout >/dev/null 2>&1 || limit=""',
+        ]
+        for key, _, command in available:
+            lines.append(
+                f'( $limit sh -c {shlex.quote(command)} > "$d/{key}" 2>&1; echo $? > "$d/{key}.rc" ) &'
+            )
+        lines.append("wait")
+        body = "\n".join(
+            f'printf \'@@section {key} %s %s\\n\' "$(cat "$d/{key}.rc")" "$(wc -c < "$d/{key}")"; '
+            f'head -c {max_bytes} "$d/{key}"; echo'
+            for key, _, _ in available
+        )
+        lines.append("{\n" + body + "\n}" + (" | gzip -c | base64 -w0" if compress else ""))
+        lines.append('rm -rf "$d"')
+        out = yield Command("\n".join(lines), sudo=True, check=False, pty=False)
+        if compress:
+            out = gzip.decompress(base64.b64decode(out.strip())).decode("utf-8", "replace")
+        titles = {key: title for key, title, _ in available}
+        results: list[dict] = []
+        for line in out.splitlines():
+            parts = line.split(" ")
+            if len(parts) == 4 and parts[0] == "@@section" and parts[1] in titles:
+                code = int(parts[2]) if parts[2].lstrip("-").isdigit() else -1
+                size = int(parts[3]) if parts[3].isdigit() else 0
+                results.append(
+                    {
+                        "key": parts[1],
+                        "title": titles[parts[1]],
+                        "exit_code": code,
+                        "timed_out": code in {124, 137},
+                        "bytes": size,
+                        "truncated": size > max_bytes,
+                        "output": [],
+                    }
+                )
+            elif results:
+                results[-1]["output"].append(line)
+        for item in results:
+            item["output"] = "\n".join(item["output"]).strip()
+        return results
+
+    def get_system_report(self, sections: Optional[Iterable[str]] = None, **options: Any) -> str:
+        """Collects deep diagnostics for debugging connectivity issues."""
+        return self.format_report(self.collect_diagnostics(sections, **options))
+
+    @staticmethod
+    def format_report(sections: list[dict]) -> str:
         report = ["=== VPN WIZARD DIAGNOSTIC REPORT ==="]
-        for name, cmd in commands:
-            report.append(f"\n--- {name} ---")
-            try:
-                out = self.ssh.run(cmd, sudo=True, check=False, pty=False)
-                report.append(out)
-            except Exception as e:
-                report.append(f"Error running command: {e}")
-        
+        for item in sections:
+            report.append(f"\n--- {item['title']} ---")
+            report.append(item["output"])
+            if item["timed_out"]:
+                report.append("(timed out)")
+            elif item["truncated"]:
+                report.append(f"(truncated, {item['bytes']} bytes total)")
         return "\n".join(report)
 
+    @_exclusive
     def repair_network(self) -> list[str]:
         logs = []
         def log(msg: str):
@@ -1622,3 +3072,314 @@ class WireGuardProvisioner:
         
         log("Repair complete. Try connecting now.")
         return logs
+
+    # Dry-run plans: the mutating operations above, computed locally from one snapshot.
+
+    _AWG_PARAM_RE = re.compile(r"^(Jc|Jmin|Jmax|S1|S2|H1|H2|H3|H4) =")
+    PLAN_OPERATIONS = ("add_client", "remove_client", "rotate_client", "repair_network")
+
+    def snapshot(self) -> Snapshot:
+        return self._drive(self._snapshot_ops())
+
+    def _snapshot_ops(self) -> Ops[Snapshot]:
+        """Every file the peer and repair operations read or write, in one round trip."""
+        awg, wg = "/etc/amnezia/amneziawg", "/etc/wireguard"
+        patterns = [
+            f"{awg}/*.conf",
+            f"{awg}/server_public*.key",
+            f"{awg}/clients/*.conf",
+            f"{awg}/clients/*.pub",
+            f"{awg}/clients_tyumen/*.conf",
+            f"{awg}/clients_tyumen/*.pub",
+            f"{wg}/wg0.conf",
+            f"{wg}/server_public.key",
+            f"{wg}/clients/*.conf",
+            f"{wg}/clients/*.pub",
+            "/etc/sysctl.d/99-vpn-wizard-repair.conf",
+            "/etc/default/ufw",
+        ]
+        raw = yield Command(snapshot_script(patterns), sudo=True, check=False, pty=False)
+        snap = parse_snapshot(raw)
+        self._pick_protocol(f"{awg}/awg0.conf" in snap.files, f"{wg}/wg0.conf" in snap.files)
+        return snap
+
+    def plan(self, operation: str, **kwargs: Any) -> ChangePlan:
+        """Preview a mutating operation without changing the server (one read round trip)."""
+        return self._drive(self._plan_ops(operation, **kwargs))
+
+    def _plan_ops(self, operation: str, **kwargs: Any) -> Ops[ChangePlan]:
+        planners = {
+            "add_client": self._plan_add_client,
+            "remove_client": self._plan_remove_client,
+            "rotate_client": self._plan_rotate_client,
+            "repair_network": self._plan_repair_network,
+        }
+        if operation not in planners:
+            raise ValueError(f"Unknown operation: {operation}")
+        snap = yield from self._snapshot_ops()
+        return planners[operation](snap, **kwargs)
+
+    def plan_add_client(self, client_name: Optional[str] = None, client_ip: Optional[str] = None) -> ChangePlan:
+        return self.plan("add_client", client_name=client_name, client_ip=client_ip)
+
+    def plan_remove_client(self, client_name: str) -> ChangePlan:
+        return self.plan("remove_client", client_name=client_name)
+
+    def plan_rotate_client(self, client_name: str) -> ChangePlan:
+        return self.plan("rotate_client", client_name=client_name)
+
+    def plan_repair_network(self) -> ChangePlan:
+        return self.plan("repair_network")
+
+    def _peer_paths(self, name: str) -> tuple[str, str, str]:
+        """(interface, interface conf, clients dir) a client name belongs to."""
+        if self.protocol != "amneziawg":
+            return "wg0", "/etc/wireguard/wg0.conf", "/etc/wireguard/clients"
+        if name.lower().startswith("tyumen"):
+            return "awg1", "/etc/amnezia/amneziawg/awg1.conf", "/etc/amnezia/amneziawg/clients_tyumen"
+        return "awg0", "/etc/amnezia/amneziawg/awg0.conf", "/etc/amnezia/amneziawg/clients"
+
+    @staticmethod
+    def _conf_value(text: Optional[str], key: str) -> str:
+        for line in (text or "").splitlines():
+            if line.startswith(key):
+                return line.split("=", 1)[1].strip() if "=" in line else ""
+        return ""
+
+    def _planned_rebuild(self, files: dict[str, str], iface: str, conf: str, clients_dir: str, plan: ChangePlan) -> None:
+        """Apply the rebuild_*_from_clients result for `iface` to `files`."""
+        service = "awg-quick" if iface.startswith("awg") else "wg-quick"
+        if self.apply_queue is not None:
+            plan.notes.append(f"The {iface} rebuild would be queued and applied with the next batch.")
+        header: list[str] = []
+        for line in (files.get(conf) or "").splitlines():
+            if line.startswith("[Peer]"):
+                break
+            header.append(line)
+        text = "\n".join(header).rstrip("\n") + "\n"
+        for path in self._list_planned(files, clients_dir, ".conf"):
+            name = path.rsplit("/", 1)[-1].removesuffix(".conf")
+            pub = (files.get(f"{clients_dir}/{name}.pub") or "").strip()
+            ip = self._conf_value(files[path], "Address").replace(" ", "").replace("\r", "")
+            text += f"\n[Peer]\nPublicKey = {pub}\nAllowedIPs = {ip}\n"
+        files[conf] = text
+        plan.commands.append(f"systemctl restart {service}@{iface}")
+        if self.apply_queue is None:
+            parent, name, _ = self._backup_paths()
+            plan.commands.append(f"backup {parent}/{name} (label: peers)")
+
+    @staticmethod
+    def _list_planned(files: dict[str, str], directory: str, suffix: str) -> list[str]:
+        return Snapshot(files).listing(directory, suffix)
+
+    def _plan_add_client(
+        self,
+        snap: Snapshot,
+        client_name: Optional[str] = None,
+        client_ip: Optional[str] = None,
+        files: Optional[dict[str, str]] = None,
+        plan: Optional[ChangePlan] = None,
+    ) -> ChangePlan:
+        files = dict(snap.files) if files is None else files
+        plan = plan or ChangePlan(operation="add_client")
+        if client_name:
+            name = client_name.strip()
+        else:
+            existing = {
+                path.rsplit("/", 1)[-1].removesuffix(".conf")
+                for clients_dir, _ in self._client_dirs()
+                for path in snap.listing(clients_dir, ".conf")
+            }
+            name = next(f"client{idx}" for idx in range(1, len(existing) + 2) if f"client{idx}" not in existing)
+        self._validate_client_name(name)
+        iface, conf, clients_dir = self._peer_paths(name)
+        conf_dir = conf.rsplit("/", 1)[0]
+        tool = "awg" if self.protocol == "amneziawg" else "wg"
+        if conf not in files:
+            if iface != "awg1":
+                raise RuntimeError(f"{os.path.basename(conf)} not found.")
+            plan.notes.append("awg1 does not exist yet; it would be set up first (not shown).")
+
+        client_conf = f"{clients_dir}/{name}.conf"
+        if client_conf in files:
+            plan.notes.append(f"Client {name} exists and would be overwritten with new keys.")
+            plan.commands.append(f"rm -f {clients_dir}/{name}.conf {clients_dir}/{name}.key {clients_dir}/{name}.pub")
+            files.pop(client_conf, None)
+            files.pop(f"{clients_dir}/{name}.pub", None)
+
+        if client_ip:
+            ip = client_ip
+        else:
+            used = {
+                line.split("=", 1)[1].replace(" ", "").replace("\r", "").split("/")[0]
+                for path in self._list_planned(files, clients_dir, ".conf")
+                for line in files[path].splitlines()
+                if line.startswith("Address") and "=" in line
+            }
+            cidr = "10.11.0.1/24" if iface == "awg1" else self.server_cidr
+            base = str(ipaddress.ip_network(cidr, strict=False).network_address).rsplit(".", 1)[0]
+            free = [f"{base}.{i}" for i in range(2, 255) if f"{base}.{i}" not in used]
+            if not free:
+                raise RuntimeError(f"No free IPs available in {cidr} subnet")
+            ip = f"{free[0]}/32"
+
+        others = [files[path] for path in self._list_planned(files, clients_dir, ".conf")]
+        mtu = self._resolved_mtu if self._resolved_mtu is not None else self.mtu
+        if mtu is None and self.auto_mtu:
+            existing_mtu = next((self._conf_value(text, "MTU") for text in others if self._conf_value(text, "MTU")), "")
+            mtu = int(existing_mtu) if existing_mtu.isdigit() else self.mtu_fallback
+            plan.notes.append(f"MTU is auto-detected on the server; {mtu} is assumed from existing clients.")
+        port = self._conf_value(files.get(conf), "ListenPort")
+        listen_port = int(port) if port.isdigit() else self.listen_port
+        dns = next((self._conf_value(text, "DNS") for text in others if self._conf_value(text, "DNS")), "") or self.dns
+        allowed = self._allowed_ips()
+        if self.allow_ipv6:
+            allowed = next(
+                (self._conf_value(text, "AllowedIPs") for text in others if self._conf_value(text, "AllowedIPs")), ""
+            ) or allowed
+
+        awg_params = ""
+        if self.protocol == "amneziawg":
+            params = [line for line in (files.get(conf) or "").splitlines() if self._AWG_PARAM_RE.match(line)]
+            if params:
+                awg_params = "\n".join(params) + "\n"
+            elif iface == "awg1":
+                awg_params = (
+                    f"Jc = {self.awg_jc + 1}\nJmin = {self.awg_jmin}\nJmax = {self.awg_jmax}\n"
+                    f"S1 = {self.awg_s1 + 5}\nS2 = {self.awg_s2 + 5}\nH1 = {self.awg_h1 + 123456}\n"
+                    f"H2 = {self.awg_h2}\nH3 = {self.awg_h3}\nH4 = {self.awg_h4}\n"
+                )
+
+        suffix = "_awg1" if iface == "awg1" else ""
+        server_pub = (files.get(f"{conf_dir}/server_public{suffix}.key") or "").strip()
+        if not server_pub:
+            server_pub = "<new server public key>"
+            plan.commands.append(
+                f"{tool} genkey | tee {conf_dir}/server_private{suffix}.key | {tool} pubkey > {conf_dir}/server_public{suffix}.key"
+            )
+        public_ip = self._public_ip_cache or (
+            self.ssh.config.host if self.ssh.config.host.replace(".", "").isdigit() else "<public ip>"
+        )
+        plan.commands.append(
+            f"{tool} genkey | tee {clients_dir}/{name}.key | {tool} pubkey > {clients_dir}/{name}.pub"
+        )
+        files[f"{clients_dir}/{name}.pub"] = f"<new public key of {name}>\n"
+        files[client_conf] = self._client_config_text(
+            "<new private key>", ip, dns, mtu, awg_params, server_pub, f"{public_ip}:{listen_port}", allowed
+        )
+        plan.commands.append(f"chmod 600 {client_conf}")
+        plan.commands.append(self._forget_client_index())
+        self._planned_rebuild(files, iface, conf, clients_dir, plan)
+        plan.result = {"name": name, "ip": ip, "interface": iface}
+        return plan.compare(snap.files, files)
+
+    def _plan_remove_client(
+        self,
+        snap: Snapshot,
+        client_name: str,
+        files: Optional[dict[str, str]] = None,
+        plan: Optional[ChangePlan] = None,
+    ) -> ChangePlan:
+        self._validate_client_name(client_name)
+        files = dict(snap.files) if files is None else files
+        plan = plan or ChangePlan(operation="remove_client")
+        iface, conf, clients_dir = self._peer_paths(client_name)
+        if f"{clients_dir}/{client_name}.conf" not in files:
+            plan.notes.append(f"Client {client_name} not found; nothing would change.")
+            plan.result = {"removed": False}
+            return plan
+        plan.commands.append(
+            f"rm -f {clients_dir}/{client_name}.conf {clients_dir}/{client_name}.key {clients_dir}/{client_name}.pub"
+        )
+        plan.commands.append(self._forget_client_index())
+        files.pop(f"{clients_dir}/{client_name}.conf", None)
+        files.pop(f"{clients_dir}/{client_name}.pub", None)
+        self._planned_rebuild(files, iface, conf, clients_dir, plan)
+        plan.result = {"removed": True}
+        return plan.compare(snap.files, files)
+
+    def _plan_rotate_client(self, snap: Snapshot, client_name: str) -> ChangePlan:
+        self._validate_client_name(client_name)
+        iface, conf, clients_dir = self._peer_paths(client_name)
+        client_conf = f"{clients_dir}/{client_name}.conf"
+        current_ip = self._conf_value(snap.read(client_conf), "Address").replace(" ", "").replace("\r", "")
+        if not current_ip:
+            raise RuntimeError("Client not found.")
+        files = dict(snap.files)
+        plan = ChangePlan(operation="rotate_client")
+        old_pub = (files.get(f"{clients_dir}/{client_name}.pub") or "").strip()
+        if not old_pub:
+            plan.notes.append("The client has no public key; it would be removed and added again.")
+            self._plan_remove_client(snap, client_name, files=files, plan=plan)
+            return self._plan_add_client(snap, client_name, current_ip, files=files, plan=plan)
+        tool = "awg" if iface.startswith("awg") else "wg"
+        new_pub = f"<new public key of {client_name}>"
+        plan.commands.append(f"{tool} genkey | tee {clients_dir}/{client_name}.key | {tool} pubkey > {clients_dir}/{client_name}.pub")
+        files[client_conf] = re.sub(
+            r"^PrivateKey = .*$", "PrivateKey = <new private key>", files[client_conf], flags=re.MULTILINE
+        )
+        files[f"{clients_dir}/{client_name}.pub"] = new_pub + "\n"
+        plan.commands.append(self._forget_client_index())
+        server_conf = files.get(conf) or ""
+        if f"PublicKey = {old_pub}" in server_conf.splitlines():
+            files[conf] = "".join(
+                f"PublicKey = {new_pub}\n" if line == f"PublicKey = {old_pub}\n" else line
+                for line in server_conf.splitlines(keepends=True)
+            )
+            plan.commands.append(f"{tool} set {iface} peer {old_pub} remove")
+            plan.commands.append(f"{tool} set {iface} peer {new_pub} allowed-ips {current_ip}")
+            parent, name, _ = self._backup_paths()
+            plan.commands.append(f"backup {parent}/{name} (label: peers)")
+        else:
+            plan.notes.append(f"{os.path.basename(conf)} does not list the peer yet; it would be rebuilt.")
+            self._planned_rebuild(files, iface, conf, clients_dir, plan)
+        plan.result = {"name": client_name, "ip": current_ip, "interface": iface}
+        return plan.compare(snap.files, files)
+
+    def _plan_repair_network(self, snap: Snapshot) -> ChangePlan:
+        plan = ChangePlan(operation="repair_network")
+        if self.protocol == "amneziawg":
+            plan.notes.append("Repair is only supported for WireGuard mode.")
+            return plan
+        files = dict(snap.files)
+        files["/etc/sysctl.d/99-vpn-wizard-repair.conf"] = "net.ipv4.ip_forward=1\n"
+        plan.commands.append("sysctl --system")
+        if "/etc/default/ufw" in files:
+            files["/etc/default/ufw"] = re.sub(
+                r"^DEFAULT_FORWARD_POLICY=.*$",
+                'DEFAULT_FORWARD_POLICY="ACCEPT"',
+                files["/etc/default/ufw"],
+                flags=re.MULTILINE,
+            )
+            plan.commands.append("ufw reload")
+        conf = "/etc/wireguard/wg0.conf"
+        current = files.get(conf)
+        if current is None:
+            raise RuntimeError("wg0.conf not found.")
+        priv_key, port = "", str(self.listen_port)
+        for line in current.splitlines():
+            if "PrivateKey" in line:
+                priv_key = line.split("=", 1)[1].strip()
+            if "ListenPort" in line:
+                port = line.split("=", 1)[1].strip()
+        if not priv_key:
+            raise RuntimeError("Could not find PrivateKey in wg0.conf")
+        if snap.route_iface:
+            plan.notes.append(f"Detected primary interface: {snap.route_iface}")
+        else:
+            plan.notes.append("Could not detect interface, assuming eth0")
+        postup, postdown = self._post_rules("wg0")
+        lines = current.splitlines()
+        start = next((idx for idx, line in enumerate(lines) if line.startswith("[Peer]")), len(lines))
+        peers = "\n".join(lines[start:]).strip()
+        files[conf] = (
+            "[Interface]\n"
+            f"Address = {self.server_cidr}\n"
+            f"ListenPort = {port}\n"
+            f"PrivateKey = {priv_key}\n"
+            f"PostUp = {postup}\n"
+            f"PostDown = {postdown}\n"
+            f"\n{peers}\n"
+        )
+        plan.commands.append("systemctl restart wg-quick@wg0")
+        return plan.compare(snap.files, files)
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import csv
+import hashlib
+import io
+import time
+from typing import Iterable, Iterator, Optional
+import zipfile
+
+from vpn_wizard.qr import QR_ENGINE, QR_FORMATS, QREngine
+
+
+class _Spool(io.RawIOBase):
+    """Write-only sink that hands out what has been written so far."""
+
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+def iter_clients_zip(
+    clients: list[dict],
+    qr_formats: Iterable[str] = ("png",),
+    engine: Optional[QREngine] = None,
+) -> Iterator[bytes]:
+    """Stream a ZIP of client configs, their QR codes and a manifest.csv.
+
+    `clients` are export_client-shaped dicts. Each file is yielded as soon as it is
+    compressed, so memory stays at one entry plus the QR engine's window however many
+    clients there are. Entries are `<interface>/<name>.conf` (and `.png` / `.svg`).
+    """
+    formats = list(dict.fromkeys(qr_formats))
+    unknown = sorted(set(formats) - set(QR_FORMATS))
+    if unknown:
+        raise ValueError(f"Unknown QR formats: {', '.join(unknown)}")
+    spool = _Spool()
+    stamp = time.localtime()[:6]
+    manifest = io.StringIO()
+    writer = csv.writer(manifest)
+    writer.writerow(["name", "interface", "ip", "public_key", "config", *formats, "config_sha256"])
+    images = (engine or QR_ENGINE).map((client["config"], fmt) for client in clients for fmt in formats)
+    with zipfile.ZipFile(spool, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+
+        def add(name: str, data: bytes, compress: int = zipfile.ZIP_DEFLATED) -> bytes:
+            info = zipfile.ZipInfo(name, date_time=stamp)
+            info.compress_type = compress
+            archive.writestr(info, data)
+            return spool.drain()
+
+        for client in clients:
+            base = f"{client['interface']}/{client['name']}"
+            config = client["config"].rstrip("\n") + "\n"
+            yield add(f"{base}.conf", config.encode("utf-8"))
+            for fmt in formats:
+                # PNG is already compressed; deflating it again only costs CPU.
+                method = zipfile.ZIP_STORED if fmt == "png" else zipfile.ZIP_DEFLATED
+                yield add(f"{base}.{fmt}", next(images), method)
+            writer.writerow(
+                [
+                    client["name"],
+                    client["interface"],
+                    client.get("ip", ""),
+                    client.get("public_key", ""),
+                    f"{base}.conf",
+                    *(f"{base}.{fmt}" for fmt in formats),
+                    hashlib.sha256(config.encode("utf-8")).hexdigest(),
+                ]
+            )
+        yield add("manifest.csv", manifest.getvalue().encode("utf-8"))
+    yield spool.drain()
@@ -3,16 +3,19 @@ from __future__ import annotations
 from pathlib import Path
 from typing import Optional
 
-import qrcode
-from PIL.ImageQt import ImageQt
 from PySide6 import QtCore, QtGui, QtWidgets
 
 from vpn_wizard.core import SSHConfig, SSHRunner, WireGuardProvisioner
+from vpn_wizard.qr import QREngine
+
+# Renders inline: ProvisionWorker already keeps encoding off the UI thread, and a
+# process pool started from a Qt worker thread would fork a multithreaded process.
+QR_ENGINE = QREngine(workers=0)
 
 
 class ProvisionWorker(QtCore.QThread):
     log = QtCore.Signal(str)
-    done = QtCore.Signal(str, object)
+    done = QtCore.Signal(str, object, bytes)
     error = QtCore.Signal(str)
 
     def __init__(
@@ -58,7 +61,8 @@ class ProvisionWorker(QtCore.QThread):
                 prov.provision()
                 config = prov.export_client_config()
                 checks = prov.post_check()
-            self.done.emit(config, checks)
+            qr_png = QR_ENGINE.render(config)
+            self.done.emit(config, checks, qr_png)
         except Exception as exc:
             self.error.emit(str(exc))
 
@@ -182,7 +186,7 @@ class Wizard(QtWidgets.QWidget):
     def _append_log(self, msg: str) -> None:
         self.log_output.append(msg)
 
-    def _provision_done(self, config: str, checks: object) -> None:
+    def _provision_done(self, config: str, checks: object, qr_png: bytes) -> None:
         self.client_config = config
         results = checks if isinstance(checks, list) else []
         ok = all(item.get("ok") for item in results) if results else True
@@ -192,7 +196,7 @@ class Wizard(QtWidgets.QWidget):
             self.log_output.append(
                 f"check {item.get('name')}: {'ok' if item.get('ok') else 'fail'} ({item.get('details')})"
             )
-        self._set_qr(config)
+        self._set_qr(qr_png)
         self.stack.setCurrentWidget(self.page_done)
 
     def _provision_error(self, message: str) -> None:
@@ -209,10 +213,9 @@ class Wizard(QtWidgets.QWidget):
         if path:
             Path(path).write_text(self.client_config, encoding="utf-8")
 
-    def _set_qr(self, config: str) -> None:
-        img = qrcode.make(config)
-        qimg = ImageQt(img)
-        pix = QtGui.QPixmap.fromImage(qimg)
+    def _set_qr(self, qr_png: bytes) -> None:
+        pix = QtGui.QPixmap()
+        pix.loadFromData(qr_png, "PNG")
         pix = pix.scaled(260, 260, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
         self.qr_label.setPixmap(pix)
 
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import base64
+from dataclasses import dataclass, field
+import difflib
+import re
+from typing import Iterable, Optional
+
+_SECRET_RE = re.compile(r"^(\s*(?:PrivateKey|PresharedKey)\s*=\s*)(?![\s<]).+$", re.MULTILINE)
+
+
+def redact(text: str) -> str:
+    """Mask private and preshared keys, so plans can be shown and logged."""
+    return _SECRET_RE.sub(r"\1<redacted>", text)
+
+
+@dataclass
+class Snapshot:
+    """Remote files (path -> content) read in one round trip, plus routing facts."""
+
+    files: dict[str, str]
+    route_iface: str = ""
+
+    def read(self, path: str) -> Optional[str]:
+        return self.files.get(path)
+
+    def listing(self, directory: str, suffix: str) -> list[str]:
+        """Paths directly inside `directory` ending in `suffix`, in glob order."""
+        prefix = directory.rstrip("/") + "/"
+        return sorted(
+            path
+            for path in self.files
+            if path.startswith(prefix) and "/" not in path[len(prefix):] and path.endswith(suffix)
+        )
+
+
+def snapshot_script(patterns: Iterable[str]) -> str:
+    """Shell script printing every existing file matching `patterns`, base64-encoded."""
+    return "\n".join(
+        [
+            "set +e",
+            f"for f in {' '.join(patterns)}; do",
+            '  [ -f "$f" ] || continue',
+            '  echo "@@file $f"',
+            '  base64 -w0 "$f"',
+            "  echo",
+            "done",
+            "echo \"@@route $(ip -4 route get 1.1.1.1 2>/dev/null | awk '{print $5; exit}')\"",
+            "true",
+        ]
+    )
+
+
+def parse_snapshot(raw: str) -> Snapshot:
+    files: dict[str, str] = {}
+    route_iface = ""
+    pending: Optional[str] = None
+    for line in raw.splitlines():
+        if line.startswith("@@file "):
+            pending = line[len("@@file "):].strip()
+            files[pending] = ""
+        elif line.startswith("@@route"):
+            route_iface = line[len("@@route"):].strip()
+            pending = None
+        elif pending is not None:
+            files[pending] = base64.b64decode(line.strip()).decode("utf-8", "replace")
+            pending = None
+    return Snapshot(files=files, route_iface=route_iface)
+
+
+@dataclass
+class FileChange:
+    path: str
+    before: Optional[str]
+    after: Optional[str]
+
+    @property
+    def action(self) -> str:
+        if self.before is None:
+            return "create"
+        if self.after is None:
+            return "delete"
+        return "modify"
+
+    def diff(self) -> str:
+        before = redact(self.before or "").splitlines(keepends=True)
+        after = redact(self.after or "").splitlines(keepends=True)
+        lines = difflib.unified_diff(
+            before,
+            after,
+            fromfile="/dev/null" if self.before is None else f"a{self.path}",
+            tofile="/dev/null" if self.after is None else f"b{self.path}",
+        )
+        return "".join(line if line.endswith("\n") else line + "\n" for line in lines)
+
+
+@dataclass
+class ChangePlan:
+    """What a mutating operation would do: file changes, commands and caveats.
+
+    Built locally from a Snapshot, so computing it never touches the server. Values
+    only known after the run (generated keys, an unresolved public IP) appear as
+    `<placeholders>`; private keys are redacted in diffs.
+    """
+
+    operation: str
+    changes: list[FileChange] = field(default_factory=list)
+    commands: list[str] = field(default_factory=list)
+    notes: list[str] = field(default_factory=list)
+    result: dict = field(default_factory=dict)
+
+    def compare(self, before: dict[str, str], after: dict[str, str]) -> "ChangePlan":
+        """Record every path whose content differs between two file maps."""
+        self.changes = [
+            FileChange(path, before.get(path), after.get(path))
+            for path in sorted(set(before) | set(after))
+            if before.get(path) != after.get(path)
+        ]
+        return self
+
+    def diff(self) -> str:
+        return "".join(change.diff() for change in self.changes)
+
+    def as_dict(self) -> dict:
+        return {
+            "operation": self.operation,
+            "changes": [
+                {"path": change.path, "action": change.action, "diff": change.diff()}
+                for change in self.changes
+            ],
+            "commands": list(self.commands),
+            "notes": list(self.notes),
+            "result": dict(self.result),
+            "diff": self.diff(),
+        }
@@ -1,12 +1,258 @@
 from __future__ import annotations
 
+import asyncio
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from io import BytesIO
+import os
 from pathlib import Path
+import struct
+import threading
+from typing import Iterable, Iterator, Optional
+import zlib
 
 import qrcode
+import qrcode.constants
+import qrcode.exceptions
+import qrcode.image.svg
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - optional dependency
+    np = None
+
+QR_FORMATS = ("png", "svg")
+BOX_SIZE = 10
+BORDER = 4
 
 
 def save_qr_png(data: str, out_path: str | Path) -> Path:
     path = Path(out_path)
-    img = qrcode.make(data)
-    img.save(path)
+    path.write_bytes(QR_ENGINE.render(data))
     return path
+
+
+# Values equal to what the client assumes anyway. The AmneziaWG ones switch the
+# obfuscation off, i.e. they describe plain WireGuard.
+QR_DEFAULTS = {
+    "persistentkeepalive": {"0", "off"},
+    "jc": {"0"},
+    "jmin": {"0"},
+    "jmax": {"0"},
+    "s1": {"0"},
+    "s2": {"0"},
+    "h1": {"1"},
+    "h2": {"2"},
+    "h3": {"3"},
+    "h4": {"4"},
+}
+
+EC_LEVELS = (
+    qrcode.constants.ERROR_CORRECT_L,
+    qrcode.constants.ERROR_CORRECT_M,
+    qrcode.constants.ERROR_CORRECT_Q,
+    qrcode.constants.ERROR_CORRECT_H,
+)
+
+
+def compact_config(text: str, group_numeric: bool = False) -> str:
+    """Smallest equivalent form of a WireGuard config, for QR payloads.
+
+    Comments, blank lines and the spaces around `=` and list commas are dropped, as are
+    settings that only restate the default. With `group_numeric`, settings with purely
+    numeric values are moved to the end of their section, so the digits sit in longer
+    runs that the QR encoder can pack in numeric mode. The config file itself is never
+    rewritten; only what goes into the QR code.
+    """
+    sections: list[tuple[str, list[str], list[str]]] = []
+    for raw in text.splitlines():
+        line = raw.split("#", 1)[0].strip()
+        if not line:
+            continue
+        if line.startswith("[") and line.endswith("]"):
+            sections.append((line, [], []))
+            continue
+        if not sections:
+            sections.append(("", [], []))
+        key, sep, value = line.partition("=")
+        if not sep:
+            sections[-1][1].append(line)
+            continue
+        key = key.strip()
+        value = ",".join(part.strip() for part in value.split(","))
+        if value in QR_DEFAULTS.get(key.lower(), ()):
+            continue
+        target = sections[-1][2] if group_numeric and value.isdigit() else sections[-1][1]
+        target.append(f"{key}={value}")
+    lines: list[str] = []
+    for header, entries, numeric in sections:
+        if header:
+            lines.append(header)
+        lines.extend(entries + numeric)
+    return "\n".join(lines)
+
+
+def qr_code(data: str, boost: bool = True) -> qrcode.QRCode:
+    """A built QR code at the smallest version that fits `data`.
+
+    The version is chosen at error correction level L; with `boost` the level is then
+    raised as far as it goes without growing the symbol, so damage tolerance comes for
+    free and the code stays as coarse (and as easy for a camera) as possible.
+    """
+    chosen = None
+    for level in EC_LEVELS if boost else EC_LEVELS[:1]:
+        qr = qrcode.QRCode(error_correction=level, box_size=BOX_SIZE, border=BORDER)
+        qr.add_data(data)
+        try:
+            version = qr.best_fit()
+        except qrcode.exceptions.DataOverflowError:
+            break
+        if chosen is not None and version != chosen.version:
+            break
+        chosen = qr
+    if chosen is None:
+        raise ValueError("Data too long for a QR code.")
+    chosen.make(fit=False)
+    return chosen
+
+
+def qr_matrix(data: str) -> list[list[bool]]:
+    """Module matrix (True = dark) with the quiet zone."""
+    return qr_code(data).get_matrix()
+
+
+def _png_chunk(kind: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I", len(payload)) + kind + payload + struct.pack(">I", zlib.crc32(kind + payload))
+
+
+def matrix_to_png(matrix: list[list[bool]], scale: int = BOX_SIZE) -> bytes:
+    """Encode a module matrix as a 1-bit grayscale PNG directly, without an image library.
+
+    Each scanline is packed once and repeated `scale` times. With NumPy installed
+    (`pip install vpn-wizard[fast]`) the scaling and bit packing are vectorized.
+    """
+    size = len(matrix) * scale
+    if np is not None:
+        light = ~np.asarray(matrix, dtype=bool)
+        pixels = np.repeat(np.repeat(light, scale, axis=0), scale, axis=1)
+        packed = np.packbits(pixels, axis=1)
+        raw = np.hstack([np.zeros((size, 1), dtype=np.uint8), packed]).tobytes()
+    else:
+        rows = []
+        for row in matrix:
+            bits = "".join(("0" if dark else "1") * scale for dark in row)
+            bits += "0" * (-len(bits) % 8)
+            rows.append((b"\0" + int(bits, 2).to_bytes(len(bits) // 8, "big")) * scale)
+        raw = b"".join(rows)
+    header = struct.pack(">IIBBBBB", size, size, 1, 0, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", header)
+        + _png_chunk(b"IDAT", zlib.compress(raw, 6))
+        + _png_chunk(b"IEND", b"")
+    )
+
+
+def render_qr(data: str, fmt: str = "png", fast: bool = False, compact: bool = False) -> bytes:
+    """QR code for `data` as PNG or SVG bytes. Top-level, so process pools can run it.
+
+    `fast` builds PNGs from the bare module matrix instead of drawing through Pillow;
+    the pixels are identical. `compact` encodes compact_config(data) instead of `data`.
+    """
+    if fmt not in QR_FORMATS:
+        raise ValueError(f"Unknown QR format: {fmt}")
+    qr = qr_code(compact_config(data) if compact else data)
+    if fmt == "png" and fast:
+        return matrix_to_png(qr.get_matrix())
+    factory = qrcode.image.svg.SvgPathImage if fmt == "svg" else None
+    img = qr.make_image(image_factory=factory)
+    buf = BytesIO()
+    img.save(buf)
+    return buf.getvalue()
+
+
+class QREngine:
+    """Renders QR codes off the calling thread, in a pool of worker processes.
+
+    QR encoding is pure Python and holds the GIL, so rendering in a request handler or
+    a UI thread stalls everything else in the process. The engine sends the work to a
+    ProcessPoolExecutor, created on first use with `workers` processes (0 renders
+    inline). At most `max_pending` renders are queued at a time: `submit` blocks beyond
+    that, so a large batch cannot pile up unbounded work and results. With `compact`
+    (the default) configs are encoded in their compact_config form.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        max_pending: int = 64,
+        fast: Optional[bool] = None,
+        compact: Optional[bool] = None,
+    ) -> None:
+        if workers is None:
+            env = os.getenv("VPNW_QR_WORKERS")
+            workers = int(env) if env not in (None, "") else (os.cpu_count() or 1)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.fast = os.getenv("VPNW_QR_FAST", "1") != "0" if fast is None else fast
+        self.compact = os.getenv("VPNW_QR_COMPACT", "1") != "0" if compact is None else compact
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> Optional[ProcessPoolExecutor]:
+        if self.workers <= 0:
+            return None
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def render(self, data: str, fmt: str = "png") -> bytes:
+        """Render in the calling thread."""
+        return render_qr(data, fmt, self.fast, self.compact)
+
+    def submit(self, data: str, fmt: str = "png") -> Future:
+        self._slots.acquire()
+        pool = self._pool()
+        if pool is None:
+            future: Future = Future()
+            try:
+                future.set_result(self.render(data, fmt))
+            except Exception as exc:  # noqa: BLE001 - delivered through the future
+                future.set_exception(exc)
+            finally:
+                self._slots.release()
+            return future
+        try:
+            future = pool.submit(render_qr, data, fmt, self.fast, self.compact)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    async def arender(self, data: str, fmt: str = "png") -> bytes:
+        # submit may block on a full queue, so it is called from a worker thread.
+        future = await asyncio.to_thread(self.submit, data, fmt)
+        return await asyncio.wrap_future(future)
+
+    def map(self, jobs: Iterable[tuple[str, str]], window: Optional[int] = None) -> Iterator[bytes]:
+        """Render (data, fmt) jobs in input order with at most `window` in flight."""
+        window = max(1, min(window or 2 * max(self.workers, 1), self.max_pending))
+        pending: deque = deque()
+        for data, fmt in jobs:
+            pending.append(self.submit(data, fmt))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+QR_ENGINE = QREngine()
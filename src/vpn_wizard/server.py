@@ -1,26 +1,49 @@
 from __future__ import annotations
 
-from dataclasses import dataclass, field
+import argparse
+import asyncio
+from dataclasses import asdict, dataclass, field
 import base64
-from io import BytesIO
+from contextlib import asynccontextmanager
+import hashlib
+import hmac
+import json
 import os
 from pathlib import Path
-import tempfile
-from typing import Optional
-import threading
+import secrets
+import time
+from typing import AsyncIterator, Literal, Optional
 import uuid
 
-from fastapi import BackgroundTasks, FastAPI, HTTPException
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
-import qrcode
 import uvicorn
 
-from vpn_wizard.core import SSHConfig, SSHRunner, WireGuardProvisioner
+from vpn_wizard.aio import AsyncSSHPool, AsyncSSHRunner, AsyncWireGuardProvisioner, arun_ops
+from vpn_wizard.apply import ApplyQueue
+from vpn_wizard.backend import SQLiteBackend, default_state_path, get_backend
+from vpn_wizard.core import Command, CommandTimings, Ops, SSHConfig, SSHRunner, WireGuardProvisioner
+from vpn_wizard.export import iter_clients_zip
+from vpn_wizard.qr import QR_ENGINE
+
+
+@asynccontextmanager
+async def _lifespan(_: FastAPI) -> AsyncIterator[None]:
+    yield
+    await SSH_POOL.close()
+    await asyncio.to_thread(QR_ENGINE.shutdown)
+    if APPLY_QUEUE is None:
+        return
+    try:
+        await asyncio.to_thread(APPLY_QUEUE.flush)
+    except Exception as exc:  # noqa: BLE001 - shutting down; report and continue
+        print(f"VPN Wizard: pending peer changes failed to apply: {exc}")
 
 
-app = FastAPI(title="VPN Wizard API")
+app = FastAPI(title="VPN Wizard API", lifespan=_lifespan)
 raw_origins = os.getenv("VPNW_CORS_ORIGINS", "")
 cors_origins = []
 if raw_origins:
@@ -48,6 +71,7 @@ app.add_middleware(
     allow_origins=cors_origins,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
 
@@ -109,12 +133,35 @@ class ClientRequest(BaseModel):
     listen_port: Optional[int] = None
 
 
+class BackupRestoreRequest(BaseModel):
+    ssh: SSHPayload
+    backup_id: str
+
+
+class BackupListResponse(BaseModel):
+    ok: bool
+    backups: list[dict] = []
+    error: Optional[str] = None
+
+
 class ClientRemoveRequest(BaseModel):
     ssh: SSHPayload
     client_name: str
     listen_port: Optional[int] = None
 
 
+class ClientExportAllRequest(BaseModel):
+    ssh: SSHPayload
+    qr_formats: list[Literal["png", "svg"]] = ["png"]
+
+
+class ClientFindRequest(BaseModel):
+    ssh: SSHPayload
+    name: Optional[str] = None
+    public_key: Optional[str] = None
+    ip: Optional[str] = None
+
+
 class ClientListResponse(BaseModel):
     ok: bool
     clients: list[dict] = []
@@ -128,6 +175,7 @@ class ClientAddResponse(BaseModel):
     config: Optional[str] = None
     qr_png_base64: Optional[str] = None
     interface: Optional[str] = None
+    apply_pending: bool = False
     error: Optional[str] = None
 
 
@@ -145,6 +193,17 @@ class JobCreateResponse(BaseModel):
     job_id: str
 
 
+class PhaseTiming(BaseModel):
+    phase: str
+    commands: int
+    seconds: float
+    bytes_in: int = 0
+    bytes_out: int = 0
+    retries: int = 0
+    slowest: Optional[str] = None
+    slowest_seconds: float = 0.0
+
+
 class JobStatus(BaseModel):
     job_id: str
     status: str
@@ -152,34 +211,28 @@ class JobStatus(BaseModel):
     checks: list[CheckItem] = []
     error: Optional[str] = None
     config_ready: bool = False
+    timings: list[PhaseTiming] = []
+
+
+def _ssh_config(ssh: SSHPayload) -> SSHConfig:
+    # Key text goes straight to SSHConfig; it is parsed in memory and cached by fingerprint.
+    return SSHConfig(
+        host=ssh.host,
+        user=ssh.user,
+        port=ssh.port,
+        password=ssh.password,
+        key_path=ssh.key_path,
+        key_content=ssh.key_content,
+    )
 
 
-@dataclass
-class TempKey:
-    path: Optional[str] = None
-
-    def cleanup(self) -> None:
-        if self.path and Path(self.path).exists():
-            try:
-                Path(self.path).unlink()
-            except OSError:
-                pass
-
-
-def _write_temp_key(content: str) -> TempKey:
-    tmp = tempfile.NamedTemporaryFile(delete=False, mode="w", encoding="utf-8")
-    tmp.write(content)
-    tmp.flush()
-    tmp.close()
-    os.chmod(tmp.name, 0o600)
-    return TempKey(path=tmp.name)
+def _build_qr_base64(config: str) -> str:
+    return base64.b64encode(QR_ENGINE.submit(config).result()).decode("ascii")
 
 
-def _build_qr_base64(config: str) -> str:
-    img = qrcode.make(config)
-    buf = BytesIO()
-    img.save(buf, format="PNG")
-    return base64.b64encode(buf.getvalue()).decode("ascii")
+async def _qr_base64(config: str) -> str:
+    # Rendered in the QR process pool: encoding holds the GIL and would stall the loop.
+    return base64.b64encode(await QR_ENGINE.arender(config)).decode("ascii")
 
 
 @dataclass
@@ -191,78 +244,78 @@ class Job:
     config: Optional[str] = None
     qr_png_base64: Optional[str] = None
     error: Optional[str] = None
+    timings: list[dict] = field(default_factory=list)
 
 
 class JobStore:
-    def __init__(self) -> None:
-        self._jobs: dict[str, Job] = {}
-        self._lock = threading.Lock()
+    """Provisioning jobs kept in the state backend, so every API worker sees every job.
+
+    Jobs run in the worker that accepted them but may be polled through any other one;
+    finished jobs older than `max_age` seconds are purged when new jobs are created.
+    """
+
+    MAX_PROGRESS = 50
+
+    def __init__(self, backend: Optional[SQLiteBackend] = None, max_age: float = 86400.0) -> None:
+        self.backend = backend or SQLiteBackend()
+        self.max_age = max_age
 
     def create(self) -> Job:
-        job_id = uuid.uuid4().hex
-        job = Job(job_id=job_id)
-        with self._lock:
-            self._jobs[job_id] = job
+        job = Job(job_id=uuid.uuid4().hex)
+        self.backend.job_purge(self.max_age)
+        self.backend.job_put(job.job_id, asdict(job))
         return job
 
     def get(self, job_id: str) -> Optional[Job]:
-        with self._lock:
-            job = self._jobs.get(job_id)
-            if not job:
-                return None
-            return Job(
-                job_id=job.job_id,
-                status=job.status,
-                progress=list(job.progress),
-                checks=list(job.checks),
-                config=job.config,
-                qr_png_base64=job.qr_png_base64,
-                error=job.error,
-            )
+        data = self.backend.job_get(job_id)
+        return Job(**data) if data else None
 
     def update(self, job_id: str, **kwargs) -> None:
-        with self._lock:
-            job = self._jobs.get(job_id)
-            if not job:
-                return
-            for key, value in kwargs.items():
-                setattr(job, key, value)
+        self.backend.job_update(job_id, lambda data: data.update(kwargs))
 
     def append_progress(self, job_id: str, message: str) -> None:
-        with self._lock:
-            job = self._jobs.get(job_id)
-            if not job:
-                return
-            job.progress.append(message)
-            if len(job.progress) > 50:
-                job.progress = job.progress[-50:]
+        def change(data: dict) -> None:
+            data["progress"] = [*data["progress"], message][-self.MAX_PROGRESS :]
+
+        self.backend.job_update(job_id, change)
+
 
+JOB_STORE = JobStore(get_backend(), max_age=float(os.getenv("VPNW_JOB_TTL", "86400")))
+
+# Peer changes are applied write-behind: a burst of add/remove/rotate calls on one host
+# costs one backup and one interface restart. VPNW_APPLY_DELAY=0 applies each at once.
+_APPLY_DELAY = float(os.getenv("VPNW_APPLY_DELAY", "2"))
+APPLY_QUEUE: Optional[ApplyQueue] = (
+    ApplyQueue(
+        delay=_APPLY_DELAY,
+        opener=lambda cfg: SSHRunner(cfg),
+        backend=get_backend(),
+        log=lambda msg: print(f"VPN Wizard: {msg}"),
+    )
+    if _APPLY_DELAY > 0
+    else None
+)
 
-JOB_STORE = JobStore()
+
+def _apply_error(ssh: SSHPayload) -> Optional[str]:
+    """Why queued peer changes for this server are not live, if their rebuild failed."""
+    failure = APPLY_QUEUE.failure(f"{ssh.host}:{ssh.port}") if APPLY_QUEUE is not None else None
+    if not failure:
+        return None
+    return f"Peer changes on {', '.join(failure['interfaces'])} were not applied: {failure['error']}"
 
 
 def _run_provision(job_id: str, payload: ProvisionRequest) -> None:
-    temp_key = TempKey()
+    timings = CommandTimings()
     try:
         JOB_STORE.update(job_id, status="running")
 
-        key_path = payload.ssh.key_path
-        if payload.ssh.key_content:
-            temp_key = _write_temp_key(payload.ssh.key_content)
-            key_path = temp_key.path
-
         def progress(msg: str) -> None:
             JOB_STORE.append_progress(job_id, msg)
 
         progress("Connecting over SSH")
-        cfg = SSHConfig(
-            host=payload.ssh.host,
-            user=payload.ssh.user,
-            port=payload.ssh.port,
-            password=payload.ssh.password,
-            key_path=key_path,
-        )
-        with SSHRunner(cfg, logger=progress) as ssh:
+        cfg = _ssh_config(payload.ssh)
+        with SSHRunner(cfg, logger=progress, on_command=timings) as ssh:
             opts = payload.options
             prov = WireGuardProvisioner(
                 ssh,
@@ -302,7 +355,8 @@ def _run_provision(job_id: str, payload: ProvisionRequest) -> None:
     except Exception as exc:
         JOB_STORE.update(job_id, status="error", error=str(exc))
     finally:
-        temp_key.cleanup()
+        JOB_STORE.update(job_id, timings=timings.breakdown())
+        _forget_status(payload.ssh)
 
 
 @app.get("/health")
@@ -329,6 +383,7 @@ def job_status(job_id: str) -> JobStatus:
         checks=job.checks,
         error=job.error,
         config_ready=bool(job.config),
+        timings=job.timings,
     )
 
 
@@ -350,83 +405,81 @@ def job_result(job_id: str) -> ProvisionResponse:
     )
 
 
+# Mutating endpoints run the blocking provisioner in a worker thread: it connects with
+# SSHRunner and may wait on the host lock, neither of which may stall the event loop.
+
+
 @app.post("/api/rollback", response_model=RollbackResponse)
 async def rollback(payload: RollbackRequest) -> RollbackResponse:
-    temp_key = TempKey()
+    def run() -> Optional[str]:
+        with SSHRunner(_ssh_config(payload.ssh)) as ssh:
+            return WireGuardProvisioner(ssh).rollback_last_backup()
+
     try:
-        key_path = payload.ssh.key_path
-        if payload.ssh.key_content:
-            temp_key = _write_temp_key(payload.ssh.key_content)
-            key_path = temp_key.path
-
-        cfg = SSHConfig(
-            host=payload.ssh.host,
-            user=payload.ssh.user,
-            port=payload.ssh.port,
-            password=payload.ssh.password,
-            key_path=key_path,
-        )
-        with SSHRunner(cfg) as ssh:
-            prov = WireGuardProvisioner(ssh)
-            backup = prov.rollback_last_backup()
+        backup = await asyncio.to_thread(run)
+        _forget_status(payload.ssh)
         if not backup:
             return RollbackResponse(ok=False, error="No backup found.")
         return RollbackResponse(ok=True, backup=backup)
     except Exception as exc:
         return RollbackResponse(ok=False, error=str(exc))
-    finally:
-        temp_key.cleanup()
+
+
+@app.post("/api/backups/list", response_model=BackupListResponse)
+async def backup_list(payload: RollbackRequest) -> BackupListResponse:
+    def run() -> list[dict]:
+        with SSHRunner(_ssh_config(payload.ssh)) as ssh:
+            return WireGuardProvisioner(ssh).list_backups()
+
+    try:
+        backups = await asyncio.to_thread(run)
+        return BackupListResponse(ok=True, backups=backups)
+    except Exception as exc:
+        return BackupListResponse(ok=False, error=str(exc))
+
+
+@app.post("/api/backups/restore", response_model=RollbackResponse)
+async def backup_restore(payload: BackupRestoreRequest) -> RollbackResponse:
+    def run() -> bool:
+        with SSHRunner(_ssh_config(payload.ssh)) as ssh:
+            return WireGuardProvisioner(ssh).restore_backup(payload.backup_id)
+
+    try:
+        restored = await asyncio.to_thread(run)
+        _forget_status(payload.ssh)
+        if not restored:
+            return RollbackResponse(ok=False, error="Backup not found.")
+        return RollbackResponse(ok=True, backup=payload.backup_id)
+    except Exception as exc:
+        return RollbackResponse(ok=False, error=str(exc))
 
 
 @app.post("/api/clients/list", response_model=ClientListResponse)
 async def client_list(payload: RollbackRequest) -> ClientListResponse:
-    temp_key = TempKey()
     try:
-        key_path = payload.ssh.key_path
-        if payload.ssh.key_content:
-            temp_key = _write_temp_key(payload.ssh.key_content)
-            key_path = temp_key.path
-
-        cfg = SSHConfig(
-            host=payload.ssh.host,
-            user=payload.ssh.user,
-            port=payload.ssh.port,
-            password=payload.ssh.password,
-            key_path=key_path,
-        )
-        with SSHRunner(cfg) as ssh:
-            prov = WireGuardProvisioner(ssh)
-            clients = prov.list_clients()
+        cfg = _ssh_config(payload.ssh)
+        async with AsyncSSHRunner(cfg) as ssh:
+            prov = AsyncWireGuardProvisioner(ssh)
+            clients = await prov.list_clients()
         return ClientListResponse(ok=True, clients=clients)
     except Exception as exc:
         return ClientListResponse(ok=False, error=str(exc))
-    finally:
-        temp_key.cleanup()
 
 
 @app.post("/api/clients/add", response_model=ClientAddResponse)
 async def client_add(payload: ClientRequest) -> ClientAddResponse:
-    temp_key = TempKey()
-    try:
-        key_path = payload.ssh.key_path
-        if payload.ssh.key_content:
-            temp_key = _write_temp_key(payload.ssh.key_content)
-            key_path = temp_key.path
-
-        cfg = SSHConfig(
-            host=payload.ssh.host,
-            user=payload.ssh.user,
-            port=payload.ssh.port,
-            password=payload.ssh.password,
-            key_path=key_path,
-        )
-        with SSHRunner(cfg) as ssh:
+    def run() -> tuple[WireGuardProvisioner, dict]:
+        with SSHRunner(_ssh_config(payload.ssh)) as ssh:
             prov_kwargs = {}
             if payload.listen_port:
                 prov_kwargs["listen_port"] = payload.listen_port
-            prov = WireGuardProvisioner(ssh, **prov_kwargs)
-            result = prov.add_client(client_name=payload.client_name, client_ip=payload.client_ip)
-        qr_b64 = _build_qr_base64(result["config"])
+            prov = WireGuardProvisioner(ssh, apply_queue=APPLY_QUEUE, **prov_kwargs)
+            return prov, prov.add_client(client_name=payload.client_name, client_ip=payload.client_ip)
+
+    try:
+        prov, result = await asyncio.to_thread(run)
+        _forget_status(payload.ssh)
+        qr_b64 = await _qr_base64(result["config"])
         return ClientAddResponse(
             ok=True,
             client_name=result["name"],
@@ -434,64 +487,67 @@ async def client_add(payload: ClientRequest) -> ClientAddResponse:
             config=result["config"],
             qr_png_base64=qr_b64,
             interface=result.get("interface"),
+            apply_pending=not prov.last_apply.done(),
         )
     except Exception as exc:
         return ClientAddResponse(ok=False, error=str(exc))
-    finally:
-        temp_key.cleanup()
 
 
 @app.post("/api/clients/remove", response_model=RollbackResponse)
 async def client_remove(payload: ClientRemoveRequest) -> RollbackResponse:
-    temp_key = TempKey()
+    def run() -> bool:
+        with SSHRunner(_ssh_config(payload.ssh)) as ssh:
+            return WireGuardProvisioner(ssh, apply_queue=APPLY_QUEUE).remove_client(payload.client_name)
+
     try:
-        key_path = payload.ssh.key_path
-        if payload.ssh.key_content:
-            temp_key = _write_temp_key(payload.ssh.key_content)
-            key_path = temp_key.path
-
-        cfg = SSHConfig(
-            host=payload.ssh.host,
-            user=payload.ssh.user,
-            port=payload.ssh.port,
-            password=payload.ssh.password,
-            key_path=key_path,
-        )
-        with SSHRunner(cfg) as ssh:
-            prov = WireGuardProvisioner(ssh)
-            ok = prov.remove_client(payload.client_name)
+        ok = await asyncio.to_thread(run)
+        _forget_status(payload.ssh)
         if not ok:
             return RollbackResponse(ok=False, error="Client not found.")
         return RollbackResponse(ok=True, backup=None)
     except Exception as exc:
         return RollbackResponse(ok=False, error=str(exc))
+
+
+@app.post("/api/clients/apply", response_model=RollbackResponse)
+async def client_apply(payload: RollbackRequest) -> RollbackResponse:
+    """Apply queued peer changes for a server now and return once they are live.
+
+    Changes whose earlier rebuild failed are rebuilt again, so this is also the retry.
+    """
+    if APPLY_QUEUE is None:
+        return RollbackResponse(ok=True)
+    key = f"{payload.ssh.host}:{payload.ssh.port}"
+
+    def run() -> None:
+        APPLY_QUEUE.flush(key)
+        if APPLY_QUEUE.failure(key):
+            with SSHRunner(_ssh_config(payload.ssh)) as ssh:
+                APPLY_QUEUE.reapply(WireGuardProvisioner(ssh))
+
+    try:
+        await asyncio.to_thread(run)
+        return RollbackResponse(ok=True)
+    except Exception:
+        return RollbackResponse(ok=False, error=_apply_error(payload.ssh))
     finally:
-        temp_key.cleanup()
+        _forget_status(payload.ssh)
 
 
 @app.post("/api/clients/rotate", response_model=ClientAddResponse)
 async def client_rotate(payload: ClientRemoveRequest) -> ClientAddResponse:
-    temp_key = TempKey()
-    try:
-        key_path = payload.ssh.key_path
-        if payload.ssh.key_content:
-            temp_key = _write_temp_key(payload.ssh.key_content)
-            key_path = temp_key.path
-
-        cfg = SSHConfig(
-            host=payload.ssh.host,
-            user=payload.ssh.user,
-            port=payload.ssh.port,
-            password=payload.ssh.password,
-            key_path=key_path,
-        )
-        with SSHRunner(cfg) as ssh:
+    def run() -> tuple[WireGuardProvisioner, dict]:
+        with SSHRunner(_ssh_config(payload.ssh)) as ssh:
             prov_kwargs = {}
             if payload.listen_port:
                 prov_kwargs["listen_port"] = payload.listen_port
-            prov = WireGuardProvisioner(ssh, **prov_kwargs)
-            result = prov.rotate_client(payload.client_name)
-        qr_b64 = _build_qr_base64(result["config"])
+            prov = WireGuardProvisioner(ssh, apply_queue=APPLY_QUEUE, **prov_kwargs)
+            return prov, prov.rotate_client(payload.client_name)
+
+    try:
+        prov, result = await asyncio.to_thread(run)
+        _forget_status(payload.ssh)
+        qr_b64 = await _qr_base64(result["config"])
         return ClientAddResponse(
             ok=True,
             client_name=result["name"],
@@ -499,33 +555,20 @@ async def client_rotate(payload: ClientRemoveRequest) -> ClientAddResponse:
             config=result["config"],
             qr_png_base64=qr_b64,
             interface=result.get("interface"),
+            apply_pending=not prov.last_apply.done(),
         )
     except Exception as exc:
         return ClientAddResponse(ok=False, error=str(exc))
-    finally:
-        temp_key.cleanup()
 
 
 @app.post("/api/clients/export", response_model=ClientExportResponse)
 async def client_export(payload: ClientRemoveRequest) -> ClientExportResponse:
-    temp_key = TempKey()
     try:
-        key_path = payload.ssh.key_path
-        if payload.ssh.key_content:
-            temp_key = _write_temp_key(payload.ssh.key_content)
-            key_path = temp_key.path
-
-        cfg = SSHConfig(
-            host=payload.ssh.host,
-            user=payload.ssh.user,
-            port=payload.ssh.port,
-            password=payload.ssh.password,
-            key_path=key_path,
-        )
-        with SSHRunner(cfg) as ssh:
-            prov = WireGuardProvisioner(ssh)
-            result = prov.export_client(payload.client_name)
-        qr_b64 = _build_qr_base64(result["config"])
+        cfg = _ssh_config(payload.ssh)
+        async with AsyncSSHRunner(cfg) as ssh:
+            prov = AsyncWireGuardProvisioner(ssh)
+            result = await prov.export_client(payload.client_name)
+        qr_b64 = await _qr_base64(result["config"])
         return ClientExportResponse(
             ok=True,
             client_name=result["name"],
@@ -536,16 +579,75 @@ async def client_export(payload: ClientRemoveRequest) -> ClientExportResponse:
         )
     except Exception as exc:
         return ClientExportResponse(ok=False, error=str(exc))
-    finally:
-        temp_key.cleanup()
+
+
+@app.post("/api/clients/find", response_model=ClientListResponse)
+async def client_find(payload: ClientFindRequest) -> ClientListResponse:
+    """Look a client up by name, public key or IP through the server's client index."""
+    if not (payload.name or payload.public_key or payload.ip):
+        return ClientListResponse(ok=False, error="Pass name, public_key or ip.")
+    try:
+        cfg = _ssh_config(payload.ssh)
+        async with AsyncSSHRunner(cfg) as ssh:
+            prov = AsyncWireGuardProvisioner(ssh)
+            entry = await prov.find_client(payload.name, payload.public_key, payload.ip)
+        return ClientListResponse(ok=True, clients=[entry] if entry else [])
+    except Exception as exc:
+        return ClientListResponse(ok=False, error=str(exc))
+
+
+@app.post("/api/clients/export_all")
+async def client_export_all(payload: ClientExportAllRequest) -> StreamingResponse:
+    """ZIP of every client's config and QR codes plus manifest.csv, streamed as it is built."""
+    cfg = _ssh_config(payload.ssh)
+    try:
+        async with AsyncSSHRunner(cfg) as ssh:
+            clients = await AsyncWireGuardProvisioner(ssh).export_all_clients()
+    except Exception as exc:
+        raise HTTPException(status_code=502, detail=str(exc)) from exc
+    # A plain generator: Starlette iterates it in a worker thread, so waiting on the QR
+    # process pool never blocks the event loop.
+    filename = f"vpn-clients-{payload.ssh.host}.zip".replace(":", "_")
+    return StreamingResponse(
+        iter_clients_zip(clients, payload.qr_formats),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+class LogsRequest(BaseModel):
+    ssh: SSHPayload
+    sections: Optional[list[str]] = None
+    timeout: float = Field(default=10.0, gt=0, le=120)
+    max_bytes: int = Field(default=65536, gt=0, le=1048576)
+    compress: bool = True
 
 
 class LogsResponse(BaseModel):
     ok: bool
     logs: Optional[str] = None
+    sections: list[dict] = []
     error: Optional[str] = None
 
 
+class StatusRequest(BaseModel):
+    ssh: SSHPayload
+    refresh: bool = False
+
+
+class InterfaceStatus(BaseModel):
+    name: str
+    protocol: str
+    listen_port: Optional[int] = None
+    address: Optional[str] = None
+    clients_count: int = 0
+    service: Optional[str] = None
+    peers: int = 0
+    peers_with_handshake: int = 0
+    peers_active: int = 0
+    last_handshake: Optional[int] = None
+
+
 class ServerStatusResponse(BaseModel):
     ok: bool
     configured: bool
@@ -554,151 +656,266 @@ class ServerStatusResponse(BaseModel):
     server_cidr: Optional[str] = None
     clients_count: int = 0
     tyumen_port: Optional[int] = None
+    service: Optional[str] = None
+    uptime_seconds: Optional[float] = None
+    last_handshake: Optional[int] = None
+    interfaces: list[InterfaceStatus] = []
+    apply_error: Optional[str] = None
     error: Optional[str] = None
 
 
+class StatusManyRequest(BaseModel):
+    servers: list[SSHPayload] = Field(..., max_length=200)
+    timeout: float = Field(default=10.0, gt=0, le=120)
+    concurrency: int = Field(default=16, ge=1)
+    refresh: bool = False
+
+
+class ServerStatusItem(ServerStatusResponse):
+    index: int
+    host: str
+    port: int
+    elapsed: float
+
+
 class PrecheckResponse(BaseModel):
     ok: bool
     checks: list[CheckItem] = []
     error: Optional[str] = None
 
 
-def _detect_server_status(ssh: SSHRunner) -> dict:
-    awg_conf = "/etc/amnezia/amneziawg/awg0.conf"
-    wg_conf = "/etc/wireguard/wg0.conf"
-    has_awg = ssh.run(f"test -f {awg_conf} && echo yes || echo no", sudo=True, check=False).strip() == "yes"
-    has_wg = ssh.run(f"test -f {wg_conf} && echo yes || echo no", sudo=True, check=False).strip() == "yes"
-    if not has_awg and not has_wg:
-        return {"configured": False}
-
-    protocol = "amneziawg" if has_awg else "wireguard"
-    conf_path = awg_conf if has_awg else wg_conf
-    clients_dir = "/etc/amnezia/amneziawg/clients" if has_awg else "/etc/wireguard/clients"
-
-    listen_port_raw = ssh.run(
-        f"awk -F'= ' '/^ListenPort/{{print $2; exit}}' {conf_path} 2>/dev/null || true",
-        sudo=True,
-        check=False,
-    ).strip()
-    listen_port = int(listen_port_raw) if listen_port_raw.isdigit() else None
-
-    server_cidr = ssh.run(
-        f"awk -F'= ' '/^Address/{{print $2; exit}}' {conf_path} 2>/dev/null || true",
-        sudo=True,
-        check=False,
-    ).strip() or None
-
-    clients_count_raw = ssh.run(
-        f"ls -1 {clients_dir}/*.conf 2>/dev/null | wc -l",
-        sudo=True,
-        check=False,
-    ).strip()
-    clients_count = int(clients_count_raw) if clients_count_raw.isdigit() else 0
-    if has_awg:
-        tyumen_count_raw = ssh.run(
-            "ls -1 /etc/amnezia/amneziawg/clients_tyumen/*.conf 2>/dev/null | wc -l",
-            sudo=True,
-            check=False,
-        ).strip()
-        if tyumen_count_raw.isdigit():
-            clients_count += int(tyumen_count_raw)
-
-    tyumen_port_raw = ssh.run(
-        "awk -F'= ' '/^ListenPort/{{print $2; exit}}' /etc/amnezia/amneziawg/awg1.conf 2>/dev/null || true",
-        sudo=True,
-        check=False,
-    ).strip()
-    tyumen_port = int(tyumen_port_raw) if tyumen_port_raw.isdigit() else None
+class PlanStep(BaseModel):
+    step: str
+    label: str
+    action: str
+    reason: str
+    diff: str = ""
+    recorded: Optional[str] = None
+    fingerprint: Optional[str] = None
 
+
+class ProvisionPlanResponse(BaseModel):
+    ok: bool
+    steps: list[PlanStep] = []
+    error: Optional[str] = None
+
+
+# One round trip for the whole status: every known interface config is probed in a
+# single script. Peers count as active when their last handshake is under 3 minutes old.
+_STATUS_SCRIPT = r"""
+now=$(date +%s)
+for conf in /etc/amnezia/amneziawg/awg0.conf /etc/amnezia/amneziawg/awg1.conf /etc/wireguard/wg0.conf; do
+  [ -f "$conf" ] || continue
+  name=$(basename "$conf" .conf)
+  case "$name" in
+    awg0) proto=amneziawg; tool=awg; clients=/etc/amnezia/amneziawg/clients ;;
+    awg1) proto=amneziawg; tool=awg; clients=/etc/amnezia/amneziawg/clients_tyumen ;;
+    *) proto=wireguard; tool=wg; clients=/etc/wireguard/clients ;;
+  esac
+  echo "@@iface $name $proto"
+  awk -F' *= *' '/^ListenPort/ && !p {p=1; print "port=" $2} /^Address/ && !a {a=1; print "address=" $2}' "$conf"
+  echo "clients=$(ls -1 "$clients"/*.conf 2>/dev/null | wc -l)"
+  echo "service=$(systemctl is-active "$tool-quick@$name" 2>/dev/null)"
+  $tool show "$name" latest-handshakes 2>/dev/null | awk -v now="$now" '
+    NF == 2 && $2 ~ /^[0-9]+$/ {n++; if ($2 > 0) {h++; if (now - $2 < 180) a++; if ($2 > m) m = $2}}
+    END {printf "peers=%d\nhandshakes=%d\nactive=%d\nlatest=%d\n", n, h, a, m}'
+done
+echo "@@host"
+echo "uptime=$(cut -d' ' -f1 /proc/uptime 2>/dev/null)"
+"""
+
+
+def _server_status_ops() -> Ops[dict]:
+    out = yield Command(_STATUS_SCRIPT, sudo=True, check=False, pty=False)
+    interfaces: dict[str, dict] = {}
+    host: dict[str, str] = {}
+    current: Optional[dict] = None
+    for line in out.splitlines():
+        line = line.strip()
+        if line.startswith("@@iface "):
+            _, name, protocol = line.split(" ", 2)
+            current = interfaces[name] = {"name": name, "protocol": protocol}
+        elif line == "@@host":
+            current = host
+        elif "=" in line and current is not None:
+            key, value = line.split("=", 1)
+            current[key] = value.strip()
+
+    def number(data: dict, key: str) -> Optional[int]:
+        value = data.get(key, "")
+        return int(value) if value.isdigit() else None
+
+    items = [
+        {
+            "name": data["name"],
+            "protocol": data["protocol"],
+            "listen_port": number(data, "port"),
+            "address": data.get("address") or None,
+            "clients_count": number(data, "clients") or 0,
+            "service": data.get("service") or None,
+            "peers": number(data, "peers") or 0,
+            "peers_with_handshake": number(data, "handshakes") or 0,
+            "peers_active": number(data, "active") or 0,
+            "last_handshake": number(data, "latest") or None,
+        }
+        for data in interfaces.values()
+    ]
+    primary = interfaces.get("awg0") or interfaces.get("wg0")
+    if primary is None:
+        return {"configured": False, "interfaces": items}
+
+    by_name = {item["name"]: item for item in items}
+    main = by_name[primary["name"]]
+    tyumen = by_name.get("awg1")
+    clients_count = main["clients_count"]
+    if main["protocol"] == "amneziawg" and tyumen:
+        clients_count += tyumen["clients_count"]
+    handshakes = [item["last_handshake"] for item in items if item["last_handshake"]]
+    try:
+        uptime = float(host.get("uptime", ""))
+    except ValueError:
+        uptime = None
     return {
         "configured": True,
-        "protocol": protocol,
-        "listen_port": listen_port,
-        "server_cidr": server_cidr,
+        "protocol": main["protocol"],
+        "listen_port": main["listen_port"],
+        "server_cidr": main["address"],
         "clients_count": clients_count,
-        "tyumen_port": tyumen_port,
+        "tyumen_port": tyumen["listen_port"] if tyumen else None,
+        "service": main["service"],
+        "uptime_seconds": uptime,
+        "last_handshake": max(handshakes) if handshakes else None,
+        "interfaces": items,
     }
 
+
+# Status results are cached briefly in the state backend (shared between API workers)
+# and served with an ETag, so the miniapp's refreshes cost no SSH round trip at all.
+STATUS_TTL = float(os.getenv("VPNW_STATUS_TTL", "15"))
+
+
+def _status_cache_key(ssh: SSHPayload) -> str:
+    return f"status:{ssh.host}:{ssh.port}"
+
+
+# Keys the credential check stored with cached entries, so the state file holds no
+# guessable hash of passwords or keys. Without VPNW_STATUS_SECRET each process draws
+# its own (and `main` shares one between its workers).
+_STATUS_SECRET = (os.getenv("VPNW_STATUS_SECRET") or "").encode("utf-8") or secrets.token_bytes(32)
+
+
+def _status_auth(ssh: SSHPayload) -> str:
+    # Entries are per server but only served to callers presenting the same credentials.
+    creds = [ssh.host, ssh.port, ssh.user, ssh.password, ssh.key_path, ssh.key_content]
+    return hmac.new(_STATUS_SECRET, json.dumps(creds).encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+# Status probes keep their SSH connections open for reuse (VPNW_SSH_POOL_IDLE seconds),
+# so repeated and fan-out probes skip the handshake.
+SSH_POOL = AsyncSSHPool(lambda cfg: AsyncSSHRunner(cfg), idle=float(os.getenv("VPNW_SSH_POOL_IDLE", "60")))
+STATUS_MAX_CONCURRENCY = int(os.getenv("VPNW_STATUS_CONCURRENCY", "16"))
+
+
+def _forget_status(ssh: SSHPayload) -> None:
+    get_backend().delete(_status_cache_key(ssh))
+
+
 @app.post("/api/logs", response_model=LogsResponse)
-async def get_logs(payload: RollbackRequest) -> LogsResponse:
-    temp_key = TempKey()
+async def get_logs(payload: LogsRequest) -> LogsResponse:
     try:
-        key_path = payload.ssh.key_path
-        if payload.ssh.key_content:
-            temp_key = _write_temp_key(payload.ssh.key_content)
-            key_path = temp_key.path
-
-        cfg = SSHConfig(
-            host=payload.ssh.host,
-            user=payload.ssh.user,
-            port=payload.ssh.port,
-            password=payload.ssh.password,
-            key_path=key_path,
-        )
-        with SSHRunner(cfg) as ssh:
-            prov = WireGuardProvisioner(ssh)
-            report = prov.get_system_report()
-            
-        return LogsResponse(ok=True, logs=report)
+        cfg = _ssh_config(payload.ssh)
+        async with AsyncSSHRunner(cfg) as ssh:
+            prov = AsyncWireGuardProvisioner(ssh)
+            sections = await prov.collect_diagnostics(
+                payload.sections,
+                timeout=payload.timeout,
+                max_bytes=payload.max_bytes,
+                compress=payload.compress,
+            )
+        return LogsResponse(ok=True, logs=prov.sync.format_report(sections), sections=sections)
     except Exception as exc:
         return LogsResponse(ok=False, error=str(exc))
-    finally:
-        temp_key.cleanup()
+
+
+async def _probe_status(ssh_payload: SSHPayload, refresh: bool = False) -> tuple[dict, str]:
+    """Server status and its ETag, from the cache when fresh, otherwise over a pooled connection."""
+    backend = get_backend()
+    key = _status_cache_key(ssh_payload)
+    auth = _status_auth(ssh_payload)
+    cached = None if refresh or STATUS_TTL <= 0 else backend.get(key)
+    if cached and hmac.compare_digest(str(cached.get("auth", "")), auth):
+        return cached["status"], cached["etag"]
+    async with SSH_POOL.connection(_ssh_config(ssh_payload)) as ssh:
+        status = await arun_ops(ssh, _server_status_ops())
+    # Weak ETag: uptime ticks on every probe but alone is not worth a re-render.
+    stable = {k: v for k, v in status.items() if k != "uptime_seconds"}
+    etag = 'W/"' + hashlib.sha256(json.dumps(stable, sort_keys=True).encode("utf-8")).hexdigest()[:32] + '"'
+    if STATUS_TTL > 0:
+        backend.set(key, {"auth": auth, "status": status, "etag": etag}, ttl=STATUS_TTL)
+    return status, etag
 
 
 @app.post("/api/server/status", response_model=ServerStatusResponse)
-async def server_status(payload: RollbackRequest) -> ServerStatusResponse:
-    temp_key = TempKey()
+async def server_status(
+    payload: StatusRequest,
+    request: Request,
+    response: Response,
+) -> ServerStatusResponse:
     try:
-        key_path = payload.ssh.key_path
-        if payload.ssh.key_content:
-            temp_key = _write_temp_key(payload.ssh.key_content)
-            key_path = temp_key.path
-
-        cfg = SSHConfig(
-            host=payload.ssh.host,
-            user=payload.ssh.user,
-            port=payload.ssh.port,
-            password=payload.ssh.password,
-            key_path=key_path,
+        status, etag = await _probe_status(payload.ssh, payload.refresh)
+    except Exception as exc:
+        return ServerStatusResponse(ok=False, configured=False, error=str(exc))
+    apply_error = _apply_error(payload.ssh)
+    if apply_error:
+        etag = f'{etag[:-1]}-{hashlib.sha256(apply_error.encode("utf-8")).hexdigest()[:8]}"'
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={int(STATUS_TTL)}"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return ServerStatusResponse(ok=True, apply_error=apply_error, **status)
+
+
+@app.post("/api/servers/status_many")
+async def servers_status_many(payload: StatusManyRequest) -> StreamingResponse:
+    """Probe many servers at once; one NDJSON line per server, in completion order."""
+    limit = asyncio.Semaphore(min(payload.concurrency, STATUS_MAX_CONCURRENCY))
+
+    async def probe(index: int, ssh_payload: SSHPayload) -> ServerStatusItem:
+        started = time.monotonic()
+        async with limit:
+            try:
+                status, _ = await asyncio.wait_for(_probe_status(ssh_payload, payload.refresh), payload.timeout)
+                result = ServerStatusResponse(ok=True, apply_error=_apply_error(ssh_payload), **status)
+            except asyncio.TimeoutError:
+                result = ServerStatusResponse(
+                    ok=False, configured=False, error=f"Timed out after {payload.timeout:g}s."
+                )
+            except Exception as exc:
+                result = ServerStatusResponse(ok=False, configured=False, error=str(exc))
+        return ServerStatusItem(
+            index=index,
+            host=ssh_payload.host,
+            port=ssh_payload.port,
+            elapsed=round(time.monotonic() - started, 3),
+            **result.model_dump(),
         )
-        with SSHRunner(cfg) as ssh:
-            status = _detect_server_status(ssh)
 
-        if not status.get("configured"):
-            return ServerStatusResponse(ok=True, configured=False)
+    async def lines() -> AsyncIterator[str]:
+        tasks = [asyncio.create_task(probe(i, item)) for i, item in enumerate(payload.servers)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield (await finished).model_dump_json() + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()  # the client went away; stop probing
 
-        return ServerStatusResponse(
-            ok=True,
-            configured=True,
-            protocol=status.get("protocol"),
-            listen_port=status.get("listen_port"),
-            server_cidr=status.get("server_cidr"),
-            clients_count=status.get("clients_count", 0),
-            tyumen_port=status.get("tyumen_port"),
-        )
-    except Exception as exc:
-        return ServerStatusResponse(ok=False, configured=False, error=str(exc))
-    finally:
-        temp_key.cleanup()
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 
 @app.post("/api/server/precheck", response_model=PrecheckResponse)
 async def server_precheck(payload: ProvisionRequest) -> PrecheckResponse:
-    temp_key = TempKey()
     try:
-        key_path = payload.ssh.key_path
-        if payload.ssh.key_content:
-            temp_key = _write_temp_key(payload.ssh.key_content)
-            key_path = temp_key.path
-
-        cfg = SSHConfig(
-            host=payload.ssh.host,
-            user=payload.ssh.user,
-            port=payload.ssh.port,
-            password=payload.ssh.password,
-            key_path=key_path,
-        )
+        cfg = _ssh_config(payload.ssh)
         with SSHRunner(cfg) as ssh:
             opts = payload.options
             prov = WireGuardProvisioner(
@@ -717,8 +934,76 @@ async def server_precheck(payload: ProvisionRequest) -> PrecheckResponse:
         return PrecheckResponse(ok=True, checks=checks)
     except Exception as exc:
         return PrecheckResponse(ok=False, error=str(exc))
-    finally:
-        temp_key.cleanup()
+
+
+@app.post("/api/provision/plan", response_model=ProvisionPlanResponse)
+async def provision_plan(payload: ProvisionRequest) -> ProvisionPlanResponse:
+    try:
+        cfg = _ssh_config(payload.ssh)
+        with SSHRunner(cfg) as ssh:
+            opts = payload.options
+            prov = WireGuardProvisioner(
+                ssh,
+                client_name=opts.client_name,
+                client_ip=opts.client_ip,
+                server_cidr=opts.server_cidr,
+                listen_port=opts.listen_port,
+                dns=opts.dns,
+                mtu=opts.mtu,
+                auto_mtu=opts.auto_mtu,
+                tune=opts.tune,
+                protocol=opts.protocol,
+            )
+            steps = prov.plan_provision()
+        return ProvisionPlanResponse(ok=True, steps=steps)
+    except Exception as exc:
+        return ProvisionPlanResponse(ok=False, error=str(exc))
+
+
+class ChangePlanRequest(BaseModel):
+    ssh: SSHPayload
+    operation: Literal["add_client", "remove_client", "rotate_client", "repair_network"]
+    client_name: Optional[str] = None
+    client_ip: Optional[str] = None
+    listen_port: Optional[int] = None
+
+
+class FileChangeItem(BaseModel):
+    path: str
+    action: str
+    diff: str
+
+
+class ChangePlanResponse(BaseModel):
+    ok: bool
+    operation: Optional[str] = None
+    changes: list[FileChangeItem] = []
+    commands: list[str] = []
+    notes: list[str] = []
+    result: dict = {}
+    diff: str = ""
+    error: Optional[str] = None
+
+
+@app.post("/api/plan", response_model=ChangePlanResponse)
+async def change_plan(payload: ChangePlanRequest) -> ChangePlanResponse:
+    """Dry run of a mutating operation: unified diff and commands, one read round trip."""
+    kwargs: dict = {}
+    if payload.operation == "add_client":
+        kwargs = {"client_name": payload.client_name, "client_ip": payload.client_ip}
+    elif payload.operation in ("remove_client", "rotate_client"):
+        if not payload.client_name:
+            return ChangePlanResponse(ok=False, error="client_name is required.")
+        kwargs = {"client_name": payload.client_name}
+    try:
+        cfg = _ssh_config(payload.ssh)
+        prov_kwargs = {"listen_port": payload.listen_port} if payload.listen_port else {}
+        async with AsyncSSHRunner(cfg) as ssh:
+            prov = AsyncWireGuardProvisioner(ssh, apply_queue=APPLY_QUEUE, **prov_kwargs)
+            plan = await prov.plan(payload.operation, **kwargs)
+        return ChangePlanResponse(ok=True, **plan.as_dict())
+    except Exception as exc:
+        return ChangePlanResponse(ok=False, error=str(exc))
 
 
 @app.post("/api/repair", response_model=JobCreateResponse)
@@ -726,21 +1011,10 @@ async def run_repair(payload: RollbackRequest, background_tasks: BackgroundTasks
     job = JOB_STORE.create()
     
     def _do_repair(job_id: str, payload: RollbackRequest):
-        temp_key = TempKey()
         try:
             JOB_STORE.update(job_id, status="running")
-            key_path = payload.ssh.key_path
-            if payload.ssh.key_content:
-                temp_key = _write_temp_key(payload.ssh.key_content)
-                key_path = temp_key.path
-
-            cfg = SSHConfig(
-                host=payload.ssh.host,
-                user=payload.ssh.user,
-                port=payload.ssh.port,
-                password=payload.ssh.password,
-                key_path=key_path,
-            )
+
+            cfg = _ssh_config(payload.ssh)
             
             def progress(msg: str) -> None:
                 JOB_STORE.append_progress(job_id, msg)
@@ -753,7 +1027,7 @@ async def run_repair(payload: RollbackRequest, background_tasks: BackgroundTasks
         except Exception as exc:
             JOB_STORE.update(job_id, status="error", error=str(exc))
         finally:
-            temp_key.cleanup()
+            _forget_status(payload.ssh)
 
     background_tasks.add_task(_do_repair, job.job_id, payload)
     return JobCreateResponse(job_id=job.job_id)
@@ -769,10 +1043,24 @@ def _mount_miniapp() -> None:
 _mount_miniapp()
 
 
-def main() -> None:
-    host = os.getenv("VPNW_HOST", "0.0.0.0")
-    port = int(os.getenv("VPNW_PORT") or os.getenv("PORT", "8000"))
-    uvicorn.run("vpn_wizard.server:app", host=host, port=port, reload=False)
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="vpnw-server", description="VPN Wizard API server")
+    parser.add_argument("--host", default=os.getenv("VPNW_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("VPNW_PORT") or os.getenv("PORT", "8000")))
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("VPNW_WORKERS", "1")),
+        help="Worker processes; with more than one, jobs are shared through VPNW_STATE_DB",
+    )
+    args = parser.parse_args(argv)
+    if args.workers > 1 and not os.getenv("VPNW_STATE_DB"):
+        # Workers are separate processes; they inherit this and share one SQLite file.
+        os.environ["VPNW_STATE_DB"] = default_state_path()
+    if args.workers > 1 and not os.getenv("VPNW_STATUS_SECRET"):
+        # Lets workers serve each other's cached status entries.
+        os.environ["VPNW_STATUS_SECRET"] = secrets.token_hex(32)
+    uvicorn.run("vpn_wizard.server:app", host=args.host, port=args.port, workers=args.workers, reload=False)
 
 
 if __name__ == "__main__":
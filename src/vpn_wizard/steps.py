@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+import time
+from typing import Callable, Optional
+
+
+@dataclass
+class Step:
+    name: str
+    action: Callable[[], object]
+    deps: tuple[str, ...] = ()
+    skip: Optional[Callable[[], bool]] = None
+    label: Optional[str] = None
+
+
+@dataclass
+class StepResult:
+    name: str
+    status: str  # "done", "skipped" or "failed"
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+
+class StepGraph:
+    """Runs steps as soon as their dependencies finish, independent steps in parallel.
+
+    A step whose `skip` predicate returns True when it becomes ready is recorded as
+    skipped and counts as finished for its dependents. The first failure stops new steps
+    from being scheduled; running ones are allowed to finish and the original exception
+    is re-raised. `results` is filled in either way, so callers can persist progress.
+    """
+
+    def __init__(self, steps: list[Step]) -> None:
+        self.steps = {step.name: step for step in steps}
+        if len(self.steps) != len(steps):
+            raise ValueError("Duplicate step names.")
+        for step in steps:
+            missing = [dep for dep in step.deps if dep not in self.steps]
+            if missing:
+                raise ValueError(f"Step {step.name} depends on unknown steps: {', '.join(missing)}")
+        self._check_acyclic()
+        self.results: dict[str, StepResult] = {}
+
+    def _check_acyclic(self) -> None:
+        visiting: set[str] = set()
+        visited: set[str] = set()
+
+        def visit(name: str) -> None:
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(f"Dependency cycle through step {name}.")
+            visiting.add(name)
+            for dep in self.steps[name].deps:
+                visit(dep)
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self.steps:
+            visit(name)
+
+    def _timed(self, step: Step, on_start: Callable[[Step], None]) -> float:
+        started = time.monotonic()
+        on_start(step)
+        step.action()
+        return time.monotonic() - started
+
+    def run(
+        self,
+        max_workers: int = 4,
+        on_start: Optional[Callable[[Step], None]] = None,
+        on_skip: Optional[Callable[[Step], None]] = None,
+    ) -> dict[str, StepResult]:
+        on_start = on_start or (lambda _: None)
+        on_skip = on_skip or (lambda _: None)
+        pending = dict(self.steps)
+        running: dict[Future, Step] = {}
+        failure: Optional[BaseException] = None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            while pending or running:
+                if failure is None:
+                    progressed = True
+                    while progressed:
+                        progressed = False
+                        for name, step in list(pending.items()):
+                            if not all(dep in self.results for dep in step.deps):
+                                continue
+                            del pending[name]
+                            if step.skip and step.skip():
+                                self.results[name] = StepResult(name, "skipped")
+                                on_skip(step)
+                                progressed = True
+                                continue
+                            running[pool.submit(self._timed, step, on_start)] = step
+                if not running:
+                    break
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    try:
+                        seconds = future.result()
+                    except BaseException as exc:  # noqa: BLE001 - re-raised below
+                        self.results[step.name] = StepResult(step.name, "failed", error=str(exc))
+                        if failure is None:
+                            failure = exc
+                        continue
+                    self.results[step.name] = StepResult(step.name, "done", round(seconds, 3))
+        if failure is not None:
+            raise failure
+        return self.results
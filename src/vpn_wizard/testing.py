@@ -0,0 +1,646 @@
+from __future__ import annotations
+
+import base64
+import fcntl
+import hashlib
+import os
+from contextlib import contextmanager
+from pathlib import Path
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Callable, Iterator, Optional
+
+from vpn_wizard.core import CommandStat, RemoteCommandError, SSHConfig
+
+
+# Simulated remote cost (seconds) for commands matching a substring, on top of `cpu_cost`.
+DEFAULT_COMMAND_COSTS: dict[str, float] = {
+    "apt-get update": 8.0,
+    "apt-get install": 25.0,
+    "apt-get -o DPkg::Lock::Timeout=300 update": 8.0,
+    "apt-get -o DPkg::Lock::Timeout=300 install": 25.0,
+    "add-apt-repository": 6.0,
+    "apt-get autoremove": 4.0,
+    "sysctl --system": 0.3,
+    "ufw reload": 1.0,
+    "firewall-cmd --reload": 1.0,
+    "systemctl enable --now": 1.5,
+    "ping -c 1": 0.05,
+    "curl -s https://api.ipify.org": 0.3,
+}
+
+_REMOTE_ROOTS = ("etc", "var", "tmp", "run", "lib", "boot")
+_PATH_RE = re.compile(r"(?<![\w.~-])/(%s)(?=/|\b)" % "|".join(_REMOTE_ROOTS))
+
+_WG_STUB = """#!/usr/bin/env bash
+case "$1" in
+  genkey) head -c 32 /dev/urandom | base64 ;;
+  pubkey) read -r key; printf '%s' "$key" | sha256sum | head -c 32 | base64 ;;
+  set) echo "$*" >> "$VPNW_SIM_ROOT/run/wg-set.log" ;;
+  show)
+    if [ "$3" = latest-handshakes ]; then
+      for conf in "$VPNW_SIM_ROOT/etc/wireguard/$2.conf" "$VPNW_SIM_ROOT/etc/amnezia/amneziawg/$2.conf"; do
+        [ -f "$conf" ] && awk -F' = ' '/^PublicKey/{print $2 "\t0"}' "$conf"
+      done
+    elif [ -n "$2" ] && [ "$2" != "all" ]; then
+      echo "interface: $2"
+    fi
+    ;;
+esac
+exit 0
+"""
+
+_STUBS = {
+    "apt-get": """#!/usr/bin/env bash
+db="$VPNW_SIM_ROOT/var/lib/dpkg/sim-installed"
+action=""
+for arg in "$@"; do
+  case "$arg" in
+    -*|*=*) ;;
+    update) touch "$VPNW_SIM_ROOT/var/lib/apt/lists/sim_main_Packages" ;;
+    install|purge|autoremove|clean|download) action="$arg" ;;
+    *)
+      if [ "$action" = download ]; then
+        echo "sim" > "${arg}_1.0_all.deb"
+        continue
+      fi
+      [ "$action" = install ] || continue
+      pkg="$arg"
+      case "$arg" in */*.deb) pkg=$(basename "$arg"); pkg="${pkg%%_*}" ;; esac
+      echo "$pkg" >> "$db"
+      case "$pkg" in
+        wireguard|wireguard-tools) cp "$VPNW_SIM_STUBS/wg" "$VPNW_SIM_BIN/wg" ;;
+        amneziawg|amneziawg-tools) cp "$VPNW_SIM_STUBS/wg" "$VPNW_SIM_BIN/awg" ;;
+      esac
+      ;;
+  esac
+done
+exit 0
+""",
+    "dpkg-query": """#!/usr/bin/env bash
+db="$VPNW_SIM_ROOT/var/lib/dpkg/sim-installed"
+fmt=""
+status=0
+while [ $# -gt 0 ]; do
+  case "$1" in
+    -f) fmt="$2"; shift ;;
+    -*) ;;
+    *)
+      if grep -qx "$1" "$db" 2>/dev/null; then
+        case "$fmt" in
+          *Last-Modified*) echo "$1 $(date +%s)" ;;
+          *) echo "$1 installed" ;;
+        esac
+      else
+        echo "dpkg-query: no packages found matching $1" >&2
+        status=1
+      fi
+      ;;
+  esac
+  shift
+done
+exit $status
+""",
+    "ping": """#!/usr/bin/env bash
+size=56
+while [ $# -gt 0 ]; do
+  case "$1" in
+    -h) echo "Usage: ping [options] <destination>"; echo "  -M <pmtud opt>     define mtu discovery"; exit 2 ;;
+    -s) size="$2"; shift ;;
+  esac
+  shift
+done
+[ "$size" -le "$VPNW_SIM_MAX_PAYLOAD" ]
+""",
+    "curl": """#!/usr/bin/env bash
+echo "$VPNW_SIM_PUBLIC_IP"
+""",
+    "ip": """#!/usr/bin/env bash
+case "$*" in
+  *"route get"*) echo "1.1.1.1 via 10.0.0.1 dev eth0 src 10.0.0.2 uid 0" ;;
+  *"link show"*) exit 0 ;;
+  *) echo "1: lo: <LOOPBACK,UP,LOWER_UP> mtu 65536"; echo "2: eth0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500" ;;
+esac
+exit 0
+""",
+    "systemctl": """#!/usr/bin/env bash
+case "$1" in
+  is-active) echo active ;;
+  status) echo "* ${2:-unit} - active (running)" ;;
+esac
+exit 0
+""",
+    "sysctl": """#!/usr/bin/env bash
+[ "$1" = "-n" ] && echo 1
+exit 0
+""",
+    "ss": """#!/usr/bin/env bash
+echo "State  Recv-Q Send-Q Local Address:Port Peer Address:Port"
+for conf in "$VPNW_SIM_ROOT"/etc/wireguard/*.conf "$VPNW_SIM_ROOT"/etc/amnezia/amneziawg/*.conf; do
+  [ -f "$conf" ] || continue
+  port=$(awk -F'= ' '/^ListenPort/{print $2; exit}' "$conf")
+  [ -n "$port" ] && echo "UNCONN 0      0      0.0.0.0:$port 0.0.0.0:* "
+done
+exit 0
+""",
+    "sudo": """#!/usr/bin/env bash
+while [ $# -gt 0 ]; do
+  case "$1" in
+    -S|-n) shift ;;
+    -p) shift 2 ;;
+    *) break ;;
+  esac
+done
+exec "$@"
+""",
+}
+
+_NOOP_STUBS = (
+    "add-apt-repository",
+    "apt-key",
+    "depmod",
+    "dkms",
+    "dnf",
+    "dpkg",
+    "firewall-cmd",
+    "ip6tables",
+    "iptables",
+    "journalctl",
+    "killall",
+    "modinfo",
+    "modprobe",
+    "qrencode",
+    "ufw",
+    "wget",
+    "yum",
+)
+
+
+def _fake_key(seed: str) -> str:
+    return base64.b64encode(hashlib.sha256(seed.encode("utf-8")).digest()).decode("ascii")
+
+
+class SimulatedSSH:
+    """Drop-in SSHRunner replacement that runs commands against a local sandbox.
+
+    Absolute remote paths (/etc, /var, /tmp, ...) are rewritten into a temporary root and
+    system tools (wg, awg, apt-get, systemctl, ping, ...) are replaced by stubs, so the
+    provisioner's real shell scripts execute against a virtual filesystem. Every call is
+    charged `latency` seconds of round-trip time plus `cpu_cost` (and any matching
+    `command_costs`) seconds of remote work on a simulated clock; with `realtime=True` the
+    delay is also slept, which makes concurrent callers overlap like real channels do.
+    """
+
+    def __init__(
+        self,
+        clients: int = 0,
+        protocol: str = "amneziawg",
+        latency: float = 0.05,
+        cpu_cost: float = 0.005,
+        command_costs: Optional[dict[str, float]] = None,
+        realtime: bool = False,
+        installed: bool = True,
+        public_ip: str = "203.0.113.10",
+        max_payload: int = 1432,
+        on_command: Optional[Callable[[CommandStat], None]] = None,
+    ) -> None:
+        self.config = SSHConfig(host=public_ip, user="root")
+        self.protocol = protocol
+        self.latency = latency
+        self.cpu_cost = cpu_cost
+        self.command_costs = DEFAULT_COMMAND_COSTS if command_costs is None else command_costs
+        self.realtime = realtime
+        self.on_command = on_command
+        self.commands: list[str] = []
+        self.simulated_seconds = 0.0
+        self._lock = threading.Lock()
+        self.root = Path(tempfile.mkdtemp(prefix="vpnw-sim-"))
+        self._bin = self.root / ".bin"
+        self._stubs = self.root / ".stubs"
+        self._env = dict(os.environ)
+        self._env.update(
+            {
+                "PATH": f"{self._bin}:{os.environ.get('PATH', '/usr/bin:/bin')}",
+                "TMPDIR": str(self.root / "tmp"),
+                "VPNW_SIM_ROOT": str(self.root),
+                "VPNW_SIM_BIN": str(self._bin),
+                "VPNW_SIM_STUBS": str(self._stubs),
+                "VPNW_SIM_PUBLIC_IP": public_ip,
+                "VPNW_SIM_MAX_PAYLOAD": str(max_payload),
+            }
+        )
+        self._local = threading.local()
+        self._seed_system(installed)
+        if clients:
+            self.seed_clients(clients)
+
+    @property
+    def phase(self) -> Optional[str]:
+        return getattr(self._local, "phase", None)
+
+    @phase.setter
+    def phase(self, value: Optional[str]) -> None:
+        self._local.phase = value
+
+    @property
+    def round_trips(self) -> int:
+        return len(self.commands)
+
+    def __enter__(self) -> "SimulatedSSH":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def connect(self) -> None:
+        return None
+
+    def close(self) -> None:
+        return None
+
+    def cleanup(self) -> None:
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self.commands = []
+            self.simulated_seconds = 0.0
+
+    def path(self, remote_path: str) -> Path:
+        """Map a remote absolute path to its location in the sandbox."""
+        return self.root / remote_path.lstrip("/")
+
+    def write(self, remote_path: str, content: str) -> None:
+        target = self.path(remote_path)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_text(content, encoding="utf-8")
+
+    def read(self, remote_path: str) -> str:
+        return self.path(remote_path).read_text(encoding="utf-8")
+
+    def exists(self, remote_path: str) -> bool:
+        return self.path(remote_path).exists()
+
+    def put(self, local_path: str, remote_path: str) -> None:
+        target = self.path(remote_path)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(local_path, target)
+        self._charge(f"sftp put {remote_path}", target.stat().st_size, 0)
+
+    def get(self, remote_path: str, local_path: str) -> None:
+        shutil.copyfile(self.path(remote_path), local_path)
+        self._charge(f"sftp get {remote_path}", 0, os.path.getsize(local_path))
+
+    @contextmanager
+    def remote_lock(self, path: str, timeout: float) -> Iterator[None]:
+        """flock on the sandbox copy of `path`, like SSHRunner.remote_lock on a server."""
+        target = self.path(path)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        deadline = time.monotonic() + timeout
+        with target.open("a") as fp:
+            while True:
+                try:
+                    fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise RemoteCommandError(f"Could not lock {path} on the server (exit 1).")
+                    time.sleep(0.01)
+            self._charge(f"flock {path}", 0, 0)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _charge(
+        self,
+        command: str,
+        bytes_out: int,
+        bytes_in: int,
+        exit_code: int = 0,
+        elapsed: float = 0.0,
+        attempt: int = 0,
+    ) -> None:
+        cost = self._cost(command)
+        if self.realtime and cost > elapsed:
+            time.sleep(cost - elapsed)
+        with self._lock:
+            self.commands.append(command)
+            self.simulated_seconds += cost
+        if self.on_command:
+            self.on_command(
+                CommandStat(
+                    command=command,
+                    phase=self.phase,
+                    duration=cost,
+                    bytes_out=bytes_out,
+                    bytes_in=bytes_in,
+                    exit_code=exit_code,
+                    retries=attempt,
+                )
+            )
+
+    def _seed_system(self, installed: bool) -> None:
+        for directory in (
+            "etc/sysctl.d",
+            "etc/ufw",
+            "etc/default",
+            "etc/apt",
+            "var/lib/apt/lists",
+            "var/lib/dpkg",
+            "var/cache/apt/archives",
+            "tmp",
+            "run",
+            "boot",
+        ):
+            (self.root / directory).mkdir(parents=True, exist_ok=True)
+        self.write(
+            "/etc/os-release",
+            'NAME="Ubuntu"\nVERSION_ID="22.04"\nID=ubuntu\nID_LIKE=debian\n',
+        )
+        self.write("/etc/ufw/before.rules", "*filter\nCOMMIT\n")
+        self.write("/etc/default/ufw", 'DEFAULT_FORWARD_POLICY="DROP"\n')
+        self._bin.mkdir()
+        self._stubs.mkdir()
+        (self._stubs / "wg").write_text(_WG_STUB, encoding="utf-8")
+        (self._stubs / "wg").chmod(0o755)
+        stubs = dict(_STUBS)
+        stubs["wget"] = _STUBS["curl"]
+        for name in _NOOP_STUBS:
+            stubs.setdefault(name, "#!/usr/bin/env bash\nexit 0\n")
+        for name, body in stubs.items():
+            target = self._bin / name
+            target.write_text(body, encoding="utf-8")
+            target.chmod(0o755)
+        if installed:
+            shutil.copy(self._stubs / "wg", self._bin / "wg")
+            shutil.copy(self._stubs / "wg", self._bin / "awg")
+            self.write(
+                "/var/lib/dpkg/sim-installed",
+                "wireguard\namneziawg\nqrencode\niptables\ncurl\n",
+            )
+
+    def seed_clients(self, count: int, tyumen: int = 0) -> None:
+        """Create a configured server with `count` clients (and optional Tyumen clients)."""
+        if self.protocol == "amneziawg":
+            conf_dir = "/etc/amnezia/amneziawg"
+            ifname = "awg0"
+            params = "Jc = 2\nJmin = 40\nJmax = 70\nS1 = 20\nS2 = 30\nH1 = 111111111\nH2 = 222222222\nH3 = 333333333\nH4 = 444444444\n"
+        else:
+            conf_dir = "/etc/wireguard"
+            ifname = "wg0"
+            params = ""
+        self._seed_interface(conf_dir, ifname, "clients", "10.10", 3478, params, count, "client")
+        if tyumen and self.protocol == "amneziawg":
+            self._seed_interface(conf_dir, "awg1", "clients_tyumen", "10.11", 3479, params, tyumen, "tyumen")
+
+    def _seed_interface(
+        self,
+        conf_dir: str,
+        ifname: str,
+        clients_subdir: str,
+        base: str,
+        port: int,
+        params: str,
+        count: int,
+        prefix: str,
+    ) -> None:
+        key_suffix = "_awg1" if ifname == "awg1" else ""
+        server_priv = _fake_key(f"{ifname}-server-priv")
+        server_pub = _fake_key(f"{ifname}-server-pub")
+        self.write(f"{conf_dir}/server_private{key_suffix}.key", server_priv + "\n")
+        self.write(f"{conf_dir}/server_public{key_suffix}.key", server_pub + "\n")
+        peers = []
+        for idx in range(1, count + 1):
+            name = f"{prefix}{idx}"
+            # 250 clients per /24 keep .252-.254 free, so next_client_ip always finds a slot.
+            ip = f"{base}.{(idx - 1) // 250}.{(idx - 1) % 250 + 2}/32"
+            priv = _fake_key(f"{ifname}-{name}-priv")
+            pub = _fake_key(f"{ifname}-{name}-pub")
+            clients_dir = f"{conf_dir}/{clients_subdir}"
+            self.write(f"{clients_dir}/{name}.key", priv + "\n")
+            self.write(f"{clients_dir}/{name}.pub", pub + "\n")
+            self.write(
+                f"{clients_dir}/{name}.conf",
+                "[Interface]\n"
+                f"PrivateKey = {priv}\n"
+                f"Address = {ip}\n"
+                "DNS = 1.1.1.1, 1.0.0.1\n"
+                "MTU = 1352\n"
+                f"{params}"
+                "\n"
+                "[Peer]\n"
+                f"PublicKey = {server_pub}\n"
+                f"Endpoint = {self.config.host}:{port}\n"
+                "AllowedIPs = 0.0.0.0/0\n"
+                "PersistentKeepalive = 15\n",
+            )
+            peers.append(f"\n[Peer]\nPublicKey = {pub}\nAllowedIPs = {ip}\n")
+        (self.path(f"{conf_dir}/{clients_subdir}")).mkdir(parents=True, exist_ok=True)
+        self.write(
+            f"{conf_dir}/{ifname}.conf",
+            "[Interface]\n"
+            f"Address = {base}.0.1/24\n"
+            f"ListenPort = {port}\n"
+            f"PrivateKey = {server_priv}\n"
+            "MTU = 1352\n"
+            f"{params}"
+            f"PostUp = iptables -w -I FORWARD 1 -i {ifname} -j ACCEPT\n"
+            f"PostDown = iptables -w -D FORWARD -i {ifname} -j ACCEPT\n"
+            + "".join(peers),
+        )
+
+    def _cost(self, command: str) -> float:
+        cost = self.latency + self.cpu_cost
+        for needle, seconds in self.command_costs.items():
+            if needle in command:
+                cost += seconds
+        return cost
+
+    def run(
+        self, command: str, sudo: bool = False, check: bool = True, pty: bool = True, attempt: int = 0
+    ) -> str:
+        local = _PATH_RE.sub(lambda match: f"{self.root}/{match.group(1)}", command)
+        started = time.monotonic()
+        proc = subprocess.run(
+            ["bash", "-c", local],
+            capture_output=True,
+            env=self._env,
+            cwd=str(self.root),
+        )
+        root = str(self.root)
+        out = proc.stdout.decode("utf-8", "ignore").replace(root, "").strip()
+        err = proc.stderr.decode("utf-8", "ignore").replace(root, "").strip()
+        self._charge(
+            command,
+            len(command.encode("utf-8")),
+            len(proc.stdout) + len(proc.stderr),
+            exit_code=proc.returncode,
+            elapsed=time.monotonic() - started,
+            attempt=attempt,
+        )
+        if check and proc.returncode != 0:
+            msg = f"Command failed ({proc.returncode}): {command}"
+            if err:
+                msg += f"\nSTDERR: {err}"
+            if out:
+                msg += f"\nSTDOUT: {out}"
+            raise RemoteCommandError(msg)
+        if err and not out:
+            return err
+        return out
+
+
+class AsyncRunner:
+    """Presents a blocking runner (e.g. SimulatedSSH) through the AsyncSSHRunner interface."""
+
+    def __init__(self, inner) -> None:
+        self.inner = inner
+
+    @property
+    def config(self) -> SSHConfig:
+        return self.inner.config
+
+    @property
+    def phase(self) -> Optional[str]:
+        return getattr(self.inner, "phase", None)
+
+    @phase.setter
+    def phase(self, value: Optional[str]) -> None:
+        self.inner.phase = value
+
+    async def __aenter__(self) -> "AsyncRunner":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        return None
+
+    async def connect(self) -> None:
+        return None
+
+    async def close(self) -> None:
+        return None
+
+    async def run(
+        self, command: str, sudo: bool = False, check: bool = True, pty: bool = True, attempt: int = 0
+    ) -> str:
+        return self.inner.run(command, sudo=sudo, check=check, pty=pty, attempt=attempt)
+
+    async def put(self, local_path: str, remote_path: str) -> None:
+        self.inner.put(local_path, remote_path)
+
+    async def get(self, remote_path: str, local_path: str) -> None:
+        self.inner.get(remote_path, local_path)
+
+
+class RoundTripBudgetExceeded(AssertionError):
+    pass
+
+
+# Maximum exec channels each public WireGuardProvisioner operation may open against an
+# already configured server (either protocol, packages installed). Budgets must hold for
+# any number of clients; lower them when an optimization lands, never raise them silently.
+ROUND_TRIP_BUDGETS: dict[str, int] = {
+    "provision": 37,
+    "pre_check": 5,
+    "post_check": 4,
+    "status": 2,
+    "list_clients": 2,
+    "add_client": 24,
+    "remove_client": 4,
+    "rotate_client": 2,
+    "export_client": 2,
+    "export_all_clients": 2,
+    "export_client_config": 1,
+    "backup_config": 1,
+    "rollback_last_backup": 1,
+    "list_backups": 1,
+    "get_system_report": 1,
+    "repair_network": 9,
+    "detect_mtu": 10,
+    "next_client_ip": 1,
+    "next_client_name": 2,
+    "find_client": 1,
+    "plan_add_client": 1,
+    "plan_remove_client": 1,
+    "plan_rotate_client": 1,
+    "plan_repair_network": 1,
+}
+
+
+class CountingSSH:
+    """Wraps any SSH runner and counts the exec channels each operation opens."""
+
+    def __init__(self, inner, budgets: Optional[dict[str, int]] = None) -> None:
+        self.inner = inner
+        self.budgets = ROUND_TRIP_BUDGETS if budgets is None else budgets
+        self.counts: dict[str, int] = {}
+        self.total = 0
+        self._operation: Optional[str] = None
+        self._lock = threading.Lock()
+
+    @property
+    def config(self) -> SSHConfig:
+        return self.inner.config
+
+    @property
+    def phase(self) -> Optional[str]:
+        return getattr(self.inner, "phase", None)
+
+    @phase.setter
+    def phase(self, value: Optional[str]) -> None:
+        self.inner.phase = value
+
+    def __enter__(self) -> "CountingSSH":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+    def connect(self) -> None:
+        self.inner.connect()
+
+    def close(self) -> None:
+        self.inner.close()
+
+    def _count(self) -> None:
+        with self._lock:
+            self.total += 1
+            if self._operation:
+                self.counts[self._operation] = self.counts.get(self._operation, 0) + 1
+
+    def run(self, command: str, *args, **kwargs) -> str:
+        self._count()
+        return self.inner.run(command, *args, **kwargs)
+
+    def put(self, local_path: str, remote_path: str) -> None:
+        self._count()
+        self.inner.put(local_path, remote_path)
+
+    def get(self, remote_path: str, local_path: str) -> None:
+        self._count()
+        self.inner.get(remote_path, local_path)
+
+    @contextmanager
+    def measure(self, operation: str, enforce: bool = True) -> Iterator[None]:
+        """Count round trips made inside the block; raise if the declared budget is exceeded."""
+        self._operation = operation
+        self.counts[operation] = 0
+        try:
+            yield
+        finally:
+            self._operation = None
+        if enforce:
+            self.check(operation)
+
+    def check(self, operation: str) -> None:
+        budget = self.budgets.get(operation)
+        used = self.counts.get(operation, 0)
+        if budget is not None and used > budget:
+            raise RoundTripBudgetExceeded(
+                f"{operation} used {used} round trips, budget is {budget}"
+            )
@@ -1,14 +1,21 @@
 from __future__ import annotations
 
 import asyncio
+from collections import deque
+import contextlib
+from io import BytesIO
 import os
-from pathlib import Path
-import tempfile
-from typing import Optional, Tuple
+import threading
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional, Tuple
 
 from telegram import KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, Update, WebAppInfo
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    BaseUpdateProcessor,
+    ChatMemberHandler,
     CommandHandler,
     ConversationHandler,
     ContextTypes,
@@ -16,14 +23,16 @@ from telegram.ext import (
     filters,
 )
 
-import qrcode
 
-from vpn_wizard.core import SSHConfig, SSHRunner, WireGuardProvisioner
+from vpn_wizard.aio import AsyncSSHRunner, AsyncWireGuardProvisioner
+from vpn_wizard.core import SSHConfig, load_private_key
+from vpn_wizard.qr import QR_ENGINE
 
 
 STATE_HOST, STATE_USER, STATE_AUTH, STATE_PASSWORD, STATE_KEY, STATE_PORT = range(6)
 DEFAULT_PORT = 3478
 REQUIRED_CHANNEL = os.getenv("VPNW_REQUIRED_CHANNEL", "@fodders_dev")
+NON_MEMBER_STATUSES = {"left", "kicked"}
 
 I18N = {
     "ru": {
@@ -49,12 +58,15 @@ I18N = {
         "auth_key": "ключ",
         "ask_password": "Отправьте SSH пароль.",
         "ask_key": "Отправьте SSH приватный ключ (текстом).",
+        "key_invalid": "Не удалось прочитать ключ ({error}). Отправьте приватный ключ Ed25519, ECDSA или RSA без пароля.",
         "ask_port": "UDP порт для VPN? (по умолчанию 3478)",
         "port_invalid": "Введите число порта от 1 до 65535.",
         "port_default": "по умолчанию",
         "auth_retry": "Введите «пароль» или «ключ».",
         "provisioning": "Настраиваем... это может занять пару минут.",
         "provision_failed": "Не удалось настроить: {error}",
+        "queued": "В очереди на настройку, позиция {position}. Сообщение обновится, когда начнем.",
+        "queue_full": "Сейчас слишком много настроек в очереди. Попробуйте через несколько минут.",
         "checks_ok": "Проверки: OK",
         "checks_fail": "Проверки: Есть проблемы",
         "canceled": "Отменено.",
@@ -85,12 +97,15 @@ I18N = {
         "auth_key": "key",
         "ask_password": "Send SSH password.",
         "ask_key": "Send SSH private key content (paste as text).",
+        "key_invalid": "Could not read the key ({error}). Send an unencrypted Ed25519, ECDSA or RSA private key.",
         "ask_port": "UDP port for VPN? (default 3478)",
         "port_invalid": "Enter a port number from 1 to 65535.",
         "port_default": "default",
         "auth_retry": "Type 'password' or 'key'.",
         "provisioning": "Provisioning... this can take a few minutes.",
         "provision_failed": "Provision failed: {error}",
+        "queued": "Waiting in the provisioning queue, position {position}. This message updates when we start.",
+        "queue_full": "Too many provisioning runs are queued right now. Try again in a few minutes.",
         "checks_ok": "Checks: OK",
         "checks_fail": "Checks: Issues",
         "canceled": "Canceled.",
@@ -123,17 +138,289 @@ def _channel_link() -> str:
     return ""
 
 
+class SubscriptionCache:
+    """Channel membership per user id, with separate TTLs for members and non-members.
+
+    Members are cached for long (leaving is rare and also arrives as a chat_member
+    update when the bot is a channel admin); non-members only briefly, so a user who
+    just subscribed is let in on their next message. Lookup errors are not cached.
+    """
+
+    def __init__(
+        self,
+        member_ttl: float = 600.0,
+        non_member_ttl: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.member_ttl = member_ttl
+        self.non_member_ttl = non_member_ttl
+        self._clock = clock
+        self._entries: dict[int, tuple[bool, float]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> Optional[bool]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if not entry:
+                return None
+            is_member, expires = entry
+            if self._clock() >= expires:
+                del self._entries[user_id]
+                return None
+            return is_member
+
+    def set(self, user_id: int, is_member: bool) -> None:
+        ttl = self.member_ttl if is_member else self.non_member_ttl
+        with self._lock:
+            self._entries[user_id] = (is_member, self._clock() + ttl)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+SUBSCRIPTIONS = SubscriptionCache(
+    member_ttl=float(os.getenv("VPNW_SUB_CACHE_TTL", "600")),
+    non_member_ttl=float(os.getenv("VPNW_SUB_CACHE_NEG_TTL", "30")),
+)
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different chats concurrently, but one chat's in order.
+
+    Provisioning handlers run for minutes, so updates must not wait for each other
+    across chats. Within a chat, though, the ConversationHandler only moves to its next
+    state when a handler returns: a second message handled alongside the first would
+    re-enter the same step (and e.g. queue a duplicate provisioning run).
+    """
+
+    def __init__(self, max_concurrent_updates: int = 256) -> None:
+        super().__init__(max_concurrent_updates)
+        self._chats: dict[int, tuple[asyncio.Lock, int]] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[object]) -> None:
+        chat = getattr(update, "effective_chat", None) or getattr(update, "effective_user", None)
+        if chat is None:
+            await coroutine
+            return
+        lock, users = self._chats.get(chat.id, (asyncio.Lock(), 0))
+        self._chats[chat.id] = (lock, users + 1)
+        try:
+            async with lock:
+                await coroutine
+        finally:
+            lock, users = self._chats[chat.id]
+            if users == 1:
+                del self._chats[chat.id]
+            else:
+                self._chats[chat.id] = (lock, users - 1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class QueueFull(RuntimeError):
+    pass
+
+
+class ProvisionScheduler:
+    """FIFO admission for provisioning runs, with global and per-user concurrency limits.
+
+    Every run holds an SSH session and a worker thread for minutes, so one bot process
+    admits at most `max_active` runs at once and `per_user` per Telegram user; the rest
+    wait in arrival order (a waiter blocked only by its own user's limit does not hold
+    up others). `on_wait` is awaited with the 1-based queue position whenever it
+    changes. More than `max_waiting` waiters raises QueueFull instead of queueing.
+    """
+
+    def __init__(self, max_active: int = 4, per_user: int = 1, max_waiting: int = 50) -> None:
+        self.max_active = max_active
+        self.per_user = per_user
+        self.max_waiting = max_waiting
+        self._running: dict[int, int] = {}
+        self._waiting: list[tuple[object, int]] = []
+        self._cond = asyncio.Condition()
+
+    @property
+    def active(self) -> int:
+        return sum(self._running.values())
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiting)
+
+    def _can_start(self, ticket: object) -> bool:
+        if self.active >= self.max_active:
+            return False
+        for waiter, user_id in self._waiting:
+            if self._running.get(user_id, 0) < self.per_user:
+                return waiter is ticket
+        return False
+
+    def _position(self, ticket: object) -> int:
+        return next(i for i, (waiter, _) in enumerate(self._waiting, 1) if waiter is ticket)
+
+    @contextlib.asynccontextmanager
+    async def slot(
+        self,
+        user_id: int,
+        on_wait: Optional[Callable[[int], Awaitable[None]]] = None,
+    ) -> AsyncIterator[None]:
+        ticket = object()
+        async with self._cond:
+            if len(self._waiting) >= self.max_waiting:
+                raise QueueFull(f"{len(self._waiting)} provisioning runs already queued")
+            self._waiting.append((ticket, user_id))
+        reported: Optional[int] = None
+        try:
+            while True:
+                async with self._cond:
+                    if self._can_start(ticket):
+                        self._waiting.remove((ticket, user_id))
+                        self._running[user_id] = self._running.get(user_id, 0) + 1
+                        break
+                    position = self._position(ticket)
+                    if position == reported or on_wait is None:
+                        await self._cond.wait()
+                        continue
+                # Report outside the lock; a Telegram round trip must not stall the queue.
+                reported = position
+                await on_wait(position)
+        except BaseException:
+            async with self._cond:
+                if (ticket, user_id) in self._waiting:
+                    self._waiting.remove((ticket, user_id))
+                self._cond.notify_all()
+            raise
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._running[user_id] -= 1
+                if not self._running[user_id]:
+                    del self._running[user_id]
+                self._cond.notify_all()
+
+
+SCHEDULER = ProvisionScheduler(
+    max_active=int(os.getenv("VPNW_BOT_MAX_PROVISIONS", "4")),
+    per_user=int(os.getenv("VPNW_BOT_MAX_PER_USER", "1")),
+    max_waiting=int(os.getenv("VPNW_BOT_MAX_QUEUE", "50")),
+)
+
+
+class ProgressMessage:
+    """Shows provisioner progress by editing one message, coalesced and rate-limited.
+
+    `push` is safe to call from worker threads (the blocking provisioner reports from
+    one); it only records the line. A background task edits the message at most once
+    per `interval` seconds with the last `max_lines` lines, skips unchanged text and
+    honours Telegram's RetryAfter. Progress is best effort: other edit errors are
+    dropped rather than failing the provisioning run.
+    """
+
+    def __init__(
+        self,
+        edit: Callable[[str], Awaitable[object]],
+        header: str = "",
+        interval: float = 3.0,
+        max_lines: int = 8,
+    ) -> None:
+        self._edit = edit
+        self.header = header
+        self.interval = interval
+        self._lines: deque[str] = deque(maxlen=max_lines)
+        self._lock = threading.Lock()
+        self._shown = ""
+        self._not_before = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self.edits = 0
+
+    def push(self, line: str) -> None:
+        with self._lock:
+            self._lines.append(line)
+
+    def text(self) -> str:
+        with self._lock:
+            lines = list(self._lines)
+        if not lines:
+            return ""
+        return "\n".join([self.header, *lines] if self.header else lines)
+
+    async def flush(self) -> None:
+        text = self.text()
+        if not text or text == self._shown or time.monotonic() < self._not_before:
+            return
+        try:
+            await self._edit(text)
+        except RetryAfter as exc:
+            delay = exc.retry_after
+            seconds = delay.total_seconds() if hasattr(delay, "total_seconds") else float(delay)
+            self._not_before = time.monotonic() + seconds
+            return
+        except TelegramError:
+            return
+        self._shown = text
+        self.edits += 1
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def __aenter__(self) -> "ProgressMessage":
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+
+async def _is_subscribed(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
+    cached = SUBSCRIPTIONS.get(user_id)
+    if cached is not None:
+        return cached
+    try:
+        member = await context.bot.get_chat_member(REQUIRED_CHANNEL, user_id)
+    except Exception:
+        return False
+    is_member = member is not None and member.status not in NON_MEMBER_STATUSES
+    SUBSCRIPTIONS.set(user_id, is_member)
+    return is_member
+
+
+def _is_required_channel(chat) -> bool:
+    channel = REQUIRED_CHANNEL or ""
+    if channel.lstrip("-").isdigit():
+        return chat.id == int(channel)
+    name = channel.rsplit("/", 1)[-1].lstrip("@").lower()
+    return bool(chat.username) and chat.username.lower() == name
+
+
+async def on_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Refresh the subscription cache when someone joins or leaves the required channel."""
+    change = update.chat_member
+    if not change or not _is_required_channel(change.chat):
+        return
+    member = change.new_chat_member
+    SUBSCRIPTIONS.set(member.user.id, member.status not in NON_MEMBER_STATUSES)
+
+
 async def _require_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     if not REQUIRED_CHANNEL:
         return True
     user = update.effective_user
     if not user:
         return False
-    try:
-        member = await context.bot.get_chat_member(REQUIRED_CHANNEL, user.id)
-    except Exception:
-        member = None
-    if not member or member.status in {"left", "kicked"}:
+    if not await _is_subscribed(context, user.id):
         await update.message.reply_text(
             _t(update, "subscribe_required").format(channel=_channel_link()),
             reply_markup=ReplyKeyboardRemove(),
@@ -200,55 +487,55 @@ async def auth_step(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return STATE_AUTH
 
 
-def _write_temp_key(content: str) -> str:
-    tmp = tempfile.NamedTemporaryFile(delete=False, mode="w", encoding="utf-8")
-    tmp.write(content)
-    tmp.flush()
-    tmp.close()
-    os.chmod(tmp.name, 0o600)
-    return tmp.name
-
-
-def _provision(data: dict) -> tuple[str, list[dict]]:
-    key_path = data.get("key_path")
-    temp_key = None
-    if data.get("key_content"):
-        temp_key = _write_temp_key(data["key_content"])
-        key_path = temp_key
-    try:
-        cfg = SSHConfig(
-            host=data["host"],
-            user=data["user"],
-            port=data.get("port", 22),
-            password=data.get("password"),
-            key_path=key_path,
+async def _provision(data: dict, progress: Optional[Callable[[str], None]] = None) -> tuple[str, list[dict]]:
+    cfg = SSHConfig(
+        host=data["host"],
+        user=data["user"],
+        port=data.get("port", 22),
+        password=data.get("password"),
+        key_path=data.get("key_path"),
+        key_content=data.get("key_content"),
+    )
+    listen_port = data.get("listen_port") or DEFAULT_PORT
+    async with AsyncSSHRunner(cfg) as ssh:
+        prov = AsyncWireGuardProvisioner(
+            ssh,
+            client_name="client1",
+            auto_mtu=True,
+            tune=True,
+            listen_port=listen_port,
+            progress=progress,
         )
-        listen_port = data.get("listen_port") or DEFAULT_PORT
-        with SSHRunner(cfg) as ssh:
-            prov = WireGuardProvisioner(
-                ssh,
-                client_name="client1",
-                auto_mtu=True,
-                tune=True,
-                listen_port=listen_port,
-            )
-            prov.provision()
-            config = prov.export_client_config()
-            checks = prov.post_check()
-        return config, checks
-    finally:
-        if temp_key and Path(temp_key).exists():
-            try:
-                Path(temp_key).unlink()
-            except OSError:
-                pass
+        await prov.provision()
+        config = await prov.export_client_config()
+        checks = await prov.post_check()
+    return config, checks
 
 
 async def _run_provision(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    await update.message.reply_text(_t(update, "provisioning"), reply_markup=ReplyKeyboardRemove())
+    status_message = await update.message.reply_text(_t(update, "provisioning"), reply_markup=ReplyKeyboardRemove())
     data = context.user_data
+
+    async def edit(text: str) -> None:
+        # Message.edit_text is the bound shortcut for bot.edit_message_text on this chat/message.
+        await status_message.edit_text(text)
+
+    async def show_position(position: int) -> None:
+        with contextlib.suppress(TelegramError):
+            await edit(_t(update, "queued").format(position=position))
+
     try:
-        config, checks = await asyncio.to_thread(_provision, data)
+        async with SCHEDULER.slot(update.effective_user.id, on_wait=show_position):
+            reporter = ProgressMessage(
+                edit,
+                header=_t(update, "provisioning"),
+                interval=float(os.getenv("VPNW_BOT_PROGRESS_INTERVAL", "3")),
+            )
+            async with reporter:
+                config, checks = await _provision(data, progress=reporter.push)
+    except QueueFull:
+        await update.message.reply_text(_t(update, "queue_full"))
+        return ConversationHandler.END
     except Exception as exc:
         await update.message.reply_text(_t(update, "provision_failed").format(error=exc))
         return ConversationHandler.END
@@ -257,23 +544,10 @@ async def _run_provision(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     status = _t(update, "checks_ok") if ok else _t(update, "checks_fail")
     await update.message.reply_text(status)
 
-    tmp_conf = tempfile.NamedTemporaryFile(delete=False, suffix=".conf", mode="w", encoding="utf-8")
-    tmp_conf.write(config)
-    tmp_conf.flush()
-    tmp_conf.close()
-
-    img = qrcode.make(config)
-    tmp_qr = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-    img.save(tmp_qr.name)
-    tmp_qr.close()
-
-    with open(tmp_conf.name, "rb") as conf_fp:
-        await update.message.reply_document(document=conf_fp, filename="client1.conf")
-    with open(tmp_qr.name, "rb") as qr_fp:
-        await update.message.reply_photo(photo=qr_fp)
+    qr_png = BytesIO(await QR_ENGINE.arender(config))
 
-    Path(tmp_conf.name).unlink(missing_ok=True)
-    Path(tmp_qr.name).unlink(missing_ok=True)
+    await update.message.reply_document(document=BytesIO(config.encode("utf-8")), filename="client1.conf")
+    await update.message.reply_photo(photo=qr_png)
     return ConversationHandler.END
 
 
@@ -293,6 +567,11 @@ async def password_step(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 async def key_step(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not await _require_subscription(update, context):
         return ConversationHandler.END
+    try:
+        load_private_key(update.message.text)
+    except Exception as exc:
+        await update.message.reply_text(_t(update, "key_invalid").format(error=exc))
+        return STATE_KEY
     context.user_data["key_content"] = update.message.text
     keyboard = ReplyKeyboardMarkup(
         [[str(DEFAULT_PORT), "33434", "27015", "443", _t(update, "port_default")]],
@@ -354,12 +633,10 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(_t(update, "help"), reply_markup=ReplyKeyboardRemove())
 
 
-def main() -> None:
-    token = os.getenv("VPNW_BOT_TOKEN")
-    if not token:
-        raise RuntimeError("VPNW_BOT_TOKEN is required.")
-
-    app = ApplicationBuilder().token(token).build()
+def build_application(token: str) -> Application:
+    # Provisioning handlers run for minutes; updates must not wait for each other, or one
+    # user's run would stall every other chat and SCHEDULER would never have to queue.
+    app = ApplicationBuilder().token(token).concurrent_updates(ChatOrderedUpdateProcessor()).build()
     conv = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
@@ -375,7 +652,16 @@ def main() -> None:
     app.add_handler(conv)
     app.add_handler(CommandHandler("miniapp", miniapp))
     app.add_handler(CommandHandler("help", help_cmd))
-    app.run_polling()
+    # Only delivered when the bot is an admin of REQUIRED_CHANNEL; otherwise the TTLs apply.
+    app.add_handler(ChatMemberHandler(on_chat_member, ChatMemberHandler.CHAT_MEMBER))
+    return app
+
+
+def main() -> None:
+    token = os.getenv("VPNW_BOT_TOKEN")
+    if not token:
+        raise RuntimeError("VPNW_BOT_TOKEN is required.")
+    build_application(token).run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import asyncio
+import shutil
+
+import pytest
+
+from vpn_wizard.aio import AsyncSSHRunner, AsyncWireGuardProvisioner
+from vpn_wizard.core import RemoteCommandError, SSHConfig
+from vpn_wizard.testing import AsyncRunner, SimulatedSSH
+
+needs_bash = pytest.mark.skipif(shutil.which("bash") is None, reason="SimulatedSSH needs bash")
+
+
+@needs_bash
+def test_async_provisioner_runs_reads_natively_and_writes_through_bridge() -> None:
+    sim = SimulatedSSH(clients=3, latency=0.0, cpu_cost=0.0, command_costs={})
+
+    async def scenario() -> tuple[list[dict], dict, list[dict]]:
+        prov = AsyncWireGuardProvisioner(AsyncRunner(sim))
+        before = await prov.list_clients()
+        added = await prov.add_client("laptop")
+        after = await prov.list_clients()
+        return before, added, after
+
+    try:
+        before, added, after = asyncio.run(scenario())
+        assert [client["name"] for client in before] == ["client1", "client2", "client3"]
+        assert added["name"] == "laptop"
+        assert "laptop" in {client["name"] for client in after}
+    finally:
+        sim.cleanup()
+
+
+def test_async_runner_masks_sudo_password_and_raises_on_failure() -> None:
+    asyncssh = pytest.importorskip("asyncssh")
+
+    class Server(asyncssh.SSHServer):
+        def begin_auth(self, username: str) -> bool:
+            return True
+
+        def password_auth_supported(self) -> bool:
+            return True
+
+        def validate_password(self, username: str, password: str) -> bool:
+            return password == "s3cret"
+
+    async def handle(process) -> None:
+        command = process.command
+        if command.startswith("sudo -S"):
+            password = (await process.stdin.readline()).strip()
+            process.stdout.write(f"password was {password}\n")
+        process.stdout.write(f"ran {command}\n")
+        process.exit(3 if "fail-me" in command else 0)
+
+    async def scenario() -> tuple[str, str]:
+        key = asyncssh.generate_private_key("ssh-ed25519")
+        server = await asyncssh.create_server(
+            Server, "127.0.0.1", 0, server_host_keys=[key], process_factory=handle
+        )
+        port = server.sockets[0].getsockname()[1]
+        config = SSHConfig(host="127.0.0.1", port=port, user="root", password="s3cret")
+        try:
+            async with AsyncSSHRunner(config, backend="asyncssh") as ssh:
+                out = await ssh.run("uname -r", sudo=True)
+                with pytest.raises(RemoteCommandError) as excinfo:
+                    await ssh.run("fail-me")
+            return out, str(excinfo.value)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    out, error = asyncio.run(scenario())
+    assert "password was ***" in out
+    assert "s3cret" not in out
+    assert "ran sudo -S -p '' bash -lc 'uname -r'" in out
+    assert error.startswith("Command failed (3): fail-me")
@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import shutil
+import threading
+import time
+
+import pytest
+
+from vpn_wizard.apply import ApplyQueue
+from vpn_wizard.backend import SQLiteBackend
+from vpn_wizard.core import WireGuardProvisioner
+from vpn_wizard.testing import SimulatedSSH
+
+needs_bash = pytest.mark.skipif(shutil.which("bash") is None, reason="SimulatedSSH needs bash")
+
+
+def _restarts(sim: SimulatedSSH) -> int:
+    return sum("systemctl restart awg-quick@awg0" in command for command in sim.commands)
+
+
+@needs_bash
+def test_burst_of_peer_changes_is_applied_once() -> None:
+    sim = SimulatedSSH(clients=2, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        queue = ApplyQueue(delay=30)
+        prov = WireGuardProvisioner(sim, apply_queue=queue)
+        added = [prov.add_client(name) for name in ("phone", "laptop", "tablet")]
+        assert prov.remove_client("client1")
+        prov.rotate_client("phone")
+
+        # Configs are returned at once; nothing has been rebuilt yet.
+        assert all(item["config"].startswith("[Interface]") for item in added)
+        assert _restarts(sim) == 0
+        assert queue.pending() == {f"{sim.config.host}:22": ["awg0"]}
+        assert not prov.last_apply.done()
+
+        queue.flush()
+        assert prov.last_apply.result() == ["awg0"]
+        assert _restarts(sim) == 1
+        assert len(sim.read("/var/backups/vpn-wizard/amneziawg/index").splitlines()) == 1
+        server_conf = sim.read("/etc/amnezia/amneziawg/awg0.conf")
+        assert server_conf.count("[Peer]") == 4  # client2 + phone, laptop, tablet
+        assert queue.pending() == {}
+    finally:
+        sim.cleanup()
+
+
+@needs_bash
+def test_apply_runs_after_debounce_and_reports_failures() -> None:
+    sim = SimulatedSSH(clients=1, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        queue = ApplyQueue(delay=0.05)
+        prov = WireGuardProvisioner(sim, apply_queue=queue)
+        prov.add_client("phone")
+        assert prov.last_apply.result(timeout=5) == ["awg0"]
+        assert _restarts(sim) == 1
+
+        def broken(interfaces) -> None:
+            raise RuntimeError("restart failed")
+
+        prov.apply_peer_changes = broken
+        prov.add_client("laptop")
+        with pytest.raises(RuntimeError, match="restart failed"):
+            prov.last_apply.result(timeout=5)
+    finally:
+        sim.cleanup()
+
+
+@needs_bash
+def test_failed_apply_is_logged_recorded_and_reapplied() -> None:
+    sim = SimulatedSSH(clients=1, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        logged: list[str] = []
+        seen = threading.Event()
+        queue = ApplyQueue(delay=0.05, log=lambda msg: (logged.append(msg), seen.set()))
+        prov = WireGuardProvisioner(sim, apply_queue=queue)
+        key = prov.host_key()
+        rebuild = prov.apply_peer_changes
+
+        def broken(interfaces) -> None:
+            raise RuntimeError("restart failed")
+
+        prov.apply_peer_changes = broken
+        prov.add_client("phone")
+        # Nobody waits on the Future: the failure must surface on its own.
+        assert seen.wait(5)
+        assert logged == [f"Peer changes on {key} (awg0) were not applied: restart failed"]
+        failure = queue.failure(key)
+        assert failure["error"] == "restart failed"
+        assert failure["interfaces"] == ["awg0"]
+        assert _restarts(sim) == 0
+
+        prov.apply_peer_changes = rebuild
+        assert queue.reapply(prov) == ["awg0"]
+        assert queue.failure(key) is None
+        assert _restarts(sim) == 1
+        assert queue.reapply(prov) == []
+    finally:
+        sim.cleanup()
+
+
+@needs_bash
+def test_batches_lost_with_their_process_are_reported_and_reapplied() -> None:
+    sim = SimulatedSSH(clients=1, latency=0.0, cpu_cost=0.0, command_costs={})
+    backend = SQLiteBackend()
+    try:
+        crashed = ApplyQueue(delay=30, backend=backend)
+        prov = WireGuardProvisioner(sim, apply_queue=crashed)
+        key = prov.host_key()
+        prov.add_client("phone")  # client files are written, the rebuild is only queued
+        assert backend.get(f"apply-pending:{key}")
+        assert crashed.failure(key) is None  # its own live batch is not lost
+        crashed._batches[key].timer.cancel()  # the process exits before the flush
+
+        restarted = ApplyQueue(delay=30, backend=backend)
+        assert restarted.failure(key) is None  # still inside the other queue's window
+        pending = backend.get(f"apply-pending:{key}")
+        for entry in pending.values():
+            entry["deadline"] = time.time() - restarted.LOST_AFTER - 1
+        backend.set(f"apply-pending:{key}", pending)
+        lost = restarted.failure(key)
+        assert lost["interfaces"] == ["awg0"] and "exited" in lost["error"]
+
+        assert restarted.reapply(WireGuardProvisioner(sim)) == ["awg0"]
+        assert _restarts(sim) == 1
+        assert "[Peer]" in sim.read("/etc/amnezia/amneziawg/awg0.conf")
+        assert restarted.failure(key) is None
+        assert backend.get(f"apply-pending:{key}") is None
+
+        # A finished batch clears its own pending entry.
+        prov = WireGuardProvisioner(sim, apply_queue=restarted)
+        prov.add_client("laptop")
+        restarted.flush()
+        assert backend.get(f"apply-pending:{key}") is None
+    finally:
+        sim.cleanup()
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import os
+import shutil
+
+import pytest
+
+from vpn_wizard.artifacts import ArtifactCache
+from vpn_wizard.core import RemoteCommandError, WireGuardProvisioner
+from vpn_wizard.testing import SimulatedSSH
+
+needs_bash = pytest.mark.skipif(shutil.which("bash") is None, reason="SimulatedSSH needs bash")
+
+UBUNTU = {"ID": "ubuntu", "ID_LIKE": "debian", "VERSION_ID": "22.04"}
+
+
+def test_cache_lookup_rejects_corrupt_entries(tmp_path) -> None:
+    deb = tmp_path / "amneziawg-modules_1.0_amd64.deb"
+    deb.write_bytes(b"module")
+    cache = ArtifactCache(tmp_path / "cache")
+    key = ArtifactCache.key("ubuntu", "22.04", "5.15.0-91-generic", "amd64")
+    assert key == "ubuntu_22.04_5.15.0-91-generic_amd64"
+    assert cache.lookup(key) is None
+
+    cache.store(key, [deb])
+    [cached] = cache.lookup(key)
+    assert cached.read_bytes() == b"module"
+    assert [entry["key"] for entry in cache.entries()] == [key]
+
+    cached.write_bytes(b"truncated")
+    assert cache.lookup(key) is None
+
+
+@needs_bash
+def test_collected_artifacts_skip_dkms_on_next_install(tmp_path) -> None:
+    cache = ArtifactCache(tmp_path)
+    source = SimulatedSSH(latency=0.0, cpu_cost=0.0, command_costs={})
+    target = SimulatedSSH(installed=False, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        source.write("/var/lib/dkms/amneziawg/1.0.0/bmdeb/amneziawg-modules_1.0.0_amd64.deb", "module")
+        key, names = WireGuardProvisioner(source, artifacts=cache).collect_amneziawg_artifacts()
+        assert sorted(names) == ["amneziawg-modules_1.0.0_amd64.deb", "amneziawg-tools_1.0_all.deb"]
+        assert cache.lookup(key)
+
+        WireGuardProvisioner(target, artifacts=cache).install_amneziawg(UBUNTU)
+        assert list(target.path("/var/cache/vpn-wizard").iterdir()) == []
+        assert list(source.path("/var/cache/vpn-wizard").iterdir()) == []
+        assert not any("/tmp/" in cmd for cmd in target.commands if cmd.startswith("sftp put"))
+        assert (target.root / ".bin" / "awg").exists()
+        installs = [cmd for cmd in target.commands if " install -y " in cmd]
+        assert len(installs) == 1 and "linux-headers" not in installs[0]
+        assert "add-apt-repository" not in installs[0]
+    finally:
+        source.cleanup()
+        target.cleanup()
+
+
+@needs_bash
+def test_cache_miss_falls_back_to_dkms(tmp_path) -> None:
+    sim = SimulatedSSH(installed=False, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        WireGuardProvisioner(sim, artifacts=ArtifactCache(tmp_path)).install_amneziawg(UBUNTU)
+        assert any("install -y amneziawg" in cmd for cmd in sim.commands)
+        assert not any(cmd.startswith("sftp put") for cmd in sim.commands)
+    finally:
+        sim.cleanup()
+
+
+@needs_bash
+def test_prebuilt_upload_dir_is_private_and_removed_on_dkms_fallback(tmp_path) -> None:
+    cache = ArtifactCache(tmp_path)
+    deb = tmp_path / "amneziawg-modules_1.0.0_amd64.deb"
+    deb.write_bytes(b"module")
+    cache.store(ArtifactCache.key("ubuntu", "22.04", os.uname().release, os.uname().machine), [deb])
+    sim = SimulatedSSH(installed=False, latency=0.0, cpu_cost=0.0, command_costs={})
+    upload_modes: list[int] = []
+    put = sim.put
+
+    def checked_put(local_path: str, remote_path: str) -> None:
+        upload_modes.append(sim.path(remote_path).parent.stat().st_mode & 0o777)
+        put(local_path, remote_path)
+
+    try:
+        sim.put = checked_put
+        # The prebuilt module does not load, so the install falls back to DKMS.
+        (sim.root / ".bin" / "modprobe").write_text("#!/usr/bin/env bash\nexit 1\n", encoding="utf-8")
+        prov = WireGuardProvisioner(sim, artifacts=cache)
+        prov.install_amneziawg(UBUNTU)
+        assert upload_modes == [0o700]
+        assert any("install -y amneziawg" in cmd for cmd in sim.commands)
+        assert list(sim.path("/var/cache/vpn-wizard").iterdir()) == []
+    finally:
+        sim.cleanup()
+
+    # A base directory someone else could write to is refused outright, not worked around.
+    sim = SimulatedSSH(installed=False, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        sim.path("/var/cache/vpn-wizard").mkdir(parents=True)
+        sim.path("/var/cache/vpn-wizard").chmod(0o777)
+        with pytest.raises(RemoteCommandError, match="not writable by others"):
+            WireGuardProvisioner(sim, artifacts=cache).install_amneziawg(UBUNTU)
+        assert not any(cmd.startswith("sftp put") for cmd in sim.commands)
+    finally:
+        sim.cleanup()
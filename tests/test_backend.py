@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import time
+
+import pytest
+
+from vpn_wizard.backend import SQLiteBackend
+from vpn_wizard.server import JobStore
+
+
+def test_jobs_are_visible_across_workers(tmp_path) -> None:
+    path = str(tmp_path / "state.db")
+    worker_a = JobStore(SQLiteBackend(path))
+    worker_b = JobStore(SQLiteBackend(path))
+
+    job = worker_a.create()
+    worker_a.update(job.job_id, status="running")
+    for i in range(60):
+        worker_a.append_progress(job.job_id, f"step {i}")
+    worker_a.update(job.job_id, checks=[{"name": "service_active", "ok": True}])
+
+    seen = worker_b.get(job.job_id)
+    assert seen is not None
+    assert seen.status == "running"
+    assert seen.progress[0] == "step 10" and len(seen.progress) == 50
+    assert seen.checks == [{"name": "service_active", "ok": True}]
+    assert worker_b.get("missing") is None
+
+
+def test_kv_values_expire(tmp_path) -> None:
+    backend = SQLiteBackend(str(tmp_path / "state.db"))
+    backend.set("facts:1.2.3.4", {"os": "ubuntu"}, ttl=0.05)
+    backend.set("forever", [1, 2])
+    assert backend.get("facts:1.2.3.4") == {"os": "ubuntu"}
+    time.sleep(0.06)
+    assert backend.get("facts:1.2.3.4") is None
+    assert backend.get("forever") == [1, 2]
+
+
+def test_lock_excludes_other_workers_until_released_or_expired(tmp_path) -> None:
+    path = str(tmp_path / "state.db")
+    a, b = SQLiteBackend(path), SQLiteBackend(path)
+    with a.lock("host:1.2.3.4"):
+        with pytest.raises(TimeoutError):
+            with b.lock("host:1.2.3.4", timeout=0.1, poll=0.02):
+                pass
+    with b.lock("host:1.2.3.4", timeout=0.1):
+        pass
+
+    assert a.try_acquire("host:5.6.7.8", "dead-worker", ttl=0.05)
+    assert not b.try_acquire("host:5.6.7.8", "other", ttl=1)
+    time.sleep(0.06)
+    assert b.try_acquire("host:5.6.7.8", "other", ttl=1)
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import importlib.util
+from pathlib import Path
+import shutil
+from typing import Callable
+
+import pytest
+
+from vpn_wizard.core import WireGuardProvisioner
+from vpn_wizard.testing import (
+    ROUND_TRIP_BUDGETS,
+    CountingSSH,
+    RoundTripBudgetExceeded,
+    SimulatedSSH,
+)
+
+pytestmark = pytest.mark.skipif(shutil.which("bash") is None, reason="SimulatedSSH needs bash")
+
+OPERATIONS: dict[str, Callable[[WireGuardProvisioner], object]] = {
+    "provision": lambda prov: prov.provision(),
+    "pre_check": lambda prov: prov.pre_check(),
+    "post_check": lambda prov: prov.post_check(),
+    "status": lambda prov: prov.status(),
+    "list_clients": lambda prov: prov.list_clients(),
+    "add_client": lambda prov: prov.add_client("budget-new"),
+    "remove_client": lambda prov: prov.remove_client("client1"),
+    "rotate_client": lambda prov: prov.rotate_client("client2"),
+    "export_client": lambda prov: prov.export_client("client2"),
+    "export_all_clients": lambda prov: prov.export_all_clients(),
+    "export_client_config": lambda prov: prov.export_client_config(),
+    "backup_config": lambda prov: prov.backup_config(),
+    "rollback_last_backup": lambda prov: prov.rollback_last_backup(),
+    "list_backups": lambda prov: prov.list_backups(),
+    "get_system_report": lambda prov: prov.get_system_report(),
+    "repair_network": lambda prov: prov.repair_network(),
+    "detect_mtu": lambda prov: prov.detect_mtu(),
+    "next_client_ip": lambda prov: prov.next_client_ip(),
+    "next_client_name": lambda prov: prov.next_client_name(),
+    "find_client": lambda prov: prov.find_client(name="client2"),
+    "plan_add_client": lambda prov: prov.plan_add_client("budget-new"),
+    "plan_remove_client": lambda prov: prov.plan_remove_client("client1"),
+    "plan_rotate_client": lambda prov: prov.plan_rotate_client("client2"),
+    "plan_repair_network": lambda prov: prov.plan_repair_network(),
+}
+
+
+def _count(operation: str, protocol: str, clients: int) -> int:
+    sim = SimulatedSSH(clients=clients, protocol=protocol, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        ssh = CountingSSH(sim)
+        prov = WireGuardProvisioner(ssh, protocol=protocol)
+        with ssh.measure(operation):
+            OPERATIONS[operation](prov)
+        return ssh.counts[operation]
+    finally:
+        sim.cleanup()
+
+
+def test_every_budgeted_operation_is_exercised() -> None:
+    assert set(OPERATIONS) == set(ROUND_TRIP_BUDGETS)
+
+
+@pytest.mark.parametrize("protocol", ["amneziawg", "wireguard"])
+@pytest.mark.parametrize("operation", sorted(OPERATIONS))
+def test_round_trips_within_budget_regardless_of_client_count(operation: str, protocol: str) -> None:
+    small = _count(operation, protocol, clients=3)
+    large = _count(operation, protocol, clients=30)
+    assert small == large
+
+
+def test_counting_ssh_raises_when_budget_exceeded() -> None:
+    sim = SimulatedSSH(clients=3, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        ssh = CountingSSH(sim, budgets={"list_clients": 1})
+        prov = WireGuardProvisioner(ssh)
+        with pytest.raises(RoundTripBudgetExceeded):
+            with ssh.measure("list_clients"):
+                prov.list_clients()
+    finally:
+        sim.cleanup()
+
+
+def _load_benchmark():
+    path = Path(__file__).resolve().parents[1] / "benchmarks" / "bench_provisioner.py"
+    spec = importlib.util.spec_from_file_location("bench_provisioner", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.mark.parametrize("operation", sorted(_load_benchmark().OPERATIONS))
+def test_benchmark_operations_run_within_budget(operation: str) -> None:
+    # Smoke run of benchmarks/bench_provisioner.py, so API signature changes cannot break it.
+    row = _load_benchmark().run_case(operation, clients=3, protocol="amneziawg", latency=0.0, cpu_cost=0.0)
+    assert row["round_trips"] > 0
+    assert row["budget"] is None or row["round_trips"] <= row["budget"]
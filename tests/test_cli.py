@@ -1,6 +1,9 @@
 from __future__ import annotations
 
+import csv
+import io
 from pathlib import Path
+import zipfile
 
 from typer.testing import CliRunner
 
@@ -20,6 +23,12 @@ class DummyProvisioner:
     def export_client_config(self) -> str:
         return self._config
 
+    def export_all_clients(self) -> list[dict]:
+        return [
+            {"name": name, "ip": ip, "public_key": "pub", "config": self._config, "interface": iface}
+            for name, ip, iface in (("phone", "10.10.0.2/32", "awg0"), ("laptop", "10.11.0.2/32", "awg1"))
+        ]
+
 
 def test_export_writes_config_and_qr(tmp_path: Path, monkeypatch) -> None:
     runner = CliRunner()
@@ -48,3 +57,42 @@ def test_export_writes_config_and_qr(tmp_path: Path, monkeypatch) -> None:
     assert result.exit_code == 0
     assert out_path.read_text(encoding="utf-8") == config
     assert qr_path.exists()
+
+
+def test_cache_list_shows_entries(tmp_path: Path) -> None:
+    deb = tmp_path / "amneziawg-tools_1.0_amd64.deb"
+    deb.write_bytes(b"deb")
+    cache_dir = tmp_path / "cache"
+    cli.ArtifactCache(cache_dir).store("ubuntu_22.04_5.15.0-91-generic_amd64", [deb])
+    runner = CliRunner()
+    result = runner.invoke(cli.app, ["cache", "list", "--cache-dir", str(cache_dir)])
+    assert result.exit_code == 0
+    assert "ubuntu_22.04_5.15.0-91-generic_amd64: amneziawg-tools_1.0_amd64.deb" in result.output
+
+
+def test_client_export_all_writes_zip_with_manifest(tmp_path: Path, monkeypatch) -> None:
+    runner = CliRunner()
+    config = "[Interface]\nPrivateKey = test\n"
+    monkeypatch.setattr(cli, "_build_provisioner", lambda *args, **kwargs: DummyProvisioner(config))
+    out_path = tmp_path / "clients.zip"
+    args = ["client", "export-all", "--host", "1.1.1.1", "--user", "root", "--out", str(out_path)]
+    result = runner.invoke(cli.app, [*args, "--qr", "png", "--qr", "svg"])
+    assert result.exit_code == 0, result.output
+
+    with zipfile.ZipFile(out_path) as archive:
+        assert archive.namelist() == [
+            "awg0/phone.conf",
+            "awg0/phone.png",
+            "awg0/phone.svg",
+            "awg1/laptop.conf",
+            "awg1/laptop.png",
+            "awg1/laptop.svg",
+            "manifest.csv",
+        ]
+        assert archive.read("awg1/laptop.conf").decode() == config
+        assert archive.read("awg0/phone.png").startswith(b"\x89PNG")
+        rows = list(csv.DictReader(io.StringIO(archive.read("manifest.csv").decode())))
+    assert [(row["name"], row["ip"], row["svg"]) for row in rows] == [
+        ("phone", "10.10.0.2/32", "awg0/phone.svg"),
+        ("laptop", "10.11.0.2/32", "awg1/laptop.svg"),
+    ]
@@ -1,6 +1,16 @@
 from __future__ import annotations
 
-from vpn_wizard.core import SSHConfig, WireGuardProvisioner
+from io import BytesIO
+import shutil
+import time
+
+import pytest
+
+from vpn_wizard.backend import SQLiteBackend
+from vpn_wizard.core import CommandTimings, RemoteCommandError, SSHConfig, SSHRunner, WireGuardProvisioner
+from vpn_wizard.testing import SimulatedSSH
+
+needs_bash = pytest.mark.skipif(shutil.which("bash") is None, reason="SimulatedSSH needs bash")
 
 
 class FakeSSH:
@@ -9,7 +19,7 @@ class FakeSSH:
         self.commands: list[tuple[str, bool, bool]] = []
         self.config = SSHConfig(host="example.com", user="root", password=password)
 
-    def run(self, command: str, sudo: bool = False, check: bool = True) -> str:
+    def run(self, command: str, sudo: bool = False, check: bool = True, pty: bool = True, attempt: int = 0) -> str:
         self.commands.append((command, sudo, check))
         for key, value in self.responses.items():
             if key in command:
@@ -22,7 +32,7 @@ class MtuSSH(FakeSSH):
         super().__init__()
         self.max_payload = max_payload
 
-    def run(self, command: str, sudo: bool = False, check: bool = True) -> str:
+    def run(self, command: str, sudo: bool = False, check: bool = True, pty: bool = True, attempt: int = 0) -> str:
         self.commands.append((command, sudo, check))
         if "command -v ping" in command:
             return "ok"
@@ -34,6 +44,31 @@ class MtuSSH(FakeSSH):
         return ""
 
 
+class FakeChannel:
+    def __init__(self, status: int) -> None:
+        self.status = status
+
+    def recv_exit_status(self) -> int:
+        return self.status
+
+
+class FakeStream(BytesIO):
+    def __init__(self, data: bytes = b"", status: int = 0) -> None:
+        super().__init__(data)
+        self.channel = FakeChannel(status)
+
+
+class FakeParamikoClient:
+    def __init__(self, outputs: dict[str, tuple[bytes, int]]) -> None:
+        self.outputs = outputs
+
+    def exec_command(self, command: str, get_pty: bool = False):
+        for key, (data, status) in self.outputs.items():
+            if key in command:
+                return FakeStream(), FakeStream(data, status), FakeStream()
+        return FakeStream(), FakeStream(), FakeStream()
+
+
 def _has_command(commands: list[tuple[str, bool, bool]], needle: str) -> bool:
     return any(needle in cmd for cmd, _, _ in commands)
 
@@ -50,7 +85,40 @@ def test_install_wireguard_debian() -> None:
     ssh = FakeSSH()
     prov = WireGuardProvisioner(ssh)
     prov.install_wireguard({"ID": "ubuntu", "ID_LIKE": "debian"})
-    assert _has_command(ssh.commands, "apt-get install -y wireguard")
+    assert _has_command(ssh.commands, "install -y wireguard qrencode iptables curl")
+    assert _has_command(ssh.commands, "DPkg::Lock::Timeout")
+
+
+def test_apt_install_reports_package_timings() -> None:
+    ssh = FakeSSH({"@@timings": "@@start 1000\n@@timings\ncurl 1003\nwireguard 1010\n"})
+    prov = WireGuardProvisioner(ssh)
+    timings = prov._apt_install(["wireguard", "curl"], update=False)
+    assert timings == [{"package": "curl", "seconds": 3}, {"package": "wireguard", "seconds": 7}]
+    assert prov.package_timings == timings
+
+
+@needs_bash
+def test_install_plans_a_single_apt_transaction() -> None:
+    sim = SimulatedSSH(installed=False, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        os_info = {"ID": "ubuntu", "ID_LIKE": "debian"}
+        WireGuardProvisioner(sim, protocol="wireguard").install_wireguard(os_info)
+        installs = [cmd for cmd in sim.commands if " install -y " in cmd]
+        assert len(installs) == 1 and " update -y" in installs[0]
+        assert sim.exists("/var/lib/dpkg/sim-installed")
+
+        sim.reset_counters()
+        WireGuardProvisioner(sim, protocol="wireguard").install_wireguard(os_info)
+        assert sim.round_trips == 1
+
+        sim.write("/var/lib/dpkg/sim-installed", "wireguard\nqrencode\niptables\n")
+        sim.reset_counters()
+        WireGuardProvisioner(sim, protocol="wireguard").install_wireguard(os_info)
+        installs = [cmd for cmd in sim.commands if " install -y " in cmd]
+        assert len(installs) == 1 and " update -y" not in installs[0]
+        assert "install -y curl iptables-persistent" in installs[0]
+    finally:
+        sim.cleanup()
 
 
 def test_install_wireguard_rhel() -> None:
@@ -105,3 +173,544 @@ def test_precheck_passes_on_supported_os() -> None:
     checks = prov.pre_check()
     assert any(item.get("name") == "os_supported" and item.get("ok") for item in checks)
     assert any(item.get("name") == "port_available" and item.get("ok") for item in checks)
+
+
+def test_ssh_runner_records_command_stats_per_phase() -> None:
+    timings = CommandTimings()
+    ssh = SSHRunner(SSHConfig(host="example.com", user="root"), on_command=timings)
+    ssh.client = FakeParamikoClient({"uname": (b"6.1.0\n", 0), "false": (b"", 1)})
+    ssh.phase = "Detecting OS"
+    assert ssh.run("uname -r") == "6.1.0"
+    ssh.run("uname -r", attempt=1)
+    ssh.phase = "Configuring firewall"
+    ssh.run("false", check=False)
+
+    assert [stat.exit_code for stat in timings.records] == [0, 0, 1]
+    assert timings.records[0].bytes_in == len(b"6.1.0\n")
+    # Repeating a command is not a retry; only callers that retry say so.
+    assert [stat.retries for stat in timings.records] == [0, 1, 0]
+    breakdown = {entry["phase"]: entry for entry in timings.breakdown()}
+    assert breakdown["Detecting OS"]["commands"] == 2
+    assert breakdown["Configuring firewall"]["commands"] == 1
+
+
+def test_ssh_runner_logs_slow_commands() -> None:
+    logs: list[str] = []
+    ssh = SSHRunner(SSHConfig(host="example.com", user="root"), logger=logs.append, slow_threshold=0.0)
+    ssh.client = FakeParamikoClient({})
+    ssh.run("apt-get update")
+    assert any(line.startswith("Slow command") and "apt-get update" in line for line in logs)
+
+
+@needs_bash
+def test_simulated_ssh_add_client_updates_server_config() -> None:
+    sim = SimulatedSSH(clients=3, latency=0.1, cpu_cost=0.0, command_costs={})
+    try:
+        prov = WireGuardProvisioner(sim)
+        result = prov.add_client("phone")
+        assert result["ip"] == "10.10.0.5/32"
+        assert "AllowedIPs = 10.10.0.5/32" in sim.read("/etc/amnezia/amneziawg/awg0.conf")
+        assert sim.simulated_seconds == pytest.approx(sim.round_trips * 0.1)
+    finally:
+        sim.cleanup()
+
+
+def test_list_clients_parses_batched_dump_with_peer_stats() -> None:
+    dump = (
+        "@@iface awg0\n"
+        "@@conf /etc/amnezia/amneziawg/clients/phone.conf\n"
+        "@@conf /etc/amnezia/amneziawg/clients/laptop.conf\n"
+        "@@addr /etc/amnezia/amneziawg/clients/phone.conf:Address = 10.10.0.2/32\n"
+        "@@addr /etc/amnezia/amneziawg/clients/laptop.conf:Address = 10.10.0.3/32\n"
+        "@@pub /etc/amnezia/amneziawg/clients/phone.pub:PHONEKEY=\n"
+        "@@show\n"
+        "interface: awg0\n"
+        "peer: PHONEKEY=\n"
+        "  endpoint: 198.51.100.7:5555\n"
+        "  transfer: 1.2 MiB received, 3.4 MiB sent\n"
+    )
+    ssh = FakeSSH({"test -f": "awg", "@@iface": dump})
+    prov = WireGuardProvisioner(ssh)
+    clients = prov.list_clients()
+    assert [client["name"] for client in clients] == ["phone", "laptop"]
+    assert clients[0]["ip"] == "10.10.0.2/32"
+    assert clients[0]["endpoint"] == "198.51.100.7:5555"
+    assert clients[0]["transfer_tx"] == "3.4 MiB"
+    assert clients[1]["public_key"] == ""
+    assert len(ssh.commands) == 2
+
+
+@needs_bash
+def test_reprovision_of_configured_server_skips_every_step() -> None:
+    sim = SimulatedSSH(installed=False, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        WireGuardProvisioner(sim, auto_mtu=False).provision()
+        sim.reset_counters()
+        results = WireGuardProvisioner(sim, auto_mtu=False).provision()
+        assert {result.status for result in results.values()} == {"skipped"}
+        assert sim.round_trips <= 2
+    finally:
+        sim.cleanup()
+
+
+@needs_bash
+def test_provision_resumes_after_failed_step() -> None:
+    sim = SimulatedSSH(latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        (sim.root / ".bin" / "systemctl").write_text("#!/usr/bin/env bash\nexit 1\n", encoding="utf-8")
+        with pytest.raises(Exception):
+            WireGuardProvisioner(sim, auto_mtu=False).provision()
+        recorded = {line.split()[0] for line in sim.read("/etc/vpn-wizard/provision.state").splitlines()}
+        assert "setup" in recorded and "service" not in recorded
+        (sim.root / ".bin" / "systemctl").write_text("#!/usr/bin/env bash\nexit 0\n", encoding="utf-8")
+        results = WireGuardProvisioner(sim, auto_mtu=False).provision()
+        assert results["setup"].status == "skipped"
+        assert results["service"].status == "done"
+    finally:
+        sim.cleanup()
+
+
+@needs_bash
+def test_plan_provision_reports_changed_steps_only() -> None:
+    sim = SimulatedSSH(installed=False, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        WireGuardProvisioner(sim, auto_mtu=False).provision()
+        plan = WireGuardProvisioner(sim, auto_mtu=False).plan_provision()
+        assert {row["action"] for row in plan} == {"skip"}
+
+        changed = WireGuardProvisioner(sim, auto_mtu=False, listen_port=51999)
+        actions = {row["step"]: row["action"] for row in changed.plan_provision()}
+        assert actions == {
+            "install": "skip",
+            "sysctl": "skip",
+            "mtu": "run",
+            "public_ip": "run",
+            "setup": "run",
+            "firewall": "run",
+            "service": "run",
+        }
+        setup = next(row for row in changed.plan_provision() if row["step"] == "setup")
+        assert "-ListenPort = 3478\n+ListenPort = 51999\n" in setup["diff"]
+        assert "PrivateKey = <redacted>" in setup["diff"] and "<generated>" not in setup["diff"]
+        results = changed.provision()
+        assert results["sysctl"].status == "skipped"
+        assert results["firewall"].status == "done"
+        assert "ListenPort = 51999" in sim.read("/etc/amnezia/amneziawg/awg0.conf")
+    finally:
+        sim.cleanup()
+
+
+@needs_bash
+def test_plan_provision_notices_files_edited_on_the_server() -> None:
+    sim = SimulatedSSH(installed=False, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        WireGuardProvisioner(sim, auto_mtu=False).provision()
+        sim.write("/etc/sysctl.d/99-vpn-wizard.conf", "net.ipv4.ip_forward=0\n")
+        plan = {row["step"]: row for row in WireGuardProvisioner(sim, auto_mtu=False).plan_provision()}
+        assert (plan["sysctl"]["action"], plan["sysctl"]["reason"]) == ("run", "changed on server since last run")
+        assert "-net.ipv4.ip_forward=0\n+net.ipv4.ip_forward=1\n" in plan["sysctl"]["diff"]
+        assert plan["setup"]["action"] == "skip" and plan["setup"]["diff"] == ""
+
+        # Adding peers is not drift: only the [Interface] section is tracked.
+        WireGuardProvisioner(sim, auto_mtu=False).add_client("phone")
+        WireGuardProvisioner(sim, auto_mtu=False).provision()
+        assert sim.read("/etc/sysctl.d/99-vpn-wizard.conf") == WireGuardProvisioner.SYSCTL_CONF
+        assert {row["action"] for row in WireGuardProvisioner(sim, auto_mtu=False).plan_provision()} == {"skip"}
+    finally:
+        sim.cleanup()
+
+
+@needs_bash
+def test_install_step_reruns_when_module_or_packages_go_missing() -> None:
+    sim = SimulatedSSH(installed=False, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        WireGuardProvisioner(sim, auto_mtu=False).provision()
+        # A kernel upgrade leaves the tools on PATH but no module for the running kernel.
+        (sim.root / ".bin" / "modinfo").write_text("#!/usr/bin/env bash\nexit 1\n", encoding="utf-8")
+        install = WireGuardProvisioner(sim, auto_mtu=False).plan_provision()[0]
+        assert (install["action"], install["reason"]) == ("run", "recorded but missing on server")
+
+        (sim.root / ".bin" / "modinfo").write_text("#!/usr/bin/env bash\nexit 0\n", encoding="utf-8")
+        sim.write("/var/lib/dpkg/sim-installed", "amneziawg\niptables\ncurl\n")
+        assert WireGuardProvisioner(sim, auto_mtu=False).plan_provision()[0]["action"] == "run"
+
+        sim.write("/etc/vpn-wizard/provision.state", "")
+        sim.write("/var/lib/dpkg/sim-installed", "amneziawg\nqrencode\niptables\ncurl\n")
+        install = WireGuardProvisioner(sim, auto_mtu=False).plan_provision()[0]
+        assert (install["action"], install["reason"]) == ("run", "no record of a previous run")
+    finally:
+        sim.cleanup()
+
+
+def test_load_private_key_detects_key_types() -> None:
+    from io import StringIO
+
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519
+    import paramiko
+
+    from vpn_wizard.core import load_private_key
+
+    ed25519_text = ed25519.Ed25519PrivateKey.generate().private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.OpenSSH,
+        serialization.NoEncryption(),
+    ).decode("ascii")
+    assert isinstance(load_private_key(ed25519_text), paramiko.Ed25519Key)
+    for key in (paramiko.ECDSAKey.generate(), paramiko.RSAKey.generate(2048)):
+        buf = StringIO()
+        key.write_private_key(buf)
+        assert type(load_private_key(buf.getvalue())) is type(key)
+    with pytest.raises(paramiko.SSHException):
+        load_private_key("not a key")
+
+
+def test_private_key_cache_parses_each_key_once() -> None:
+    from io import StringIO
+
+    import paramiko
+
+    from vpn_wizard.core import PrivateKeyCache, SSHConfig, load_private_key
+
+    buf = StringIO()
+    paramiko.ECDSAKey.generate().write_private_key(buf)
+    text = buf.getvalue()
+    calls = []
+
+    def loader(content: str) -> paramiko.PKey:
+        calls.append(content)
+        return load_private_key(content)
+
+    cache = PrivateKeyCache(maxsize=2)
+    first = cache.get("paramiko", text, loader)
+    assert cache.get("paramiko", "\n" + text + "\n", loader) is first
+    assert len(calls) == 1
+    cache.get("other", text, lambda _: object())
+    cache.get("third", text, lambda _: object())
+    assert len(cache) == 2
+    assert cache.get("paramiko", text, loader) is not first  # evicted, parsed again
+    assert len(calls) == 2
+
+    a = SSHConfig(host="h1", user="root", key_content=text)
+    b = SSHConfig(host="h2", user="root", key_content=text)
+    assert a.private_key() is b.private_key()
+    assert SSHConfig(host="h3", user="root").private_key() is None
+
+
+@needs_bash
+def test_concurrent_add_client_on_one_host_gets_distinct_ips() -> None:
+    from concurrent.futures import ThreadPoolExecutor
+
+    from vpn_wizard.backend import SQLiteBackend
+
+    sim = SimulatedSSH(clients=2, latency=0.01, cpu_cost=0.0, command_costs={}, realtime=True)
+    try:
+        backend = SQLiteBackend()
+        provs = [WireGuardProvisioner(sim, lock_backend=backend, remote_lock=True) for _ in range(4)]
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(lambda pair: pair[1].add_client(f"c{pair[0]}"), enumerate(provs)))
+        assert len({item["ip"] for item in results}) == 4
+        assert sim.commands.count("flock /run/lock/vpn-wizard.lock") == 4
+
+        # rotate_client nests remove/add under the same lock without deadlocking itself.
+        provs[0].rotate_client("c0")
+        assert sim.commands.count("flock /run/lock/vpn-wizard.lock") == 5
+    finally:
+        sim.cleanup()
+
+
+@needs_bash
+def test_read_only_operations_do_not_take_the_host_lock() -> None:
+    import threading
+
+    from vpn_wizard.core import HOST_LOCKS
+
+    sim = SimulatedSSH(clients=2, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        prov = WireGuardProvisioner(sim)
+        held, release = threading.Event(), threading.Event()
+
+        def writer() -> None:
+            with prov.host_lock():
+                held.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        held.wait(5)
+        assert len(prov.list_clients()) == 2
+        release.set()
+        thread.join()
+        assert HOST_LOCKS._depth[f"{sim.config.host}:22"] == 0
+    finally:
+        sim.cleanup()
+
+
+def test_host_lock_wait_is_bounded() -> None:
+    import threading
+
+    from vpn_wizard.core import HostLocks
+
+    locks, held, release = HostLocks(), threading.Event(), threading.Event()
+
+    def holder() -> None:
+        with locks.hold("h:22"):
+            held.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=holder)
+    thread.start()
+    try:
+        held.wait(5)
+        with pytest.raises(TimeoutError, match="busy"):
+            with locks.hold("h:22", timeout=0.05):
+                pass
+    finally:
+        release.set()
+        thread.join()
+    with locks.hold("h:22", timeout=0.05):
+        assert locks._depth["h:22"] == 1
+
+
+@needs_bash
+def test_backup_store_dedups_prunes_and_restores() -> None:
+    sim = SimulatedSSH(clients=2, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        prov = WireGuardProvisioner(sim)
+        prov.BACKUP_KEEP = 3
+        first = prov.backup_config()
+        assert first and prov.backup_config() == first  # unchanged config: no new snapshot
+
+        prov.add_client("phone")  # snapshots the state before the change: still `first`
+        backups = prov.list_backups()
+        assert [item["id"] for item in backups] == [first] and not backups[0]["current"]
+        prov.add_client("laptop")
+        backups = prov.list_backups()
+        assert len(backups) == 2 and backups[0]["label"] == "peers"
+        with_phone = backups[0]["id"]
+
+        # Each rollback undoes one more change: client files and awg0.conf come back together.
+        assert prov.rollback_last_backup() == with_phone
+        assert sim.exists("/etc/amnezia/amneziawg/clients/phone.conf")
+        assert not sim.exists("/etc/amnezia/amneziawg/clients/laptop.conf")
+        assert prov.rollback_last_backup() == first
+        assert not sim.exists("/etc/amnezia/amneziawg/clients/phone.conf")
+        assert "10.10.0.4/32" not in sim.read("/etc/amnezia/amneziawg/awg0.conf")
+        assert prov.rollback_last_backup() is None  # nothing older to step back to
+        assert prov.restore_backup(with_phone)
+        assert sim.exists("/etc/amnezia/amneziawg/clients/phone.conf")
+        assert not prov.restore_backup("20000101000000-0123456789abcdef")
+
+        for name in ("a1", "a2", "a3"):
+            prov.add_client(name)
+        backups = prov.list_backups()
+        assert len(backups) == 3 and first not in {item["id"] for item in backups}
+        objects = list(sim.path("/var/backups/vpn-wizard/amneziawg/objects").iterdir())
+        assert len(objects) == 3
+    finally:
+        sim.cleanup()
+
+
+@needs_bash
+def test_rollback_undoes_first_change_on_a_server_without_backups() -> None:
+    sim = SimulatedSSH(clients=2, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        prov = WireGuardProvisioner(sim)
+        assert not sim.exists("/var/backups/vpn-wizard/amneziawg/index")
+        prov.add_client("phone")
+        assert prov.rollback_last_backup()
+        assert not sim.exists("/etc/amnezia/amneziawg/clients/phone.conf")
+        assert prov.rollback_last_backup() is None  # does not toggle back to the undone add
+        assert not sim.exists("/etc/amnezia/amneziawg/clients/phone.conf")
+
+        # A new change after a rollback is undone on its own.
+        prov.remove_client("client1")
+        assert prov.rollback_last_backup()
+        assert sim.exists("/etc/amnezia/amneziawg/clients/client1.conf")
+
+        old_key = sim.read("/etc/amnezia/amneziawg/clients/client2.pub")
+        prov.rotate_client("client2")
+        assert sim.read("/etc/amnezia/amneziawg/clients/client2.pub") != old_key
+        assert prov.rollback_last_backup()
+        assert sim.read("/etc/amnezia/amneziawg/clients/client2.pub") == old_key
+    finally:
+        sim.cleanup()
+
+
+@needs_bash
+def test_diagnostics_run_sections_concurrently_with_timeouts_and_caps(monkeypatch) -> None:
+    sim = SimulatedSSH(clients=1, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        prov = WireGuardProvisioner(sim)
+        monkeypatch.setattr(
+            prov,
+            "diagnostic_sections",
+            lambda: [
+                ("slow", "Slow", "sleep 1; echo slow"),
+                ("hung", "Hung", "sleep 30"),
+                ("big", "Big", "head -c 5000 /dev/zero | tr '\\0' x"),
+                ("echo", "Echo", "echo hello"),
+            ],
+        )
+        started = time.monotonic()
+        sections = prov.collect_diagnostics(timeout=1.5, max_bytes=100, compress=True)
+        assert time.monotonic() - started < 5  # sections ran side by side
+        assert len(sim.commands) == 1
+        by_key = {item["key"]: item for item in sections}
+        assert by_key["slow"]["output"] == "slow" and by_key["slow"]["exit_code"] == 0
+        assert by_key["hung"]["timed_out"]
+        assert by_key["big"]["truncated"] and by_key["big"]["bytes"] == 5000
+        assert by_key["big"]["output"] == "x" * 100
+
+        report = prov.get_system_report(["echo", "hung"], timeout=0.5)
+        assert "--- Echo ---\nhello" in report and "(timed out)" in report
+        assert "--- Big ---" not in report
+        with pytest.raises(ValueError, match="nope"):
+            prov.collect_diagnostics(["nope"])
+    finally:
+        sim.cleanup()
+
+
+@needs_bash
+def test_plan_previews_peer_changes_in_one_read_round_trip() -> None:
+    sim = SimulatedSSH(clients=3, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        prov = WireGuardProvisioner(sim, mtu=1352)
+        server_conf = "/etc/amnezia/amneziawg/awg0.conf"
+        before = sim.read(server_conf)
+        sim.reset_counters()
+        plan = prov.plan_add_client("phone")
+        assert sim.round_trips == 1
+        assert sim.read(server_conf) == before
+        assert not sim.exists("/etc/amnezia/amneziawg/clients/phone.conf")
+        assert plan.result == {"name": "phone", "ip": "10.10.0.5/32", "interface": "awg0"}
+        assert [(c.path, c.action) for c in plan.changes] == [
+            (server_conf, "modify"),
+            ("/etc/amnezia/amneziawg/clients/phone.conf", "create"),
+            ("/etc/amnezia/amneziawg/clients/phone.pub", "create"),
+        ]
+        assert "+AllowedIPs = 10.10.0.5/32" in plan.diff()
+        assert "+PrivateKey = <new private key>" in plan.diff()
+        assert "systemctl restart awg-quick@awg0" in plan.commands
+
+        # The preview is exactly what the real operation writes, up to generated keys.
+        prov.add_client("phone")
+        pub = sim.read("/etc/amnezia/amneziawg/clients/phone.pub").strip()
+        priv = sim.read("/etc/amnezia/amneziawg/clients/phone.key").strip()
+        for change in plan.changes:
+            expected = change.after.replace("<new public key of phone>", pub)
+            expected = expected.replace("<new private key>", priv)
+            assert sim.read(change.path) == expected
+
+        assert prov.plan_remove_client("ghost").changes == []
+        rotate = prov.plan_rotate_client("client2")
+        assert {c.path for c in rotate.changes} == {
+            server_conf,
+            "/etc/amnezia/amneziawg/clients/client2.conf",
+            "/etc/amnezia/amneziawg/clients/client2.pub",
+        }
+        with pytest.raises(ValueError):
+            prov.plan("provision")
+    finally:
+        sim.cleanup()
+
+
+@needs_bash
+def test_plan_repair_network_matches_the_repair() -> None:
+    sim = SimulatedSSH(clients=2, protocol="wireguard", latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        prov = WireGuardProvisioner(sim, protocol="wireguard")
+        plan = prov.plan_repair_network()
+        assert {c.path for c in plan.changes} == {
+            "/etc/wireguard/wg0.conf",
+            "/etc/default/ufw",
+            "/etc/sysctl.d/99-vpn-wizard-repair.conf",
+        }
+        assert sim.read("/etc/default/ufw") == 'DEFAULT_FORWARD_POLICY="DROP"\n'
+        prov.repair_network()
+        for change in plan.changes:
+            assert sim.read(change.path) == change.after
+    finally:
+        sim.cleanup()
+
+
+@needs_bash
+def test_client_index_answers_lookups_in_one_round_trip() -> None:
+    sim = SimulatedSSH(clients=3, latency=0.0, cpu_cost=0.0, command_costs={})
+    outputs: list[str] = []
+    run = sim.run
+
+    def recording_run(command: str, *args, **kwargs) -> str:
+        out = run(command, *args, **kwargs)
+        outputs.append(out)
+        return out
+
+    sim.run = recording_run
+    try:
+        sim.seed_clients(3, tyumen=2)
+        prov = WireGuardProvisioner(sim, lock_backend=SQLiteBackend())
+        sim.reset_counters()
+        tyumen = prov.find_client(ip="10.11.0.3")
+        assert sim.round_trips == 1
+        assert (tyumen["name"], tyumen["interface"], tyumen["ip"]) == ("tyumen2", "awg1", "10.11.0.3/32")
+        assert "client2\tawg0\t10.10.0.3/32" in outputs[-1]
+
+        # An unchanged index is answered with its hash only and served from the local copy.
+        by_key = prov.find_client(public_key=sim.read("/etc/amnezia/amneziawg/clients/client2.pub").strip())
+        assert by_key["name"] == "client2"
+        assert outputs[-1].splitlines()[-1].startswith("@@same ")
+        assert prov.export_client("tyumen1")["interface"] == "awg1"
+
+        assert prov.remove_client("client2")
+        assert not sim.exists("/etc/vpn-wizard/clients.tsv")
+        assert prov.find_client(name="client2") is None
+        added = prov.add_client("phone")
+        assert prov.find_client(ip="10.10.0.3")["name"] == added["name"] == "phone"
+        assert prov.find_client(name="ghost") is None
+    finally:
+        sim.cleanup()
+
+
+@needs_bash
+def test_rotate_client_swaps_the_peer_live_and_rolls_back_on_failure() -> None:
+    sim = SimulatedSSH(clients=3, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        prov = WireGuardProvisioner(sim, lock_backend=SQLiteBackend())
+        base = "/etc/amnezia/amneziawg"
+        paths = (f"{base}/clients/client2.conf", f"{base}/clients/client2.pub", f"{base}/awg0.conf")
+        old_pub = sim.read(paths[1]).strip()
+        plan = prov.plan_rotate_client("client2")
+
+        sim.reset_counters()
+        result = prov.rotate_client("client2")
+        assert sim.round_trips == 2
+        assert not any("systemctl restart" in command for command in sim.commands)
+        new_pub = sim.read(paths[1]).strip()
+        new_priv = sim.read(f"{base}/clients/client2.key").strip()
+        assert new_pub != old_pub
+        assert sim.read("/run/wg-set.log").splitlines() == [
+            f"set awg0 peer {old_pub} remove",
+            f"set awg0 peer {new_pub} allowed-ips 10.10.0.3/32",
+        ]
+        assert result["config"] == sim.read(paths[0])
+        assert f"PrivateKey = {new_priv}" in result["config"]
+        for change in plan.changes:
+            expected = change.after.replace("<new public key of client2>", new_pub)
+            assert sim.read(change.path) == expected.replace("<new private key>", new_priv)
+        assert prov.list_backups()[0]["label"] == "peers"
+
+        # A failure after the live swap restores the files and the old peer.
+        (sim.root / ".bin" / "awg").write_text(
+            "#!/usr/bin/env bash\n"
+            'case "$*" in *allowed-ips*) [ -f "$VPNW_SIM_ROOT/run/failed" ] || { touch "$VPNW_SIM_ROOT/run/failed"; exit 1; } ;; esac\n'
+            'exec "$VPNW_SIM_STUBS/wg" "$@"\n',
+            encoding="utf-8",
+        )
+        before = {path: sim.read(path) for path in paths}
+        with pytest.raises(RemoteCommandError):
+            prov.rotate_client("client2")
+        assert {path: sim.read(path) for path in paths} == before
+        assert sim.read("/run/wg-set.log").splitlines()[-1] == f"set awg0 peer {new_pub} allowed-ips 10.10.0.3/32"
+        assert not [path for path in sim.path(f"{base}/clients").iterdir() if path.suffix == ".new"]
+    finally:
+        sim.cleanup()
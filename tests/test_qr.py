@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import asyncio
+from io import BytesIO
+import threading
+from unittest import mock
+
+from PIL import Image
+import qrcode
+
+from vpn_wizard import qr as qr_module
+from vpn_wizard.qr import QREngine, compact_config, qr_code, render_qr
+
+CONFIG = "[Interface]\nPrivateKey = test\nAddress = 10.10.0.2/32\n\n[Peer]\nEndpoint = 203.0.113.10:3478\n"
+
+
+def _pixels(png: bytes) -> tuple:
+    img = Image.open(BytesIO(png))
+    return img.size, img.convert("L").tobytes()
+
+
+def test_fast_png_matches_pillow_pixels() -> None:
+    fast = render_qr(CONFIG, "png", fast=True)
+    assert fast.startswith(b"\x89PNG")
+    assert _pixels(fast) == _pixels(render_qr(CONFIG, "png", fast=False))
+    assert render_qr(CONFIG, "svg").lstrip().startswith(b"<?xml")
+
+
+def test_engine_renders_in_processes_in_order() -> None:
+    engine = QREngine(workers=2, max_pending=4)
+    try:
+        configs = [CONFIG.replace("10.10.0.2", f"10.10.0.{i}") for i in range(2, 8)]
+        rendered = list(engine.map((config, "png") for config in configs))
+        expected = [_pixels(render_qr(config, "png", compact=engine.compact)) for config in configs]
+        assert [_pixels(png) for png in rendered] == expected
+        assert asyncio.run(engine.arender(CONFIG, "svg")) == render_qr(CONFIG, "svg", compact=engine.compact)
+    finally:
+        engine.shutdown()
+
+
+def test_engine_bounds_queued_renders() -> None:
+    engine = QREngine(workers=0, max_pending=1)
+    engine._slots.acquire()  # one render already queued
+    submitted = threading.Event()
+    thread = threading.Thread(target=lambda: (engine.submit(CONFIG), submitted.set()))
+    thread.start()
+    assert not submitted.wait(0.2)
+    engine._slots.release()
+    assert submitted.wait(5)
+    thread.join()
+
+
+def test_zero_workers_from_environment_renders_inline(monkeypatch) -> None:
+    monkeypatch.setenv("VPNW_QR_WORKERS", "0")
+    engine = QREngine()
+    assert engine.workers == 0
+    with mock.patch.object(qr_module, "ProcessPoolExecutor") as pool:
+        assert engine.submit("inline").result().startswith(b"\x89PNG")
+    pool.assert_not_called()
+    monkeypatch.setenv("VPNW_QR_WORKERS", "")
+    assert QREngine().workers >= 1
+
+
+def test_compact_config_drops_whitespace_comments_and_defaults() -> None:
+    config = (
+        "# phone\n[Interface]\nPrivateKey = abc=\nAddress = 10.10.0.2/32\nDNS = 1.1.1.1, 1.0.0.1\n"
+        "Jc = 0\nH1 = 1\n\n[Peer]\nPublicKey = def=\nAllowedIPs = 0.0.0.0/0, ::/0\n"
+        "PersistentKeepalive = 0\nEndpoint = 203.0.113.10:3478\n"
+    )
+    assert compact_config(config) == (
+        "[Interface]\nPrivateKey=abc=\nAddress=10.10.0.2/32\nDNS=1.1.1.1,1.0.0.1\n"
+        "[Peer]\nPublicKey=def=\nAllowedIPs=0.0.0.0/0,::/0\nEndpoint=203.0.113.10:3478"
+    )
+    grouped = compact_config("[Interface]\nMTU = 1380\nAddress = 10.10.0.2/32\n", group_numeric=True)
+    assert grouped == "[Interface]\nAddress=10.10.0.2/32\nMTU=1380"
+
+
+def test_qr_code_picks_smallest_version_and_boosts_error_correction() -> None:
+    qr = qr_code("short")
+    assert qr.version == 1 and qr.error_correction == qrcode.constants.ERROR_CORRECT_H
+    verbatim = qrcode.QRCode()
+    verbatim.add_data(CONFIG * 4)
+    verbatim.make(fit=True)
+    compact = qr_code(compact_config(CONFIG * 4))
+    assert compact.version < verbatim.version
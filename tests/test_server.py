@@ -1,6 +1,20 @@
 from __future__ import annotations
 
-from vpn_wizard.server import JobStore
+import asyncio
+import hashlib
+import json
+import shutil
+import time
+from unittest import mock
+
+import pytest
+from fastapi import Request, Response
+
+from vpn_wizard import server
+from vpn_wizard.server import JobStore, SSHPayload, StatusRequest, _ssh_config
+from vpn_wizard.testing import AsyncRunner, SimulatedSSH
+
+needs_bash = pytest.mark.skipif(shutil.which("bash") is None, reason="SimulatedSSH needs bash")
 
 
 def test_job_store_create_update_and_progress() -> None:
@@ -12,3 +26,228 @@ def test_job_store_create_update_and_progress() -> None:
     assert stored is not None
     assert stored.status == "running"
     assert stored.progress == ["step 1"]
+
+
+def test_ssh_config_keeps_key_in_memory() -> None:
+    payload = SSHPayload(host="1.2.3.4", user="root", key_content="-----BEGIN KEY-----")
+    cfg = _ssh_config(payload)
+    assert cfg.key_content == "-----BEGIN KEY-----"
+    assert cfg.key_path is None
+
+
+@needs_bash
+def test_server_status_is_one_round_trip_cached_and_conditional() -> None:
+    sim = SimulatedSSH(clients=3, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        sim.seed_clients(3, tyumen=2)
+        payload = StatusRequest(ssh={"host": sim.config.host, "user": "root", "password": "pw"})
+
+        def call(etag: str = "", body: StatusRequest = payload):
+            request = Request({"type": "http", "headers": [(b"if-none-match", etag.encode())]})
+            response = Response()
+            return server.server_status(body, request, response), response
+
+        with mock.patch.object(server, "AsyncSSHRunner", lambda *args, **kwargs: AsyncRunner(sim)):
+            coro, response = call()
+            status = asyncio.run(coro)
+            assert len(sim.commands) == 1
+            assert status.configured and status.protocol == "amneziawg"
+            assert status.clients_count == 5 and status.tyumen_port == 3479
+            assert [(item.name, item.peers, item.service) for item in status.interfaces] == [
+                ("awg0", 3, "active"),
+                ("awg1", 2, "active"),
+            ]
+            etag = response.headers["etag"]
+
+            coro, _ = call(etag)
+            assert asyncio.run(coro).status_code == 304
+            other = StatusRequest(ssh={"host": sim.config.host, "user": "root", "password": "guess"})
+            coro, _ = call("", other)
+            assert asyncio.run(coro).ok
+            assert len(sim.commands) == 2  # cached entry is not served to other credentials
+
+            server._forget_status(payload.ssh)
+            coro, _ = call(etag)
+            assert asyncio.run(coro).status_code == 304  # refreshed, unchanged: same ETag
+            assert len(sim.commands) == 3
+    finally:
+        server._forget_status(payload.ssh)
+        sim.cleanup()
+
+
+@needs_bash
+def test_status_cache_stores_only_a_keyed_credential_check() -> None:
+    sim = SimulatedSSH(clients=1, latency=0.0, cpu_cost=0.0, command_costs={})
+    payload = StatusRequest(ssh={"host": sim.config.host, "user": "root", "password": "pw"})
+    creds = [sim.config.host, 22, "root", "pw", None, None]
+
+    def call() -> None:
+        request = Request({"type": "http", "headers": []})
+        assert asyncio.run(server.server_status(payload, request, Response())).ok
+
+    try:
+        with mock.patch.object(server, "AsyncSSHRunner", lambda *args, **kwargs: AsyncRunner(sim)):
+            call()
+            auth = server.get_backend().get(server._status_cache_key(payload.ssh))["auth"]
+            assert auth != hashlib.sha256(json.dumps(creds).encode("utf-8")).hexdigest()
+            call()
+            assert len(sim.commands) == 1
+            # Without the deployment's secret a stored entry cannot be matched.
+            with mock.patch.object(server, "_STATUS_SECRET", b"another deployment"):
+                call()
+            assert len(sim.commands) == 2
+    finally:
+        server._forget_status(payload.ssh)
+        sim.cleanup()
+
+
+class _SlowRunner(AsyncRunner):
+    """AsyncRunner whose round trips yield to the event loop, like a real connection."""
+
+    connects = 0
+
+    def __init__(self, inner, delay: float) -> None:
+        super().__init__(inner)
+        self.delay = delay
+
+    async def connect(self) -> None:
+        type(self).connects += 1
+
+    async def run(
+        self, command: str, sudo: bool = False, check: bool = True, pty: bool = True, attempt: int = 0
+    ) -> str:
+        await asyncio.sleep(self.delay)
+        return await super().run(command, sudo=sudo, check=check, pty=pty, attempt=attempt)
+
+
+@needs_bash
+def test_status_many_fans_out_and_streams_in_completion_order() -> None:
+    delays = {"203.0.113.1": 0.3, "203.0.113.2": 0.3, "203.0.113.3": 0.3, "203.0.113.4": 5.0}
+    sims = {host: SimulatedSSH(clients=2, public_ip=host, latency=0.0, cpu_cost=0.0) for host in delays}
+    pool = server.AsyncSSHPool(lambda cfg: _SlowRunner(sims[cfg.host], delays[cfg.host]))
+    body = server.StatusManyRequest(
+        servers=[{"host": host, "user": "root"} for host in reversed(delays)],
+        timeout=1.0,
+        refresh=True,
+    )
+
+    async def collect() -> list[dict]:
+        response = await server.servers_status_many(body)
+        lines = [line async for line in response.body_iterator]
+        # A second sweep reuses the pooled connections.
+        response = await server.servers_status_many(body)
+        lines += [line async for line in response.body_iterator]
+        await pool.close()
+        return [json.loads(line) for line in lines]
+
+    try:
+        with mock.patch.object(server, "SSH_POOL", pool):
+            started = time.monotonic()
+            results = asyncio.run(collect())
+            assert time.monotonic() - started < 3.5  # four servers in parallel, twice
+        first = results[:4]
+        assert [item["host"] for item in first][-1] == "203.0.113.4"
+        assert first[-1]["ok"] is False and "Timed out" in first[-1]["error"]
+        assert all(item["ok"] and item["clients_count"] == 2 for item in first[:3])
+        assert sorted(item["index"] for item in first) == [0, 1, 2, 3]
+        assert _SlowRunner.connects == 4  # a timeout cancels the probe but keeps the connection
+    finally:
+        for sim in sims.values():
+            sim.cleanup()
+
+
+@needs_bash
+def test_change_plan_endpoint_previews_without_writing() -> None:
+    sim = SimulatedSSH(clients=2, latency=0.0, cpu_cost=0.0, command_costs={})
+    try:
+        ssh = {"host": sim.config.host, "user": "root", "password": "pw"}
+        with mock.patch.object(server, "AsyncSSHRunner", lambda *args, **kwargs: AsyncRunner(sim)):
+            plan = asyncio.run(
+                server.change_plan(server.ChangePlanRequest(ssh=ssh, operation="remove_client", client_name="client1"))
+            )
+            missing = asyncio.run(server.change_plan(server.ChangePlanRequest(ssh=ssh, operation="rotate_client")))
+        assert plan.ok and plan.result == {"removed": True}
+        assert len(sim.commands) == 1
+        assert [(c.path, c.action) for c in plan.changes][-1] == (
+            "/etc/amnezia/amneziawg/clients/client1.pub",
+            "delete",
+        )
+        assert "-AllowedIPs = 10.10.0.2/32" in plan.diff
+        assert sim.exists("/etc/amnezia/amneziawg/clients/client1.conf")
+        assert not missing.ok and missing.error == "client_name is required."
+    finally:
+        sim.cleanup()
+
+
+@needs_bash
+def test_mutating_endpoints_wait_for_the_host_lock_off_the_event_loop() -> None:
+    import threading
+
+    from vpn_wizard.core import HOST_LOCKS
+
+    sim = SimulatedSSH(clients=2, latency=0.0, cpu_cost=0.0, command_costs={})
+    held, release = threading.Event(), threading.Event()
+
+    def busy_host() -> None:
+        with HOST_LOCKS.hold(f"{sim.config.host}:22"):
+            held.set()
+            release.wait(5)
+
+    async def scenario() -> tuple[server.RollbackResponse, int]:
+        request = server.ClientRemoveRequest(
+            ssh={"host": sim.config.host, "user": "root", "password": "pw"}, client_name="client1"
+        )
+        removal = asyncio.create_task(server.client_remove(request))
+        ticks = 0
+        while ticks < 5:  # the loop keeps serving other requests while the host is busy
+            await asyncio.sleep(0.01)
+            ticks += 1
+        assert not removal.done()
+        release.set()
+        return await removal, ticks
+
+    thread = threading.Thread(target=busy_host)
+    try:
+        thread.start()
+        held.wait(5)
+        with mock.patch.object(server, "SSHRunner", lambda cfg: sim), mock.patch.object(server, "APPLY_QUEUE", None):
+            result, ticks = asyncio.run(scenario())
+        assert result.ok and ticks == 5
+        assert not sim.exists("/etc/amnezia/amneziawg/clients/client1.conf")
+    finally:
+        release.set()
+        thread.join()
+        sim.cleanup()
+
+
+
+@needs_bash
+def test_failed_write_behind_apply_is_reported_and_retried() -> None:
+    sim = SimulatedSSH(clients=2, latency=0.0, cpu_cost=0.0, command_costs={})
+    mktemp = sim.root / ".bin" / "mktemp"
+    ssh = {"host": sim.config.host, "user": "root", "password": "pw"}
+    queue = server.ApplyQueue(delay=30)
+
+    async def status():
+        request = Request({"type": "http", "headers": []})
+        return await server.server_status(StatusRequest(ssh=ssh, refresh=True), request, Response())
+
+    try:
+        with mock.patch.object(server, "SSHRunner", lambda cfg: sim), mock.patch.object(
+            server, "AsyncSSHRunner", lambda *args, **kwargs: AsyncRunner(sim)
+        ), mock.patch.object(server, "APPLY_QUEUE", queue):
+            removal = server.ClientRemoveRequest(ssh=ssh, client_name="client1")
+            assert asyncio.run(server.client_remove(removal)).ok  # queued, not yet rebuilt
+            mktemp.write_text("#!/usr/bin/env bash\nexit 1\n", encoding="utf-8")
+            mktemp.chmod(0o755)
+
+            applied = asyncio.run(server.client_apply(server.RollbackRequest(ssh=ssh)))
+            assert not applied.ok and applied.error.startswith("Peer changes on awg0 were not applied:")
+            assert asyncio.run(status()).apply_error == applied.error
+
+            mktemp.unlink()
+            assert asyncio.run(server.client_apply(server.RollbackRequest(ssh=ssh))).ok
+            assert asyncio.run(status()).apply_error is None
+    finally:
+        server._forget_status(server.SSHPayload(**ssh))
+        sim.cleanup()
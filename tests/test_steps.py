@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import threading
+
+import pytest
+
+from vpn_wizard.steps import Step, StepGraph
+
+
+def test_step_graph_runs_independent_steps_concurrently() -> None:
+    both_started = threading.Barrier(2, timeout=5)
+    order: list[str] = []
+    graph = StepGraph(
+        [
+            Step("a", lambda: (both_started.wait(), order.append("a"))),
+            Step("b", lambda: (both_started.wait(), order.append("b"))),
+            Step("c", lambda: order.append("c"), deps=("a", "b")),
+        ]
+    )
+    results = graph.run(max_workers=2)
+    assert order[-1] == "c"
+    assert {name: result.status for name, result in results.items()} == {"a": "done", "b": "done", "c": "done"}
+
+
+def test_step_graph_skips_and_stops_after_failure() -> None:
+    ran: list[str] = []
+
+    def boom() -> None:
+        raise RuntimeError("boom")
+
+    graph = StepGraph(
+        [
+            Step("done-already", lambda: ran.append("done-already"), skip=lambda: True),
+            Step("fails", boom, deps=("done-already",)),
+            Step("after", lambda: ran.append("after"), deps=("fails",)),
+        ]
+    )
+    with pytest.raises(RuntimeError, match="boom"):
+        graph.run()
+    assert ran == []
+    assert graph.results["done-already"].status == "skipped"
+    assert graph.results["fails"].status == "failed"
+    assert "after" not in graph.results
+
+
+def test_step_graph_rejects_cycles() -> None:
+    with pytest.raises(ValueError):
+        StepGraph([Step("a", lambda: None, deps=("b",)), Step("b", lambda: None, deps=("a",))])
@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+from types import SimpleNamespace
+from unittest import mock
+
+from telegram import Chat, Message, Update, User
+
+import vpn_wizard.tg_bot as tg_bot
+
+
+class FakeBot:
+    def __init__(self, status: str) -> None:
+        self.status = status
+        self.calls = 0
+
+    async def get_chat_member(self, chat_id: str, user_id: int):
+        self.calls += 1
+        return SimpleNamespace(status=self.status)
+
+
+class FakeMessage:
+    def __init__(self) -> None:
+        self.replies: list[str] = []
+        self.edits: list[str] = []
+
+    async def reply_text(self, text: str, **kwargs) -> "FakeMessage":
+        self.replies.append(text)
+        return self
+
+    async def edit_text(self, text: str, **kwargs) -> None:
+        self.edits.append(text)
+
+
+def _update(user_id: int) -> SimpleNamespace:
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id, language_code="en"),
+        message=FakeMessage(),
+    )
+
+
+def test_subscription_cache_uses_separate_ttls() -> None:
+    now = [0.0]
+    cache = tg_bot.SubscriptionCache(member_ttl=100, non_member_ttl=10, clock=lambda: now[0])
+    cache.set(1, True)
+    cache.set(2, False)
+    now[0] = 50
+    assert cache.get(1) is True
+    assert cache.get(2) is None
+    now[0] = 100
+    assert cache.get(1) is None
+
+
+def test_require_subscription_hits_telegram_once_per_ttl(monkeypatch) -> None:
+    monkeypatch.setattr(tg_bot, "REQUIRED_CHANNEL", "@vpnw_test")
+    monkeypatch.setattr(tg_bot, "SUBSCRIPTIONS", tg_bot.SubscriptionCache())
+    bot = FakeBot("member")
+    context = SimpleNamespace(bot=bot)
+
+    async def scenario() -> list[bool]:
+        return [await tg_bot._require_subscription(_update(7), context) for _ in range(5)]
+
+    assert asyncio.run(scenario()) == [True] * 5
+    assert bot.calls == 1
+
+    left = SimpleNamespace(
+        chat_member=SimpleNamespace(
+            chat=SimpleNamespace(id=-100, username="VPNW_test"),
+            new_chat_member=SimpleNamespace(status="left", user=SimpleNamespace(id=7)),
+        )
+    )
+    asyncio.run(tg_bot.on_chat_member(left, context))
+    update = _update(7)
+    assert asyncio.run(tg_bot._require_subscription(update, context)) is False
+    assert bot.calls == 1
+    assert update.message.replies
+
+
+def test_run_provision_sends_config_and_qr_from_memory(monkeypatch) -> None:
+    sent: dict = {}
+
+    class Message(FakeMessage):
+        async def reply_document(self, document, filename: str) -> None:
+            sent["document"] = (document.read(), filename)
+
+        async def reply_photo(self, photo) -> None:
+            sent["photo"] = photo.read()
+
+    async def fake_provision(data: dict, progress=None):
+        progress("Installing AmneziaWG...")
+        return "[Interface]\nPrivateKey = test\n", [{"name": "service_active", "ok": True}]
+
+    monkeypatch.setattr(tg_bot, "_provision", fake_provision)
+    update = _update(1)
+    update.message = Message()
+    asyncio.run(tg_bot._run_provision(update, SimpleNamespace(user_data={})))
+    assert sent["document"] == (b"[Interface]\nPrivateKey = test\n", "client1.conf")
+    assert sent["photo"].startswith(b"\x89PNG")
+    assert update.message.edits[-1].endswith("Installing AmneziaWG...")
+
+
+def test_updates_from_different_users_are_processed_concurrently() -> None:
+    app = tg_bot.build_application("123456:TEST")
+
+    async def scenario() -> None:
+        started = {user_id: asyncio.Event() for user_id in (1, 2)}
+
+        async def handle(user_id: int) -> None:
+            started[user_id].set()
+            # Only finishes once the other user's update is being handled as well.
+            await asyncio.wait_for(started[3 - user_id].wait(), timeout=1)
+
+        processor = app.update_processor
+        await processor.initialize()
+        try:
+            await asyncio.gather(*(processor.process_update(_update(uid), handle(uid)) for uid in (1, 2)))
+        finally:
+            await processor.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_overlapping_updates_from_one_chat_schedule_a_single_run(monkeypatch) -> None:
+    app = tg_bot.build_application("123456:TEST")
+    runs: list[int] = []
+
+    async def fake_run(update, context) -> int:
+        runs.append(update.update_id)
+        await asyncio.sleep(0.1)  # still running when the second message arrives
+        return tg_bot.ConversationHandler.END
+
+    async def subscribed(update, context) -> bool:
+        return True
+
+    monkeypatch.setattr(tg_bot, "_run_provision", fake_run)
+    monkeypatch.setattr(tg_bot, "_require_subscription", subscribed)
+
+    def port_reply(update_id: int) -> Update:
+        user = User(7, "user", False, language_code="en")
+        sent = datetime.datetime.now(datetime.timezone.utc)
+        return Update(update_id, message=Message(update_id, sent, Chat(7, "private"), from_user=user, text="default"))
+
+    async def scenario() -> None:
+        bot = type(app.bot)
+        with mock.patch.object(bot, "initialize", mock.AsyncMock()), mock.patch.object(
+            bot, "shutdown", mock.AsyncMock()
+        ):
+            await app.initialize()
+            conversation = next(h for h in app.handlers[0] if isinstance(h, tg_bot.ConversationHandler))
+            conversation._conversations[(7, 7)] = tg_bot.STATE_PORT
+            try:
+                # The same path Application.start takes for each fetched update.
+                updates = [port_reply(1), port_reply(2)]
+                await asyncio.gather(*(app.update_processor.process_update(u, app.process_update(u)) for u in updates))
+            finally:
+                await app.shutdown()
+
+    asyncio.run(scenario())
+    assert runs == [1]
+
+
+def test_scheduler_limits_concurrency_and_reports_queue_position() -> None:
+    scheduler = tg_bot.ProvisionScheduler(max_active=2, per_user=1)
+    positions: dict[str, list[int]] = {}
+    order: list[str] = []
+    peak = [0]
+
+    async def run(name: str, user_id: int) -> None:
+        async def on_wait(position: int) -> None:
+            positions.setdefault(name, []).append(position)
+
+        async with scheduler.slot(user_id, on_wait=on_wait):
+            order.append(name)
+            peak[0] = max(peak[0], scheduler.active)
+            await asyncio.sleep(0.01)
+
+    async def scenario() -> None:
+        # User 1 submits twice: its second run must wait for its first even with free slots.
+        await asyncio.gather(run("a1", 1), run("a2", 1), run("b", 2), run("c", 3))
+
+    asyncio.run(scenario())
+    assert peak[0] == 2
+    assert order.index("a2") > order.index("a1")
+    assert order.index("b") < order.index("a2")
+    assert positions == {"a2": [1], "c": [2]}
+    assert scheduler.active == 0 and scheduler.waiting == 0
+
+
+def test_scheduler_rejects_when_queue_is_full() -> None:
+    scheduler = tg_bot.ProvisionScheduler(max_active=1, per_user=1, max_waiting=1)
+
+    async def scenario() -> None:
+        async with scheduler.slot(1):
+            waiter = asyncio.create_task(scheduler.slot(2).__aenter__())
+            await asyncio.sleep(0)
+            try:
+                async with scheduler.slot(3):
+                    pass
+            except tg_bot.QueueFull:
+                pass
+            else:
+                raise AssertionError("expected QueueFull")
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+        assert scheduler.waiting == 0
+
+    asyncio.run(scenario())
+
+
+def test_progress_message_coalesces_edits() -> None:
+    edits: list[str] = []
+
+    async def edit(text: str) -> None:
+        edits.append(text)
+
+    async def scenario() -> None:
+        async with tg_bot.ProgressMessage(edit, header="Provisioning", interval=0.05, max_lines=2) as progress:
+            for i in range(50):
+                progress.push(f"step {i}")
+            await asyncio.sleep(0.12)
+            await asyncio.sleep(0.12)  # nothing new: no further edits
+
+    asyncio.run(scenario())
+    assert edits == ["Provisioning\nstep 48\nstep 49"]
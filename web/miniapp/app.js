@@ -910,14 +910,35 @@ function buildSshPayload(data) {
   };
 }
 
-async function fetchServerStatus(data) {
-  return fetchJson("/api/server/status", {
+const serverStatusCache = new Map();
+
+async function fetchServerStatus(data, refresh = false) {
+  const cacheKey = `${data.user}@${data.host}`;
+  const cached = serverStatusCache.get(cacheKey);
+  const headers = { "Content-Type": "application/json" };
+  if (cached && !refresh) {
+    headers["If-None-Match"] = cached.etag;
+  }
+  const response = await fetch(`${API_BASE}/api/server/status`, {
     method: "POST",
-    headers: { "Content-Type": "application/json" },
+    headers,
     body: JSON.stringify({
       ssh: buildSshPayload(data),
+      refresh,
     }),
   });
+  if (response.status === 304 && cached) {
+    return cached.payload;
+  }
+  const payload = await response.json();
+  if (!response.ok) {
+    throw new Error(payload.detail || "Request failed");
+  }
+  const etag = response.headers.get("ETag");
+  if (payload.ok && etag) {
+    serverStatusCache.set(cacheKey, { etag, payload });
+  }
+  return payload;
 }
 
 async function fetchServerPrecheck(data) {